@@ -0,0 +1,396 @@
+"""
+MIT License
+
+Copyright (c) 2022 Eike Jens Hoffmann [eike.jens.hoffmann [at] tum.de]
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import argparse
+import logging
+import math
+import os.path
+import pickle
+import tempfile
+from contextlib import ExitStack
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from preprocess import is_columnar, read_buildings_table
+from streaming import DEFAULT_MEMORY_MB, ChunkedTableWriter, ValueEncoder, estimate_chunk_size, map_chunks
+
+# Columns of tweets.csv.bz2
+TWEET_ID_COLUMN = "tweet_id"
+BUILDING_ID_COLUMN = "osm_building_id"
+CLASS_COLUMN = "building_class"
+
+# Exclusion rates of the statistics table in the appendix of the paper
+DEFAULT_EXCLUSION_RATES = [0, 1, 2, 5, 10, 15, 20, 25]
+
+# Seeds the hashes that choose the tweets kept per building
+SEED = 42
+
+# Columns added to the kept tweets, the hash of the building ID and the hash of the tweet ID deciding which tweets
+# are kept
+BUILDING_HASH_COLUMN = "_building"
+PRIORITY_COLUMN = "_priority"
+
+# Hashes of the selected building IDs and the cap of the workers, set once per process by init_worker
+_worker_state = {}
+
+
+def parse_args():
+    """
+    Reads the command line arguments and returns them
+
+    :return: cmd args
+    """
+    parser = argparse.ArgumentParser("Keeps at most alpha tweets per building after excluding the buildings with the "
+                                     "fewest and the most tweets, and writes statistics of the tweets per building")
+    parser.add_argument("input_tweets", help="Tweets CSV file with Bzip2 compression or Parquet file as input")
+    parser.add_argument("-b", dest="building_files", help="Building lists written by undersample.py or "
+                                                          "split_train_test.py, one output file is written per list",
+                        nargs="*", default=[])
+    parser.add_argument("-e", dest="exclusion_rate", help="Percentage of buildings excluded at each end of the "
+                                                          "distribution of tweets per building", default=0.0,
+                        type=exclusion_rate)
+    parser.add_argument("-a", dest="alpha", help="Maximum number of tweets per building, the rounded mean number of "
+                                                 "tweets per building after the exclusion if not given",
+                        default=None, type=int)
+    parser.add_argument("--stats-rates", dest="stats_rates", help="Exclusion rates of the statistics table",
+                        nargs="*", default=DEFAULT_EXCLUSION_RATES, type=exclusion_rate)
+    parser.add_argument("-p", dest="num_processes", help="Number of processes, Parquet input is read in parallel by "
+                                                         "row group", default=1, type=int)
+    parser.add_argument("-m", dest="memory_mb", help="Memory ceiling of a chunk in megabytes, the kept tweets are "
+                                                     "spilled to temporary files in parts of about this size",
+                        default=DEFAULT_MEMORY_MB, type=int)
+    return parser.parse_args()
+
+
+def exclusion_rate(value):
+    """
+    Parses an exclusion rate, at 50 percent or more the excluded ends would overlap and nothing would be left
+
+    :param value: the command line value
+    :return: the rate as float
+    """
+    rate = float(value)
+    if not 0 <= rate < 50:
+        raise argparse.ArgumentTypeError(f"{value} is not a percentage in [0, 50)")
+    return rate
+
+
+def init_worker(building_hashes, alpha):
+    """
+    Sets the state shared by all chunks of a process, so it is not sent with every chunk
+
+    :param building_hashes: the sorted hashes of the building IDs whose tweets are kept
+    :param alpha: maximum number of tweets per building
+    :return:
+    """
+    _worker_state["building_hashes"] = building_hashes
+    _worker_state["alpha"] = alpha
+
+
+def hash_ids(building_ids):
+    """
+    :param building_ids: an array or Pandas series of building IDs
+    :return: the 64-bit hashes of the IDs as strings, so numeric and string IDs are hashed alike
+    """
+    return pd.util.hash_array(pd.Series(building_ids).astype(str).to_numpy(dtype=object))
+
+
+def find_hashes(sorted_hashes, hashes):
+    """
+    :param sorted_hashes: a sorted array of hashes
+    :param hashes: an array of hashes
+    :return: 1. a boolean mask of the hashes contained in sorted_hashes, 2. their positions in sorted_hashes
+    """
+    positions = np.searchsorted(sorted_hashes, hashes)
+    found = positions < sorted_hashes.shape[0]
+    found[found] = sorted_hashes[positions[found]] == hashes[found]
+    return found, positions
+
+
+class BuildingCounts:
+    """
+    The number of tweets and the class of every building in arrays sorted by the 64-bit hash of the building ID, which
+    needs 20 bytes per building instead of about 200 bytes of a Pandas series indexed by the ID strings. The counts of
+    a chunk are merged with a binary search, so the arrays are never sorted again. Two different IDs share a hash with
+    a probability of about n^2 / 2^65
+    """
+
+    def __init__(self):
+        self.hashes = np.empty(0, dtype=np.uint64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.class_codes = np.empty(0, dtype=np.int32)
+        self._classes = ValueEncoder()
+
+    def __len__(self):
+        return self.hashes.shape[0]
+
+    @property
+    def classes(self):
+        """
+        :return: the class names, class_codes are indices into this list
+        """
+        return self._classes.values
+
+    def add(self, hashes, counts, classes):
+        """
+        Adds the counts of a chunk, the class of a building is the first known class
+        :param hashes: the sorted unique hashes of the building IDs of the chunk
+        :param counts: the number of tweets per building of the chunk
+        :param classes: the class per building of the chunk, None if unknown
+        :return:
+        """
+        codes = self._classes.encode(classes)
+        found, positions = find_hashes(self.hashes, hashes)
+        self.counts[positions[found]] += counts[found]
+        unknown = found.copy()
+        unknown[found] = self.class_codes[positions[found]] < 0
+        self.class_codes[positions[unknown]] = codes[unknown]
+        new = ~found
+        self.hashes = np.insert(self.hashes, positions[new], hashes[new])
+        self.counts = np.insert(self.counts, positions[new], counts[new])
+        self.class_codes = np.insert(self.class_codes, positions[new], codes[new])
+
+
+def count_chunk(chunk):
+    """
+    :param chunk: a Pandas dataframe with building IDs and classes of tweets
+    :return: 1. the sorted unique hashes of the building IDs, 2. the number of tweets per building, 3. the first known
+    class of every building
+    """
+    hashes = hash_ids(chunk[BUILDING_ID_COLUMN])
+    classes = pd.Series(chunk[CLASS_COLUMN].to_numpy(), index=hashes).groupby(level=0).first()
+    counts = pd.Series(hashes).value_counts().sort_index()
+    return counts.index.to_numpy(dtype=np.uint64), counts.to_numpy(dtype=np.int64), \
+        classes.reindex(counts.index).to_numpy(dtype=object)
+
+
+def count_tweets(file_name, chunk_size, pool=None, num_processes=1):
+    """
+    First pass, counts the tweets per building
+
+    :param file_name: a tweets CSV file or Parquet file
+    :param chunk_size: number of rows per chunk
+    :param pool: an optional multiprocessing pool
+    :param num_processes: number of processes of the pool
+    :return: the BuildingCounts
+    """
+    buildings = BuildingCounts()
+    for chunk_counts in map_chunks(count_chunk, file_name, chunk_size, [BUILDING_ID_COLUMN, CLASS_COLUMN], pool,
+                                   num_processes):
+        buildings.add(*chunk_counts)
+    return buildings
+
+
+def exclude_outliers(counts, hashes, rate):
+    """
+    Excludes the given percentage of buildings with the fewest and with the most tweets, like the statistics in the
+    appendix of the paper. Buildings with the same number of tweets are ordered by the hash of their ID
+
+    :param counts: the number of tweets per building
+    :param hashes: the hashes of the building IDs
+    :param rate: the percentage excluded at each end
+    :return: the positions of the remaining buildings in ascending order
+    """
+    num_buildings = counts.shape[0]
+    num_kept = int(num_buildings * (1 - 2 * rate / 100))
+    num_low = (num_buildings - num_kept) // 2
+    order = np.lexsort((hashes, counts))
+    return np.sort(order[num_low:num_low + num_kept])
+
+
+def describe_counts(counts):
+    """
+    :param counts: the number of tweets per building as Pandas series
+    :return: a dictionary with the number of buildings and the statistics of the table in the appendix of the paper
+    """
+    return {"buildings": counts.shape[0], "min": counts.min(), "max": counts.max(), "median": counts.median(),
+            "mean": counts.mean(), "variance": counts.var(), "sd": counts.std()}
+
+
+def select_chunk(chunk):
+    """
+    Keeps the tweets of the selected buildings and at most alpha tweets per building. The tweets with the smallest
+    hash of their ID are kept, which is a random sample that does not depend on the order of the tweets
+
+    :param chunk: a Pandas dataframe with tweets
+    :return: the kept tweets with the hash of their building ID and of their ID in two additional columns
+    """
+    hashes = hash_ids(chunk[BUILDING_ID_COLUMN])
+    selected, _ = find_hashes(_worker_state["building_hashes"], hashes)
+    chunk = chunk[selected]
+    chunk = chunk.assign(**{BUILDING_HASH_COLUMN: hashes[selected],
+                            PRIORITY_COLUMN: pd.util.hash_array(chunk[TWEET_ID_COLUMN].astype(str).to_numpy(
+                                dtype=object), hash_key=f"{SEED:016d}")})
+    return cap_tweets(chunk, _worker_state["alpha"])
+
+
+def cap_tweets(tweets, alpha):
+    """
+    :param tweets: a Pandas dataframe with tweets and the hashes of their building ID and of their ID
+    :param alpha: maximum number of tweets per building
+    :return: the tweets with the alpha smallest hashes of every building ordered by building hash and hash
+    """
+    tweets = tweets.sort_values([BUILDING_HASH_COLUMN, PRIORITY_COLUMN], kind="stable")
+    return tweets[tweets.groupby(BUILDING_HASH_COLUMN, sort=False).cumcount().to_numpy() < alpha]
+
+
+def calc_partition_bounds(num_partitions):
+    """
+    :param num_partitions: number of partitions
+    :return: the smallest building hash of every partition except the first one, the partitions split the hash range
+    evenly
+    """
+    return np.arange(1, num_partitions, dtype=np.uint64) * np.uint64((2 ** 64 - 1) // num_partitions)
+
+
+def select_tweets(file_name, chunk_size, building_hashes, alpha, max_rows, num_processes=1):
+    """
+    Second pass, keeps at most alpha tweets per selected building with bounded memory. The tweets kept per chunk are
+    spilled to temporary files partitioned by the hash range of their building, so every partition holds about
+    max_rows tweets. Every partition is capped with one sort after the pass
+
+    :param file_name: a tweets CSV file or Parquet file
+    :param chunk_size: number of rows per chunk
+    :param building_hashes: the sorted hashes of the building IDs whose tweets are kept
+    :param alpha: maximum number of tweets per building
+    :param max_rows: the expected maximum number of tweets kept in all partitions, e.g., the number of tweets of the
+    selected buildings
+    :param num_processes: number of processes
+    :return: a generator of Pandas dataframes with the kept tweets of one partition each, ordered by the hash of the
+    building ID and with the hash in the column _building
+    """
+    num_partitions = max(math.ceil(max_rows / chunk_size), 1)
+    bounds = calc_partition_bounds(num_partitions)
+    init_worker(building_hashes, alpha)
+    pool = Pool(num_processes, initializer=init_worker, initargs=(building_hashes, alpha)) \
+        if num_processes > 1 else None
+    with tempfile.TemporaryDirectory(prefix="aggregate_tweets_") as spill_dir:
+        spill_files = [open(os.path.join(spill_dir, f"part{i}.pickle"), "w+b") for i in range(num_partitions)]
+        try:
+            empty = None
+            for chunk_kept in map_chunks(select_chunk, file_name, chunk_size, None, pool, num_processes):
+                if empty is None:
+                    empty = chunk_kept.iloc[:0]
+                partitions = np.searchsorted(bounds, chunk_kept[BUILDING_HASH_COLUMN].to_numpy(), side="right")
+                for partition, part in chunk_kept.groupby(partitions, sort=False):
+                    pickle.dump(part, spill_files[partition], protocol=pickle.HIGHEST_PROTOCOL)
+            if pool is not None:
+                pool.close()
+                pool.join()
+                pool = None
+            if empty is None:
+                # An input without rows has no chunks, its header still gives the columns
+                yield read_buildings_table(file_name).iloc[:0].assign(
+                    **{BUILDING_HASH_COLUMN: np.empty(0, dtype=np.uint64)})
+                return
+            for spill_file in spill_files:
+                spill_file.seek(0)
+                parts = [empty]
+                while True:
+                    try:
+                        parts.append(pickle.load(spill_file))
+                    except EOFError:
+                        break
+                yield cap_tweets(pd.concat(parts), alpha).drop(columns=PRIORITY_COLUMN)
+        finally:
+            if pool is not None:
+                pool.terminate()
+            for spill_file in spill_files:
+                spill_file.close()
+
+
+def get_prefix(file_name):
+    return os.path.basename(file_name).split(".")[0]
+
+
+def main():
+    """
+    Counts the tweets per building, writes the statistics per class and per exclusion rate, and saves at most alpha
+    tweets per remaining building. With building lists, only tweets of their buildings are kept and one file per list
+    is saved as {list prefix}_tweets in the current directory, otherwise the file is saved as
+    {tweets prefix}_alpha{alpha}
+    :return:
+    """
+    args = parse_args()
+    prefix = get_prefix(args.input_tweets)
+    suffix = ".parquet" if is_columnar(args.input_tweets) else ".csv.bz2"
+    chunk_size = estimate_chunk_size(args.input_tweets, args.memory_mb)
+    # Count the tweets per building
+    pool = Pool(args.num_processes) if args.num_processes > 1 else None
+    try:
+        buildings = count_tweets(args.input_tweets, chunk_size, pool, args.num_processes)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    logging.info(f"Found {buildings.counts.sum():,} tweets of {len(buildings):,} buildings")
+    # Statistics per exclusion rate and per class after the exclusion
+    counts = pd.Series(buildings.counts)
+    stats = pd.DataFrame([dict(rate=rate, **describe_counts(counts.iloc[exclude_outliers(buildings.counts,
+                                                                                         buildings.hashes, rate)]))
+                          for rate in args.stats_rates])
+    stats.to_csv(prefix + "_exclusion_stats.csv", index=False)
+    logging.info(f"Tweets per building by exclusion rate:\n{stats.to_string(index=False)}")
+    kept = exclude_outliers(buildings.counts, buildings.hashes, args.exclusion_rate)
+    kept_counts, kept_codes = counts.iloc[kept], buildings.class_codes[kept]
+    class_stats = pd.DataFrame([dict(**{"class": cls}, **describe_counts(kept_counts[kept_codes == code]))
+                                for code, cls in sorted(enumerate(buildings.classes), key=lambda item: item[1])
+                                if (kept_codes == code).any()] +
+                               [dict(**{"class": "All"}, **describe_counts(kept_counts))])
+    class_stats.to_csv(prefix + "_class_stats.csv", index=False)
+    logging.info(f"Tweets per building by class:\n{class_stats.to_string(index=False)}")
+    if args.alpha is not None:
+        alpha = args.alpha
+    else:
+        alpha = max(int(round(kept_counts.mean())), 1) if kept_counts.shape[0] else 1
+    logging.info(f"Keeping at most {alpha} tweets per building")
+    # Join with the building lists and cap the tweets per building
+    building_lists = {get_prefix(f) + "_tweets" + suffix: np.unique(hash_ids(read_buildings_table(f, ["building_id"])
+                                                                             ["building_id"]))
+                      for f in args.building_files}
+    selected_hashes = buildings.hashes[kept]
+    if building_lists:
+        selected_hashes = np.intersect1d(selected_hashes, np.concatenate(list(building_lists.values())))
+    else:
+        building_lists = {f"{prefix}_alpha{alpha}{suffix}": selected_hashes}
+    # Every chunk keeps at most all tweets of the selected buildings
+    max_rows = int(buildings.counts[find_hashes(buildings.hashes, selected_hashes)[1]].sum())
+    num_buildings = dict.fromkeys(building_lists, 0)
+    with ExitStack() as stack:
+        writers = {f: stack.enter_context(ChunkedTableWriter(f)) for f in building_lists}
+        for tweets in select_tweets(args.input_tweets, chunk_size, selected_hashes, alpha, max_rows,
+                                    args.num_processes):
+            for output_file, hashes in building_lists.items():
+                part = tweets[find_hashes(hashes, tweets[BUILDING_HASH_COLUMN].to_numpy())[0]]
+                writers[output_file].write(part.drop(columns=BUILDING_HASH_COLUMN))
+                num_buildings[output_file] += part[BUILDING_ID_COLUMN].nunique()
+    for output_file, writer in writers.items():
+        logging.info(f"Wrote {writer.num_rows:,} tweets of {num_buildings[output_file]:,} buildings to {output_file}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    main()
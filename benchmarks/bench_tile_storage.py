@@ -0,0 +1,133 @@
+"""
+MIT License
+
+Copyright (c) 2022 Eike Jens Hoffmann [eike.jens.hoffmann [at] tum.de]
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+import mercantile
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tile_store import DirectoryTileStore  # noqa: E402
+
+
+def parse_args():
+    """
+    Reads the command line arguments and returns them
+
+    :return: cmd args
+    """
+    parser = argparse.ArgumentParser("Compares storing raw tile bytes with decoding and re-encoding them as PNG")
+    parser.add_argument("-n", dest="num_tiles", help="Number of tiles", default=10000, type=int)
+    parser.add_argument("-d", dest="work_dir", help="Directory for the temporary tile caches", default=None)
+    parser.add_argument("-q", dest="jpeg_quality", help="JPEG quality of the synthetic tiles", default=85, type=int)
+    return parser.parse_args()
+
+
+def make_responses(num_tiles, quality, tile_size=256, num_distinct=64, seed=42):
+    """
+    Creates JPEG encoded synthetic tiles that look like aerial images, i.e., smooth structures with noise
+
+    :param num_tiles: number of responses
+    :param quality: JPEG quality
+    :param tile_size: width and height of a tile
+    :param num_distinct: number of distinct images, responses are reused round robin
+    :param seed: random seed
+    :return: a list of encoded tiles
+    """
+    rng = np.random.default_rng(seed)
+    grid = np.linspace(0, 4 * np.pi, tile_size)
+    images = []
+    for _ in range(num_distinct):
+        phase = rng.uniform(0, 2 * np.pi, 3)
+        base = np.stack([np.add.outer(np.sin(grid + p), np.cos(grid - p)) for p in phase], axis=-1)
+        img = (base + 2) * 60 + rng.normal(0, 12, base.shape)
+        data = BytesIO()
+        Image.fromarray(np.clip(img, 0, 255).astype(np.uint8), mode="RGB").save(data, format="JPEG", quality=quality)
+        images.append(data.getvalue())
+    return [images[i % num_distinct] for i in range(num_tiles)]
+
+
+def store_reencoded(store, tiles, responses):
+    # Previous behavior: decode the response and save it as PNG
+    for t, content in zip(tiles, responses):
+        data = BytesIO()
+        Image.open(BytesIO(content)).save(data, format="PNG")
+        store.put(t, data.getvalue())
+
+
+def store_raw(store, tiles, responses):
+    for t, content in zip(tiles, responses):
+        store.put(t, content)
+
+
+def run(name, func, tiles, responses, work_dir):
+    """
+    Runs one storage variant with a fresh cache directory and measures CPU time, wall time, and disk usage
+
+    :return: a dictionary with the measurements
+    """
+    tiles_dir = os.path.join(work_dir, name)
+    store = DirectoryTileStore(tiles_dir)
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    func(store, tiles, responses)
+    cpu, wall = time.process_time() - cpu_start, time.perf_counter() - wall_start
+    disk_bytes = sum(entry.stat().st_size for entry in os.scandir(tiles_dir))
+    shutil.rmtree(tiles_dir)
+    return {"cpu_s": cpu, "wall_s": wall, "disk_bytes": disk_bytes}
+
+
+def main():
+    """
+    Stores the same synthetic responses with both variants and reports the savings per 10k tiles as JSON
+    :return:
+    """
+    args = parse_args()
+    responses = make_responses(args.num_tiles, args.jpeg_quality)
+    tiles = [mercantile.Tile(137000 + i % 1000, 91000 + i // 1000, 18) for i in range(args.num_tiles)]
+    work_dir = tempfile.mkdtemp(dir=args.work_dir)
+    try:
+        results = {name: run(name, func, tiles, responses, work_dir)
+                   for name, func in [("reencoded_png", store_reencoded), ("raw_bytes", store_raw)]}
+    finally:
+        shutil.rmtree(work_dir)
+    scale = 10000 / args.num_tiles
+    old, new = results["reencoded_png"], results["raw_bytes"]
+    results["saved_per_10k_tiles"] = {"cpu_s": (old["cpu_s"] - new["cpu_s"]) * scale,
+                                      "disk_bytes": int((old["disk_bytes"] - new["disk_bytes"]) * scale)}
+    results["num_tiles"] = args.num_tiles
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    main()
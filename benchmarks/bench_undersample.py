@@ -0,0 +1,129 @@
+"""
+MIT License
+
+Copyright (c) 2022 Eike Jens Hoffmann [eike.jens.hoffmann [at] tum.de]
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from itertools import product
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from undersample import SEED, balance  # noqa: E402
+
+
+def parse_args():
+    """
+    Reads the command line arguments and returns them
+
+    :return: cmd args
+    """
+    parser = argparse.ArgumentParser("Compares the grouped balancing with the previous loop over cities and classes")
+    parser.add_argument("-n", dest="num_rows", help="Number of buildings", default=1000000, type=int)
+    parser.add_argument("-c", dest="num_cities", help="Number of cities", default=42, type=int)
+    parser.add_argument("-s", dest="seed", help="Random seed of the synthetic data", default=0, type=int)
+    return parser.parse_args()
+
+
+def make_buildings(num_rows, num_cities, seed):
+    """
+    Creates a synthetic buildings table with cities of different sizes and an imbalanced class distribution
+
+    :param num_rows: number of buildings
+    :param num_cities: number of cities
+    :param seed: random seed
+    :return: a Pandas dataframe with the columns building_id, class, and city
+    """
+    rng = np.random.default_rng(seed)
+    city_weights = rng.pareto(1.5, num_cities) + 0.1
+    cities = rng.choice([f"city{i:03d}" for i in range(num_cities)], num_rows, p=city_weights / city_weights.sum())
+    classes = rng.choice(["commercial", "other", "residential"], num_rows, p=[0.05, 0.15, 0.8])
+    return pd.DataFrame({"building_id": rng.permutation(num_rows).astype(str), "class": classes, "city": cities})
+
+
+def balance_loop(data):
+    # Previous behavior: two boolean masks and a shuffle per city and class, followed by a concatenation
+    class_count = data.groupby("class").nunique()
+    city_count = data.groupby("city").nunique()
+    num_samples_per_city = class_count["building_id"].min() // city_count.shape[0]
+    classes = class_count.index.tolist()
+    dataset = []
+    excess_list = {cls: [] for cls in classes}
+    missing_numbers = {cls: 0 for cls in classes}
+    for city, cls in product(city_count.index.tolist(), classes):
+        subset = data[data["city"] == city]
+        subset = subset[subset["class"] == cls].sample(frac=1.0, random_state=SEED)
+        dataset.append(subset[:num_samples_per_city])
+        if subset.shape[0] > num_samples_per_city:
+            excess_list[cls].append(subset[num_samples_per_city:])
+        missing_numbers[cls] += max(num_samples_per_city - subset.shape[0], 0)
+    for cls in classes:
+        dataset.append(pd.concat(excess_list[cls], axis=0).sample(n=missing_numbers[cls], random_state=SEED))
+    return pd.concat(dataset, axis=0)
+
+
+def balance_grouped(data):
+    return data.iloc[balance(data)]
+
+
+def run(func, data):
+    """
+    Runs one balancing variant and measures its wall time and the peak of the memory allocated during the run
+
+    :return: 1. the balanced dataframe, 2. a dictionary with the measurements
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(data)
+    wall = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, {"wall_s": wall, "peak_bytes": peak}
+
+
+def main():
+    """
+    Balances the same synthetic buildings with both variants, checks that the results are identical, and reports the
+    measurements as JSON
+    :return:
+    """
+    args = parse_args()
+    data = make_buildings(args.num_rows, args.num_cities, args.seed)
+    loop_result, loop_stats = run(balance_loop, data)
+    grouped_result, grouped_stats = run(balance_grouped, data)
+    results = {"loop": loop_stats, "grouped": grouped_stats,
+               "identical": bool(loop_result.index.equals(grouped_result.index)),
+               "num_rows": args.num_rows, "num_cities": args.num_cities,
+               "speedup": loop_stats["wall_s"] / grouped_stats["wall_s"]}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.WARNING)
+    main()
@@ -0,0 +1,198 @@
+"""
+MIT License
+
+Copyright (c) 2022 Eike Jens Hoffmann [eike.jens.hoffmann [at] tum.de]
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import argparse
+import logging
+import random
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bench_tile_storage import make_responses
+
+TILE_PATH = re.compile(r"^/(\d+)/(\d+)/(\d+)(\.\w+)?$")
+
+
+def parse_args():
+    """
+    Reads the command line arguments and returns them
+
+    :return: cmd args
+    """
+    parser = argparse.ArgumentParser("Serves deterministic synthetic tiles under /{z}/{x}/{y}.jpg")
+    parser.add_argument("--port", dest="port", help="Port to listen on", default=8765, type=int)
+    parser.add_argument("--latency-ms", dest="latency_ms", help="Mean response time in milliseconds", default=0.0,
+                        type=float)
+    parser.add_argument("--jitter-ms", dest="jitter_ms", help="Maximum deviation from the mean response time in "
+                                                              "milliseconds", default=0.0, type=float)
+    parser.add_argument("--error-rate", dest="error_rate", help="Share of requests answered with 503", default=0.0,
+                        type=float)
+    parser.add_argument("--throttle-rate", dest="throttle_rate", help="Share of requests answered with 429",
+                        default=0.0, type=float)
+    parser.add_argument("--missing-rate", dest="missing_rate", help="Share of tiles that always answer with 404",
+                        default=0.0, type=float)
+    parser.add_argument("-s", dest="seed", help="Random seed of the failures", default=0, type=int)
+    return parser.parse_args()
+
+
+def tile_fraction(seed, *values):
+    """
+    :return: a deterministic number in [0, 1) for a seed and a tuple of integers
+    """
+    return zlib.crc32("{}/{}".format(seed, "/".join(map(str, values))).encode()) / 2 ** 32
+
+
+class MockTileServer:
+    """
+    A local HTTP tile server for benchmarks and tests without network access. Every tile is one of a fixed set of
+    synthetic JPEG images chosen by its coordinates, so repeated runs get the same bytes. Latency, transient errors,
+    throttling, and missing tiles are simulated. Whether a request fails depends only on the tile and the number of
+    previous requests for it, hence the failures are reproducible as well
+    """
+
+    def __init__(self, port=0, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, throttle_rate=0.0, missing_rate=0.0,
+                 seed=0, num_distinct=64):
+        """
+        :param port: the port to listen on, a free port is chosen if 0
+        :param latency_ms: the mean response time in milliseconds
+        :param jitter_ms: the maximum deviation from the mean response time in milliseconds
+        :param error_rate: the share of requests answered with 503
+        :param throttle_rate: the share of requests answered with 429 and a Retry-After header
+        :param missing_rate: the share of tiles that always answer with 404
+        :param seed: the seed of the simulated failures
+        :param num_distinct: the number of distinct tile images
+        """
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.missing_rate = missing_rate
+        self.seed = seed
+        self.tiles = make_responses(num_distinct, quality=85, num_distinct=num_distinct, seed=seed)
+        self.stats = Counter()
+        self._requests = Counter()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    @property
+    def url(self):
+        """
+        :return: the URL template of the server for --tile-url
+        """
+        return "http://127.0.0.1:{}/{{z}}/{{x}}/{{y}}.jpg".format(self.port)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-tile-server", daemon=True)
+        self._thread.start()
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def respond(self, z, x, y):
+        """
+        Decides how a request for a tile is answered
+        :return: the status code and the response body
+        """
+        with self._lock:
+            attempt = self._requests[(z, x, y)]
+            self._requests[(z, x, y)] += 1
+        if tile_fraction(self.seed, z, x, y) < self.missing_rate:
+            return 404, b"Not found"
+        failure = tile_fraction(self.seed, z, x, y, attempt)
+        if failure < self.throttle_rate:
+            return 429, b"Too many requests"
+        if failure < self.throttle_rate + self.error_rate:
+            return 503, b"Service unavailable"
+        return 200, self.tiles[zlib.crc32("{}/{}/{}".format(z, x, y).encode()) % len(self.tiles)]
+
+    def _make_handler(self):
+        server = self
+
+        class TileRequestHandler(BaseHTTPRequestHandler):
+            # Keep-alive connections as used by the tile fetcher
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                delay = server.latency_ms + random.uniform(-server.jitter_ms, server.jitter_ms)
+                if delay > 0:
+                    time.sleep(delay / 1000)
+                match = TILE_PATH.match(self.path)
+                status, body = (400, b"Bad request") if match is None else \
+                    server.respond(*(int(v) for v in match.groups()[:3]))
+                with server._lock:
+                    server.stats[status] += 1
+                    server.stats["bytes"] += len(body)
+                self.send_response(status)
+                self.send_header("Content-Type", "image/jpeg" if status == 200 else "text/plain")
+                self.send_header("Content-Length", str(len(body)))
+                if status == 429:
+                    self.send_header("Retry-After", "1")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return TileRequestHandler
+
+
+def main():
+    """
+    Runs the mock tile server in the foreground until it is interrupted
+    :return:
+    """
+    args = parse_args()
+    server = MockTileServer(args.port, args.latency_ms, args.jitter_ms, args.error_rate, args.throttle_rate,
+                            args.missing_rate, args.seed)
+    logging.info("Serving synthetic tiles at {}".format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    logging.info("Answered requests: {}".format(dict(server.stats)))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    main()
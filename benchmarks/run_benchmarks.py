@@ -0,0 +1,331 @@
+"""
+MIT License
+
+Copyright (c) 2022 Eike Jens Hoffmann [eike.jens.hoffmann [at] tum.de]
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+from synthetic_buildings import generate_buildings
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+SCENARIOS = ["download_cold", "download_warm", "download_parallel", "undersample", "undersample_streaming",
+             "split_shuffle", "split_hash"]
+# Metrics compared by --compare, higher is better for all of them except the ones listed in LOWER_IS_BETTER
+COMPARED_METRICS = ["buildings_per_s", "tiles_per_s", "wall_s", "peak_rss_mb"]
+LOWER_IS_BETTER = {"wall_s", "peak_rss_mb"}
+
+
+def parse_args():
+    """
+    Reads the command line arguments and returns them
+
+    :return: cmd args
+    """
+    parser = argparse.ArgumentParser("Runs the benchmark scenarios on synthetic data and a local mock tile server and "
+                                     "writes the results as JSON")
+    parser.add_argument("-o", dest="output_file", help="JSON file of the results, only printed if not given",
+                        default=None)
+    parser.add_argument("-d", dest="work_dir", help="Directory for the synthetic data, which is reused if it exists, "
+                                                    "and the outputs", default=None)
+    parser.add_argument("--scenarios", dest="scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS,
+                        help="Scenarios to run")
+    parser.add_argument("-n", dest="num_rows", help="Number of buildings for undersampling and splitting",
+                        default=1000000, type=int)
+    parser.add_argument("--download-rows", dest="download_rows", help="Number of buildings for the download "
+                                                                      "scenarios", default=2000, type=int)
+    parser.add_argument("--latency-ms", dest="latency_ms", help="Mean response time of the mock tile server",
+                        default=20.0, type=float)
+    parser.add_argument("--error-rate", dest="error_rate", help="Share of requests answered with 503", default=0.01,
+                        type=float)
+    parser.add_argument("--missing-rate", dest="missing_rate", help="Share of tiles answered with 404",
+                        default=0.001, type=float)
+    parser.add_argument("-p", dest="num_processes", help="Number of worker processes of download_parallel",
+                        default=2, type=int)
+    parser.add_argument("-s", dest="seed", help="Random seed of the synthetic data", default=0, type=int)
+    parser.add_argument("--compare", dest="baseline_file", default=None,
+                        help="JSON results of an earlier run, e.g., of another commit, to compare with")
+    return parser.parse_args()
+
+
+def get_commit():
+    """
+    :return: the current commit of the repository and whether there are uncommitted changes, None if unknown
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_DIR,
+                               capture_output=True, text=True, check=True).stdout.strip() != ""
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return {"commit": commit, "dirty": dirty}
+
+
+def run_command(args, cwd=None):
+    """
+    Runs a script of the repository in a child process and measures its wall time and the peak resident memory of
+    the child or, if higher, of one of its own child processes
+
+    :param args: the script and its arguments
+    :param cwd: the working directory of the child process
+    :return: a dictionary with the wall time in seconds and the peak RSS in megabytes
+    """
+    # The log goes to a file, a pipe could fill up while waiting for the child
+    with tempfile.TemporaryFile("w+") as log_file:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable] + args, cwd=cwd, stdout=subprocess.DEVNULL, stderr=log_file)
+        # wait4 returns the resource usage of exactly this child
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode != 0:
+            log_file.seek(0)
+            raise RuntimeError("{} failed with exit code {}:\n{}".format(" ".join(args), process.returncode,
+                                                                         log_file.read()[-2000:]))
+    # ru_maxrss is in kilobytes on Linux
+    return {"wall_s": wall, "peak_rss_mb": usage.ru_maxrss / 1024}
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def mock_tile_server(latency_ms, error_rate, missing_rate, seed):
+    """
+    Runs the mock tile server in its own process, so it does not compete with the benchmark for the interpreter lock
+
+    :return: the URL template of the server
+    """
+    port = get_free_port()
+    process = subprocess.Popen([sys.executable, os.path.join(BENCHMARK_DIR, "mock_tile_server.py"), "--port", str(port),
+                                "--latency-ms", str(latency_ms), "--jitter-ms", str(latency_ms / 2),
+                                "--error-rate", str(error_rate), "--missing-rate", str(missing_rate),
+                                "-s", str(seed)], stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or process.poll() is not None:
+                    raise RuntimeError("The mock tile server did not start")
+                time.sleep(0.1)
+        yield "http://127.0.0.1:{}/{{z}}/{{x}}/{{y}}.jpg".format(port)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def get_data_file(work_dir, num_rows, seed, **kwargs):
+    """
+    Generates a synthetic buildings file unless it exists from an earlier run with the same parameters
+
+    :return: 1. the path of the file, 2. the number of rows
+    """
+    suffix = "".join("_{}{}".format(k, v) for k, v in sorted(kwargs.items()))
+    file_name = os.path.join(work_dir, "buildings_n{}_s{}{}.csv.bz2".format(num_rows, seed, suffix))
+    count_file = file_name + ".rows"
+    if not os.path.isfile(count_file):
+        logging.info("Generating {}".format(file_name))
+        num_written = generate_buildings(file_name, num_rows, seed=seed, **kwargs)
+        with open(count_file, "w") as out_file:
+            out_file.write(str(num_written))
+    with open(count_file) as in_file:
+        return file_name, int(in_file.read())
+
+
+def summarize_download_metrics(metrics_file, wall):
+    """
+    Extracts throughput, cache hit rates, and the stage breakdown from the last metrics snapshot of a download run
+
+    :param metrics_file: the JSON lines written with --metrics-jsonl
+    :param wall: the wall time of the run in seconds
+    :return: a dictionary of results
+    """
+    with open(metrics_file) as in_file:
+        snapshot = json.loads(in_file.readlines()[-1])
+    counters = {}
+    for entry in snapshot["counters"]:
+        key = entry["name"] + "".join(".{}".format(v) for _, v in sorted(entry["labels"].items()))
+        counters[key] = entry["value"]
+    downloaded = counters.get("tiles_total.download", 0)
+    from_store = counters.get("tiles_total.store", 0)
+    cache_hits = counters.get("tile_cache_total.hit", 0)
+    cache_misses = counters.get("tile_cache_total.miss", 0)
+    stages = {}
+    for entry in snapshot["histograms"]:
+        name = entry["labels"].get("stage", entry["name"])
+        stages[name] = {"count": entry["count"], "total_s": entry["sum"],
+                        "mean_ms": 1000 * entry["sum"] / entry["count"] if entry["count"] else 0.0}
+    return {"buildings_per_s": counters.get("buildings_total.written", 0) / wall,
+            "tiles_per_s": downloaded / wall,
+            "tile_store_hit_rate": from_store / (from_store + downloaded) if from_store + downloaded else 0.0,
+            "tile_cache_hit_rate": cache_hits / (cache_hits + cache_misses) if cache_hits + cache_misses else 0.0,
+            "downloaded_mb": counters.get("tile_download_bytes_total", 0) / 1024 ** 2,
+            "buildings": {k.split(".", 1)[1]: v for k, v in counters.items() if k.startswith("buildings_total.")},
+            "stages": stages}
+
+
+def run_download(name, input_file, work_dir, tile_url, cache_dir, num_processes=0):
+    """
+    Downloads the aerial images of the synthetic buildings into a fresh output directory
+
+    :return: a dictionary of results
+    """
+    output_dir = os.path.join(work_dir, name)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    metrics_file = os.path.join(work_dir, name + ".metrics.jsonl")
+    if os.path.exists(metrics_file):
+        os.remove(metrics_file)
+    stats = run_command([os.path.join(REPO_DIR, "download_building_aerial_images.py"), "-i", input_file,
+                         "-o", output_dir, "-c", cache_dir, "--tile-url", tile_url, "-r", "1000", "-w", "16",
+                         "--retries", "3", "-p", str(num_processes), "--metrics-jsonl", metrics_file])
+    stats.update(summarize_download_metrics(metrics_file, stats["wall_s"]))
+    return stats
+
+
+def run_table_script(script, args, num_rows, cwd):
+    """
+    Runs undersample.py or split_train_test.py on a synthetic buildings file
+
+    :return: a dictionary of results
+    """
+    stats = run_command([os.path.join(REPO_DIR, script)] + args, cwd=cwd)
+    stats["buildings_per_s"] = num_rows / stats["wall_s"]
+    return stats
+
+
+def run_scenarios(args, work_dir):
+    """
+    Runs all selected scenarios
+
+    :return: a dictionary from scenario to results
+    """
+    results = {}
+    downloads = [s for s in args.scenarios if s.startswith("download")]
+    if downloads:
+        # A compact area with a few cities, so neighboring buildings share tiles as in the real dataset
+        input_file, _ = get_data_file(work_dir, args.download_rows, args.seed, num_cities=3, spread=0.01)
+        cold_cache = os.path.join(work_dir, "tile_cache_cold")
+        with mock_tile_server(args.latency_ms, args.error_rate, args.missing_rate, args.seed) as tile_url:
+            if "download_cold" in downloads or "download_warm" in downloads:
+                shutil.rmtree(cold_cache, ignore_errors=True)
+                logging.info("Running download_cold")
+                cold = run_download("download_cold", input_file, work_dir, tile_url, cold_cache)
+                if "download_cold" in downloads:
+                    results["download_cold"] = cold
+            if "download_warm" in downloads:
+                # All tiles except the failed ones are in the cache of the cold run
+                logging.info("Running download_warm")
+                results["download_warm"] = run_download("download_warm", input_file, work_dir, tile_url, cold_cache)
+            if "download_parallel" in downloads:
+                parallel_cache = os.path.join(work_dir, "tile_cache_parallel")
+                shutil.rmtree(parallel_cache, ignore_errors=True)
+                logging.info("Running download_parallel")
+                results["download_parallel"] = run_download("download_parallel", input_file, work_dir, tile_url,
+                                                            parallel_cache, args.num_processes)
+    tables = [s for s in args.scenarios if not s.startswith("download")]
+    if tables:
+        input_file, num_rows = get_data_file(work_dir, args.num_rows, args.seed)
+        out_dir = os.path.join(work_dir, "tables")
+        os.makedirs(out_dir, exist_ok=True)
+        commands = {
+            "undersample": ("undersample.py", [input_file, os.path.join(out_dir, "balanced.csv.bz2")]),
+            "undersample_streaming": ("undersample.py", [input_file, os.path.join(out_dir, "balanced_streaming.csv.bz2"),
+                                                         "--streaming"]),
+            # split_train_test.py writes its outputs into the working directory
+            "split_shuffle": ("split_train_test.py", [input_file]),
+            "split_hash": ("split_train_test.py", ["--method", "hash", "--stratify", "city,class", input_file]),
+        }
+        for name in tables:
+            logging.info("Running {}".format(name))
+            script, script_args = commands[name]
+            results[name] = run_table_script(script, script_args, num_rows, out_dir)
+    return results
+
+
+def compare(results, baseline):
+    """
+    Reports the relative change of the main metrics of every scenario compared to an earlier run
+
+    :param results: the results of this run
+    :param baseline: the results of the earlier run
+    :return:
+    """
+    for name, stats in results["scenarios"].items():
+        old_stats = baseline["scenarios"].get(name)
+        if old_stats is None:
+            continue
+        for metric in COMPARED_METRICS:
+            if metric not in stats or not old_stats.get(metric):
+                continue
+            change = stats[metric] / old_stats[metric] - 1
+            better = change < 0 if metric in LOWER_IS_BETTER else change > 0
+            logging.info("{:<22} {:<16} {:>12.2f} -> {:>12.2f} ({:+.1%}{})".format(
+                name, metric, old_stats[metric], stats[metric], change, ", better" if better else ""))
+
+
+def main():
+    """
+    Runs the selected scenarios and reports the results together with the commit and the machine as JSON
+    :return:
+    """
+    args = parse_args()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="so2sat-bench-")
+    os.makedirs(work_dir, exist_ok=True)
+    results = {"git": get_commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+               "machine": {"platform": platform.platform(), "cpu_count": os.cpu_count()},
+               "params": {k: v for k, v in vars(args).items() if k not in ("output_file", "work_dir", "baseline_file")}}
+    try:
+        results["scenarios"] = run_scenarios(args, work_dir)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    text = json.dumps(results, indent=2)
+    if args.output_file is not None:
+        with open(args.output_file, "w") as out_file:
+            out_file.write(text + "\n")
+    print(text)
+    if args.baseline_file is not None:
+        with open(args.baseline_file) as in_file:
+            compare(results, json.load(in_file))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    main()
@@ -0,0 +1,175 @@
+"""
+MIT License
+
+Copyright (c) 2022 Eike Jens Hoffmann [eike.jens.hoffmann [at] tum.de]
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import argparse
+import bz2
+import csv
+import logging
+import math
+
+import numpy as np
+from tqdm import tqdm
+
+CLASSES = ["commercial", "other", "residential"]
+# Share of the classes among all labeled buildings, the share of every city deviates from it
+CLASS_SHARES = [0.11, 0.08, 0.81]
+# Side lengths of the building footprints in meters
+MIN_SIDE, MAX_SIDE = 6.0, 40.0
+METERS_PER_DEGREE = 111320.0
+CHUNK_SIZE = 100000
+
+
+def parse_args():
+    """
+    Reads the command line arguments and returns them
+
+    :return: cmd args
+    """
+    parser = argparse.ArgumentParser("Writes a synthetic buildings.csv.bz2 with skewed cities and classes and WKT "
+                                     "polygons")
+    parser.add_argument("output_csv_bz2", help="The synthetic buildings CSV file with Bzip2 compression")
+    parser.add_argument("-n", dest="num_rows", help="Number of buildings", default=100000, type=int)
+    parser.add_argument("-c", dest="num_cities", help="Number of cities", default=42, type=int)
+    parser.add_argument("--spread", dest="spread", help="Standard deviation of the building locations around the "
+                                                        "city center in degrees", default=0.05, type=float)
+    parser.add_argument("--duplicates", dest="duplicate_share", help="Share of buildings that are assigned to a "
+                                                                     "second city as well", default=0.005, type=float)
+    parser.add_argument("-s", dest="seed", help="Random seed", default=0, type=int)
+    return parser.parse_args()
+
+
+def make_cities(num_cities, rng):
+    """
+    Creates cities of very different sizes, each with its own class distribution
+
+    :param num_cities: number of cities
+    :param rng: the random generator
+    :return: 1. the city names, 2. the probability of each city, 3. the city centers as (lon, lat) array, 4. the class
+    probabilities of each city
+    """
+    names = np.array([f"city{i:03d}" for i in range(num_cities)])
+    weights = rng.pareto(1.5, num_cities) + 0.1
+    centers = np.column_stack([rng.uniform(-120, 140, num_cities), rng.uniform(-35, 60, num_cities)])
+    class_probs = rng.dirichlet(np.array(CLASS_SHARES) * 20, num_cities)
+    return names, weights / weights.sum(), centers, class_probs
+
+
+def make_footprints(centers, spread, rng):
+    """
+    Creates rotated rectangles as building footprints around the given centers
+
+    :param centers: the (lon, lat) array of the city center of every building
+    :param spread: the standard deviation of the building locations in degrees
+    :param rng: the random generator
+    :return: a float array of shape (n, 5, 2) with the closed rings of all footprints
+    """
+    num = len(centers)
+    location = centers + rng.normal(0, spread, (num, 2))
+    location[:, 1] = np.clip(location[:, 1], -80, 80)
+    sides = rng.uniform(MIN_SIDE, MAX_SIDE, (num, 2)) / 2
+    angle = rng.uniform(0, math.pi, num)
+    corners = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1], [-1, -1]], dtype=float)
+    # Corners in meters relative to the center, rotated, then scaled to degrees at the latitude of the building
+    x = corners[None, :, 0] * sides[:, 0:1]
+    y = corners[None, :, 1] * sides[:, 1:2]
+    cos, sin = np.cos(angle)[:, None], np.sin(angle)[:, None]
+    lon = location[:, 0:1] + (x * cos - y * sin) / (METERS_PER_DEGREE * np.cos(np.radians(location[:, 1:2])))
+    lat = location[:, 1:2] + (x * sin + y * cos) / METERS_PER_DEGREE
+    return np.stack([lon, lat], axis=-1)
+
+
+def format_polygon(ring):
+    return "POLYGON (({}))".format(", ".join("{:.7f} {:.7f}".format(x, y) for x, y in ring))
+
+
+def format_multipolygon(ring, offset):
+    second = ring + offset
+    return "MULTIPOLYGON ((({})), (({})))".format(", ".join("{:.7f} {:.7f}".format(x, y) for x, y in ring),
+                                                  ", ".join("{:.7f} {:.7f}".format(x, y) for x, y in second))
+
+
+def generate_buildings(output_file, num_rows, num_cities=42, spread=0.05, duplicate_share=0.005, seed=0):
+    """
+    Writes a synthetic buildings file in the format of buildings.csv.bz2. City sizes follow a Pareto distribution, the
+    classes are imbalanced with a different distribution in every city, and every building has a rotated rectangle as
+    footprint, one percent consist of two parts. A small share of the buildings is assigned to a second city as in
+    the real dataset. The same parameters always produce the same file
+
+    :param output_file: the output CSV file with Bzip2 compression
+    :param num_rows: number of buildings
+    :param num_cities: number of cities
+    :param spread: standard deviation of the building locations around the city center in degrees
+    :param duplicate_share: share of buildings that are repeated with another city
+    :param seed: random seed
+    :return: the number of written rows including the repeated buildings
+    """
+    rng = np.random.default_rng(seed)
+    names, city_probs, centers, class_probs = make_cities(num_cities, rng)
+    num_written = 0
+    with bz2.open(output_file, "wt", newline="") as out_file:
+        writer = csv.writer(out_file, delimiter=",", quotechar='"')
+        writer.writerow(["building_id", "class", "city", "geometry"])
+        with tqdm(total=num_rows) as progress:
+            for start in range(0, num_rows, CHUNK_SIZE):
+                size = min(CHUNK_SIZE, num_rows - start)
+                # Increasing IDs with gaps like OSM way IDs
+                ids = 10000000 + 16 * np.arange(start, start + size) + rng.integers(0, 16, size)
+                cities = rng.choice(num_cities, size, p=city_probs)
+                # Inverse transform sampling of the class with the distribution of the city of each building
+                cum_probs = np.cumsum(class_probs[cities], axis=1)
+                classes = np.minimum((rng.random(size)[:, None] > cum_probs).sum(axis=1), len(CLASSES) - 1)
+                rings = make_footprints(centers[cities], spread, rng)
+                multi = rng.random(size) < 0.01
+                duplicate = rng.random(size) < duplicate_share
+                second_cities = rng.choice(num_cities, size, p=city_probs)
+                for i in range(size):
+                    if multi[i]:
+                        geometry = format_multipolygon(rings[i], rings[i, 2] - rings[i, 0])
+                    else:
+                        geometry = format_polygon(rings[i])
+                    row = [str(ids[i]), CLASSES[classes[i]], names[cities[i]], geometry]
+                    writer.writerow(row)
+                    if duplicate[i] and second_cities[i] != cities[i]:
+                        row[2] = names[second_cities[i]]
+                        writer.writerow(row)
+                        num_written += 1
+                num_written += size
+                progress.update(size)
+    return num_written
+
+
+def main():
+    """
+    Writes the synthetic buildings file given on the command line
+    :return:
+    """
+    args = parse_args()
+    num_written = generate_buildings(args.output_csv_bz2, args.num_rows, args.num_cities, args.spread,
+                                     args.duplicate_share, args.seed)
+    logging.info("Wrote {:,} rows to {}".format(num_written, args.output_csv_bz2))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    main()
@@ -0,0 +1,301 @@
+"""
+MIT License
+
+Copyright (c) 2022 Eike Jens Hoffmann [eike.jens.hoffmann [at] tum.de]
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from patch_store import open_patch_reader
+from preprocess import read_buildings_table
+
+# Readers of the patch store in a decoding process, created on first use
+_process_readers = {}
+
+
+def parse_args():
+    """
+    Reads the command line arguments and returns them
+
+    :return: cmd args
+    """
+    parser = argparse.ArgumentParser("Iterates over the aerial images of a building list in batches and reports the "
+                                     "throughput")
+    parser.add_argument("buildings_file", help="Buildings CSV or Parquet file, e.g., written by split_train_test.py")
+    parser.add_argument("output_image_dir", help="Directory with the aerial images written by "
+                                                 "download_building_aerial_images.py")
+    parser.add_argument("-z", dest="zoom_level", default=18, type=int)
+    parser.add_argument("-s", dest="img_size", default=None, type=int,
+                        help="Image size if it is part of the directory name, i.e., aerial-{zoom}-{size}")
+    parser.add_argument("-b", dest="batch_size", default=64, type=int)
+    parser.add_argument("-w", dest="num_workers", help="Number of decoding threads or processes", default=4, type=int)
+    parser.add_argument("--processes", help="Decode in processes instead of threads", action="store_true")
+    parser.add_argument("--shuffle-buffer", dest="shuffle_buffer", default=0, type=int,
+                        help="Size of the shuffle buffer, no shuffling if 0")
+    parser.add_argument("--cache", dest="cache_file", default=None,
+                        help="Memory mapped file of the decoded images, filled in the first epoch")
+    parser.add_argument("-e", dest="num_epochs", default=1, type=int)
+    return parser.parse_args()
+
+
+def decode_batch_in_process(reader_args, samples):
+    """
+    Reads and decodes the images of a batch in a worker process, which opens its own reader once
+    :param reader_args: the arguments of open_patch_reader
+    :param samples: a list of building IDs and classes
+    :return: a contiguous uint8 array of shape (batch size, height, width, 3)
+    """
+    if reader_args not in _process_readers:
+        _process_readers[reader_args] = open_patch_reader(*reader_args)
+    return decode_batch(_process_readers[reader_args], samples)
+
+
+def decode_batch(reader, samples):
+    """
+    Reads and decodes the images of a batch
+    :param reader: the reader of the patch store, can be shared by several threads
+    :param samples: a list of building IDs and classes
+    :return: a contiguous uint8 array of shape (batch size, height, width, 3)
+    """
+    batch = None
+    for i, (building_id, building_label) in enumerate(samples):
+        img = np.asarray(Image.open(BytesIO(reader.get(building_id, building_label))).convert("RGB"))
+        if batch is None:
+            batch = np.empty((len(samples),) + img.shape, dtype=np.uint8)
+        batch[i] = img
+    return batch
+
+
+class AerialPatchDataset:
+    """
+    A framework independent iterable dataset over the aerial images of a building list. Iterating yields batches of
+    images as contiguous uint8 arrays of shape (batch size, height, width, 3) and int64 arrays with the class indices.
+    The images are read and decoded ahead in a pool of threads or processes. The samples of a shard can be shuffled
+    with a bounded buffer, and the decoded images can be cached in a memory mapped file for later epochs
+    """
+
+    def __init__(self, buildings_file, output_image_dir, zoom_level=18, img_size=None, batch_size=64, classes=None,
+                 shuffle_buffer=0, seed=42, shard_index=0, num_shards=1, num_workers=4, use_processes=False,
+                 read_ahead=4, cache_file=None, drop_last=False):
+        """
+        :param buildings_file: a buildings CSV or Parquet file, e.g., a part written by split_train_test.py
+        :param output_image_dir: the output directory of download_building_aerial_images.py
+        :param zoom_level: the zoom level of the aerial images
+        :param img_size: the size of the aerial images if it is part of the directory name
+        :param batch_size: number of images per batch
+        :param classes: the list of class names, the index of a class is its label, the sorted classes of the
+        buildings file if None
+        :param shuffle_buffer: size of the shuffle buffer, no shuffling if 0
+        :param seed: random seed of the shuffling, every epoch uses seed + epoch
+        :param shard_index: index of this shard, e.g., the rank of the worker across all nodes
+        :param num_shards: number of shards, every shard gets every num_shards-th building
+        :param num_workers: number of decoding threads or processes
+        :param use_processes: decode in processes instead of threads
+        :param read_ahead: number of batches decoded ahead
+        :param cache_file: a memory mapped file of the decoded images of this shard, created in the first complete epoch
+        :param drop_last: leave out the last batch if it is smaller than batch_size
+        """
+        buildings = read_buildings_table(buildings_file, ["building_id", "class"])
+        buildings = buildings.iloc[shard_index::num_shards]
+        self.classes = classes if classes is not None else sorted(buildings["class"].dropna().unique())
+        self.reader_args = (output_image_dir, zoom_level, img_size)
+        reader = open_patch_reader(*self.reader_args)
+        samples = list(zip(buildings["building_id"].astype(str), buildings["class"]))
+        self.samples = [sample for sample in samples if sample[1] in self.classes and reader.contains(*sample)]
+        reader.close()
+        if len(self.samples) < len(samples):
+            logging.warning("{:,} of {:,} buildings have no image or an unknown class".format(
+                len(samples) - len(self.samples), len(samples)))
+        class_index = {cls: i for i, cls in enumerate(self.classes)}
+        self.labels = np.array([class_index[label] for _, label in self.samples], dtype=np.int64)
+        self.batch_size = batch_size
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.num_workers = num_workers
+        self.use_processes = use_processes
+        self.read_ahead = read_ahead
+        self.cache_file = cache_file
+        self.drop_last = drop_last
+        self.epoch = 0
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.samples) // self.batch_size
+        return (len(self.samples) + self.batch_size - 1) // self.batch_size
+
+    def _iter_order(self, rng):
+        """
+        :return: a generator of sample positions, shuffled with a bounded buffer
+        """
+        if self.shuffle_buffer <= 0:
+            yield from range(len(self.samples))
+            return
+        buffer = []
+        for position in range(len(self.samples)):
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(position)
+                continue
+            i = rng.integers(len(buffer))
+            yield buffer[i]
+            buffer[i] = position
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def _iter_batches(self, rng, keep_last=False):
+        """
+        :param keep_last: yield the last batch even if drop_last is set, e.g., to cache its images
+        :return: a generator of arrays of sample positions
+        """
+        batch = []
+        for position in self._iter_order(rng):
+            batch.append(position)
+            if len(batch) == self.batch_size:
+                yield np.array(batch)
+                batch = []
+        if batch and (keep_last or not self.drop_last):
+            yield np.array(batch)
+
+    def _cache_digest(self):
+        """
+        :return: a digest of the image directory, zoom level, image size, and the ordered samples of the cache
+        """
+        digest = hashlib.sha256()
+        output_image_dir, zoom_level, img_size = self.reader_args
+        digest.update(json.dumps([os.path.abspath(output_image_dir), zoom_level, img_size]).encode())
+        for building_id, building_label in self.samples:
+            digest.update("{}\t{}\n".format(building_id, building_label).encode())
+        return digest.hexdigest()
+
+    def _open_cache(self):
+        """
+        :return: the memory mapped images if the cache is complete and was created for the same samples, None
+        otherwise
+        """
+        if self.cache_file is None or not os.path.isfile(self.cache_file + ".json"):
+            return None
+        with open(self.cache_file + ".json") as in_file:
+            meta = json.load(in_file)
+        if meta.get("digest") != self._cache_digest() or meta["num_samples"] != len(self.samples) or \
+                os.path.getsize(self.cache_file) != int(np.prod(meta["shape"])):
+            logging.info("Cache {} was created for other images, it is created again".format(self.cache_file))
+            return None
+        return np.memmap(self.cache_file, dtype=np.uint8, mode="r", shape=tuple(meta["shape"]))
+
+    def __iter__(self):
+        """
+        Iterates over one epoch
+        :return: a generator of images and labels per batch
+        """
+        rng = np.random.default_rng(self.seed + self.epoch)
+        self.epoch += 1
+        cache = self._open_cache()
+        if cache is not None:
+            for positions in self._iter_batches(rng):
+                yield np.ascontiguousarray(cache[positions]), self.labels[positions]
+            return
+        yield from self._iter_decoded(rng)
+
+    def _iter_decoded(self, rng):
+        if self.use_processes:
+            # Every process opens its own reader
+            executor_class, reader = ProcessPoolExecutor, None
+            decode = partial(decode_batch_in_process, self.reader_args)
+        else:
+            # All threads share one reader, so the index of tar shards is loaded once
+            reader = open_patch_reader(*self.reader_args)
+            executor_class, decode = ThreadPoolExecutor, partial(decode_batch, reader)
+        if self.cache_file is not None and os.path.isfile(self.cache_file + ".json"):
+            os.remove(self.cache_file + ".json")
+        try:
+            yield from self._iter_pool(rng, executor_class, decode)
+        finally:
+            if reader is not None:
+                reader.close()
+
+    def _iter_pool(self, rng, executor_class, decode):
+        cache, num_cached = None, 0
+        with executor_class(self.num_workers) as executor:
+            pending = deque()
+            # The cache needs every image, a dropped last batch is decoded but not yielded
+            batches = self._iter_batches(rng, keep_last=self.cache_file is not None)
+            while True:
+                # Keep the workers busy with the next batches while the current one is consumed
+                while len(pending) < self.read_ahead + self.num_workers:
+                    positions = next(batches, None)
+                    if positions is None:
+                        break
+                    pending.append((positions, executor.submit(decode, [self.samples[i] for i in positions])))
+                if not pending:
+                    break
+                positions, future = pending.popleft()
+                images = future.result()
+                if self.cache_file is not None:
+                    if cache is None:
+                        cache = np.memmap(self.cache_file, dtype=np.uint8, mode="w+",
+                                          shape=(len(self.samples),) + images.shape[1:])
+                    cache[positions] = images
+                    num_cached += len(positions)
+                    if self.drop_last and len(positions) < self.batch_size:
+                        continue
+                yield images, self.labels[positions]
+        # The cache is only used if the epoch was complete
+        if cache is not None and num_cached == len(self.samples):
+            cache.flush()
+            with open(self.cache_file + ".json", "w") as out_file:
+                json.dump({"num_samples": len(self.samples), "shape": list(cache.shape),
+                           "digest": self._cache_digest()}, out_file)
+
+
+def main():
+    """
+    Iterates over the dataset and reports the number of images per second of every epoch
+    :return:
+    """
+    args = parse_args()
+    dataset = AerialPatchDataset(args.buildings_file, args.output_image_dir, args.zoom_level, args.img_size,
+                                 args.batch_size, shuffle_buffer=args.shuffle_buffer, num_workers=args.num_workers,
+                                 use_processes=args.processes, cache_file=args.cache_file)
+    logging.info("{:,} images in {:,} batches, classes {}".format(len(dataset.samples), len(dataset),
+                                                                  dataset.classes))
+    for epoch in range(args.num_epochs):
+        start, num_images = time.perf_counter(), 0
+        for images, _ in dataset:
+            num_images += images.shape[0]
+        elapsed = time.perf_counter() - start
+        logging.info("Epoch {}: {:,} images in {:.2f} s ({:,.0f} images/s)".format(
+            epoch, num_images, elapsed, num_images / elapsed if elapsed else 0.0))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    main()
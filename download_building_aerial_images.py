@@ -25,24 +25,40 @@ SOFTWARE.
 import argparse
 import bz2
 import csv
+import heapq
 import logging
+import math
+import multiprocessing
 import os
-import random
+import queue
+import re
+import signal
+import threading
 import time
+import zlib
+from collections import Counter, deque
 from io import BytesIO
 from itertools import product
 
 import mercantile
 import numpy as np
-import requests
 from PIL import Image
-from rasterio import transform
 from shapely.wkt import loads
 from tqdm import tqdm
 
-# Base URL for Google Maps tile server
-BASE_URL = "https://mt1.google.com/vt"
+import metrics
+from manifest import FAILED, ManifestGroup, get_manifest_path, rebuild_manifest
+from patch_store import Variant, get_variants, open_variant_patch_writer
+from preprocess import Centroid, is_columnar, iter_centroids
+from tile_cache import DEFAULT_SORT_WINDOW, TileCache, sort_by_tile_order
+from tile_fetcher import DEFAULT_TILE_URL, NegativeTileCache, TileFetcher, TransientTileError
+from tile_store import open_tile_store
 
+# Zoom level of the tiles partitioning the buildings among parallel workers, neighboring buildings share their tiles
+# and end up in the same worker unless a partition border lies between them
+PARTITION_ZOOM_LEVEL = 12
+# First coordinate pair of a WKT geometry
+WKT_COORDINATE_PATTERN = re.compile(r"(-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)\s+(-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)")
 
 def parse_args():
     """
@@ -51,158 +67,712 @@ def parse_args():
     """
     parser = argparse.ArgumentParser(
         description="Script to download Google aerial images for So2Sat BuildingType dataset")
-    parser.add_argument("-c", dest="tiles_cache_dir", help="Cache directory for downloaded tiles", default="/tmp/tile_cache")
-    parser.add_argument("-i", dest="input_file", help="buildings.csv.bz2 file from So2Sat BuildingType dataset ", default="./part1/buildings.csv.bz2")
+    parser.add_argument("-c", dest="tiles_cache_dir", help="Cache directory for downloaded tiles or a single-file tile store ending with .mbtiles", default="/tmp/tile_cache")
+    parser.add_argument("-i", dest="input_file", help="buildings.csv.bz2 file from So2Sat BuildingType dataset or the preprocessed Parquet file", default="./part1/buildings.csv.bz2")
     parser.add_argument("-o", dest="output_image_dir", help="Directory ", default="./aerial-images")
-    parser.add_argument("-s", dest="img_size", default=256, type=int)
+    parser.add_argument("-s", dest="img_sizes", default=[256], type=int, nargs="+",
+                        help="Width and height of the aerial images, several sizes are created in one run")
     parser.add_argument("-v", dest="verbose", action="store_true")
-    parser.add_argument("-z", dest="zoom_level", default=18, type=int)
-    return parser.parse_args()
+    parser.add_argument("-z", dest="zoom_levels", default=[18], type=int, nargs="+",
+                        help="Zoom levels of the aerial images, lower zoom levels are downsampled from the tiles of "
+                             "the highest one")
+    parser.add_argument("-w", dest="num_workers", help="Number of concurrent tile downloads", default=8, type=int)
+    parser.add_argument("-r", dest="rate", help="Maximum number of tile requests per second of all processes together, "
+                                               "a throttling response reduces the rate of all processes", default=1.0,
+                        type=float)
+    parser.add_argument("--tile-url", dest="tile_url", help="URL template of the tile source with {x}, {y}, and {z}",
+                        default=DEFAULT_TILE_URL)
+    parser.add_argument("--tile-cache-mb", dest="tile_cache_mb", help="Memory for decoded tiles in MB", default=256,
+                        type=int)
+    parser.add_argument("--sort-tiles", dest="sort_tiles", action="store_true",
+                        help="Process the buildings in the Morton order of their tiles to reuse decoded tiles")
+    parser.add_argument("--sort-window", dest="sort_window", type=int, default=DEFAULT_SORT_WINDOW,
+                        help="Number of buildings sorted together with --sort-tiles, 0 sorts all buildings at once, "
+                             "which loads the whole input before the first download")
+    parser.add_argument("-p", dest="num_processes", type=int, default=0,
+                        help="Number of worker processes, 0 processes all buildings in the main process")
+    parser.add_argument("--ordered", dest="ordered", action="store_true",
+                        help="Write the images of parallel workers in the order of the input file")
+    parser.add_argument("-f", dest="output_format", choices=["png", "tar"], default="png",
+                        help="One PNG file per building or tar shards with a random access index")
+    parser.add_argument("--shard-size", dest="shard_size", type=int, default=10000,
+                        help="Number of buildings per tar shard")
+    parser.add_argument("-m", dest="manifest", default=None,
+                        help="Journal of finished buildings, aerial-{zoom}/manifest.tsv in the output directory if not "
+                             "given. Only for a single zoom level and size")
+    parser.add_argument("--rebuild-manifest", dest="rebuild_manifest", action="store_true",
+                        help="Reconstruct the journal from the existing output and exit")
+    parser.add_argument("--negative-cache", dest="negative_cache", default=None,
+                        help="Journal of failed tiles, negative_cache.tsv next to the tile cache if not given")
+    parser.add_argument("--retries", dest="max_retries", type=int, default=5,
+                        help="Number of retries of a tile request after throttling, server, or connection errors")
+    parser.add_argument("--metrics-jsonl", dest="metrics_jsonl", default=None,
+                        help="File to which snapshots of the run metrics are appended as JSON lines")
+    parser.add_argument("--metrics-prom", dest="metrics_prom", default=None,
+                        help="Prometheus textfile with the run metrics, replaced with every snapshot")
+    parser.add_argument("--metrics-interval", dest="metrics_interval", type=float, default=10.0,
+                        help="Seconds between two snapshots of the run metrics")
+    parser.add_argument("--profile", dest="profile", default=None,
+                        help="Write a cProfile profile of the processing to this file, FILE.worker{i} for every worker "
+                             "process")
+    args = parser.parse_args()
+    if args.manifest is not None and len(args.zoom_levels) * len(args.img_sizes) > 1:
+        parser.error("-m can only be used with a single zoom level and size")
+    return args
 
 
-def process_buildings_from_file(file_name, tiles_cache_dir, output_image_dir, zoom_level, out_img_size,
-                                make_dirs=True, has_header=True):
+def process_buildings_from_file(file_name, tiles_cache_dir, output_image_dir, variants, make_dirs=True,
+                                has_header=True, fetcher=None, lookahead=32, tile_cache=None, sort_tiles=False,
+                                sort_window=DEFAULT_SORT_WINDOW, patch_writer=None, manifest=None):
     """
     Core method that iterates over the buildings.csv.bz2 and retrieves the aerial images for each building. It works
     with a caching directory that stores all downloaded tiles to prevent downloading the same tile multiple times. If an
-    image file is already present, it will be skipped to make it fail-safe.
-    :param file_name: the input CSV file containing building_ids, labels, and geometries
-    :param tiles_cache_dir: the cache directory that stores all downloaded tiles
+    image file is already present, it will be skipped to make it fail-safe. The tiles of the next buildings are
+    downloaded in the background while the current building is processed, so the request budget is used without gaps
+    :param file_name: the input CSV file containing building_ids, labels, and geometries, or a preprocessed Parquet file
+    with precomputed centroids
+    :param tiles_cache_dir: the cache directory that stores all downloaded tiles, or a single-file tile store if it ends
+    with .mbtiles. Ignored if a fetcher is given, which brings its own tile store
     :param output_image_dir: the output directory where to place all building images
-    :param zoom_level: the zoom level of the tiles, experiments showed that 18 works best for building function
-    classification
-    :param out_img_size: width and height of the aerial building images, 256 has proven to work best
+    :param variants: a list of Variants, i.e., zoom levels and sizes of the aerial images created per building.
+    Experiments showed that zoom level 18 and size 256 work best for building function classification
     :param make_dirs: create all directories if not existing, default is yes
     :param has_header: the input CSv file has a header in the first row, which should be skipped, default is yes
+    :param fetcher: the TileFetcher used for downloading tiles, a default one is created if not given
+    :param lookahead: number of buildings whose tiles are prefetched ahead of the current one
+    :param tile_cache: the TileCache of decoded tiles, a default one is created if not given
+    :param sort_tiles: process the buildings in the Morton order of their centroid tiles instead of the file order
+    :param sort_window: number of buildings sorted together if sort_tiles is set, all buildings if None or 0
+    :param patch_writer: the writer for the resulting images, one PNG file per building in output_image_dir if not
+    given
+    :param manifest: the CompletionManifest, buildings listed in it are skipped before their geometry is parsed and
+    finished buildings are added to it
     :return:
     """
+    own_fetcher = fetcher is None
+    if own_fetcher:
+        fetcher = TileFetcher(open_tile_store(tiles_cache_dir, create=make_dirs))
+    tile_store = fetcher.tile_store
+    if tile_cache is None:
+        tile_cache = TileCache()
+    own_patch_writer = patch_writer is None
+    if own_patch_writer:
+        patch_writer = open_variant_patch_writer("png", output_image_dir, variants)
+    if manifest is not None:
+        patch_writer.on_commit = manifest.record
+    buildings = read_buildings(file_name, has_header, skip_ids=manifest)
+    if sort_tiles:
+        buildings = sort_by_tile_order(buildings, max(v.zoom_level for v in variants), sort_window)
+    try:
+        pending = deque()
+        for building in tqdm(buildings):
+            building_id, building_label, _, building_centroid = building
+            logging.debug("Processing ID {}".format(building_id))
+            # Check if aerial image for building is already present
+            if patch_writer.contains(building_id, building_label):
+                logging.debug("Found existing image for {}".format(building_id))
+                metrics.inc("buildings_total", status="skipped_existing")
+                continue
+            # Start downloading the tiles of this building and process the oldest pending building
+            fetcher.prefetch(get_canvas_tiles(building_centroid, variants)[0])
+            pending.append(building)
+            metrics.set_gauge("pending_buildings", len(pending))
+            metrics.set_gauge("tiles_in_flight", fetcher.num_in_flight())
+            if len(pending) > lookahead:
+                process_building(*pending.popleft(), tile_store, variants, fetcher, tile_cache, patch_writer,
+                                 manifest)
+        while pending:
+            process_building(*pending.popleft(), tile_store, variants, fetcher, tile_cache, patch_writer, manifest)
+        metrics.set_gauge("pending_buildings", 0)
+    finally:
+        if own_patch_writer:
+            patch_writer.close()
+        if own_fetcher:
+            fetcher.close()
+            tile_store.close()
+    logging.info("Decoded tile cache: {}".format(tile_cache.stats()))
+    log_failure_counts(fetcher.failure_counts())
+    logging.info("Done.")
+
+
+def process_buildings_in_parallel(file_name, tiles_cache_dir, output_image_dir, variants, num_processes,
+                                  has_header=True, ordered=False, tile_url=DEFAULT_TILE_URL,
+                                  num_threads=8, rate=1.0, tile_cache_mb=256, queue_size=256, patch_writer=None,
+                                  manifest=None, negative_cache_path=None, max_retries=5, metrics_interval=10.0,
+                                  profile_path=None):
+    """
+    Parallel version of process_buildings_from_file as a staged pipeline: a reader thread parses the CSV rows without
+    the geometries, a pool of worker processes does the geometry parsing, downloading, stitching, and PNG encoding, and
+    the main process writes the images. All stages are connected with bounded queues. Buildings are partitioned by
+    the tile at PARTITION_ZOOM_LEVEL containing them, so the same building always ends up in the same worker and
+    neighboring buildings do not download their shared tiles in several workers. Every worker has its own TileFetcher
+    with an equal share of the request rate, a throttling response reduces the rate of all workers. Images are written atomically, hence an interrupted run leaves no partial files
+    :param file_name: the input CSV file containing building_ids, labels, and geometries, or a preprocessed Parquet file
+    with precomputed centroids
+    :param tiles_cache_dir: the cache directory that stores all downloaded tiles, or a single-file tile store if it ends
+    with .mbtiles
+    :param output_image_dir: the output directory where to place all building images
+    :param variants: a list of Variants, i.e., zoom levels and sizes of the aerial images created per building
+    :param num_processes: number of worker processes
+    :param has_header: the input CSv file has a header in the first row, which should be skipped, default is yes
+    :param ordered: write the images in the order of the input file instead of the order of completion
+    :param tile_url: URL template of the tile source
+    :param num_threads: number of concurrent downloads per worker process
+    :param rate: maximum number of tile requests per second for all workers together
+    :param tile_cache_mb: memory for decoded tiles in MB for all workers together
+    :param queue_size: capacity of every queue between the stages
+    :param patch_writer: the writer for the resulting images, one PNG file per building in output_image_dir if not
+    given
+    :param manifest: the CompletionManifest, buildings listed in it are skipped by the reader and finished buildings
+    are added to it by the writer
+    :param negative_cache_path: the journal of failed tiles shared by all workers, kept in memory per worker if None
+    :param max_retries: number of retries of a tile request after a transient failure
+    :param metrics_interval: seconds between two snapshots of the metrics sent by every worker to the main process
+    :param profile_path: every worker writes a cProfile profile to this path with the suffix .worker{i} if given
+    :return:
+    """
+    own_patch_writer = patch_writer is None
+    if own_patch_writer:
+        patch_writer = open_variant_patch_writer("png", output_image_dir, variants)
+    if manifest is not None:
+        patch_writer.on_commit = manifest.record
+    # Open the tile store once to create it before the workers open it concurrently
+    open_tile_store(tiles_cache_dir).close()
+    # The journal of failed tiles can only be compacted while no worker appends to it
+    if negative_cache_path is not None:
+        NegativeTileCache(negative_cache_path, compact=True).close()
+    config = {"tiles_cache_dir": tiles_cache_dir, "variants": variants,
+              "tile_url": tile_url, "num_threads": num_threads, "rate": rate / num_processes,
+              "tile_cache_bytes": tile_cache_mb * 1024 ** 2 // num_processes, "lookahead": 4 * num_threads,
+              "negative_cache_path": negative_cache_path, "max_retries": max_retries,
+              "log_level": logging.getLogger().level, "metrics_interval": metrics_interval,
+              "profile_path": profile_path}
+    context = multiprocessing.get_context("spawn")
+    # The share of the rate currently used by all workers, reduced after throttling responses and recovered after
+    # successful requests, so the total request rate adapts and not only the rate of the worker that was throttled
+    config["rate_scale"] = context.Value("d", 1.0)
+    task_queues = [context.Queue(queue_size) for _ in range(num_processes)]
+    result_queue = context.Queue(queue_size)
+    stop_event = context.Event()
+    reader_errors = []
+    workers = [context.Process(target=_building_worker, args=(config, idx, task_queue, result_queue, stop_event),
+                               daemon=True) for idx, task_queue in enumerate(task_queues)]
+    for worker in workers:
+        worker.start()
+    reader = threading.Thread(target=_read_building_tasks, daemon=True,
+                              args=(file_name, has_header, patch_writer, manifest, task_queues, stop_event,
+                                    reader_errors))
+    reader.start()
+    num_done, next_seq, reorder_buffer = 0, 0, []
+    failure_counts = Counter()
+    num_written, interrupted = 0, False
+    try:
+        with tqdm() as progress:
+            while num_done < num_processes:
+                set_queue_gauges(task_queues, result_queue, reorder_buffer)
+                try:
+                    result = result_queue.get(timeout=1.0)
+                except queue.Empty:
+                    if any(not w.is_alive() and w.exitcode != 0 for w in workers):
+                        raise RuntimeError("A worker process died unexpectedly")
+                    # The reader sets the stop event when it fails, the workers then end without reporting done
+                    if stop_event.is_set() or reader_errors or all(not w.is_alive() for w in workers):
+                        break
+                    continue
+                # Every worker reports its metrics periodically and its end with the failure counts of its downloads
+                if isinstance(result, dict):
+                    metrics.registry.set_remote(result["worker"], result["metrics"])
+                    if result["done"]:
+                        failure_counts.update(result["failure_counts"])
+                        num_done += 1
+                    continue
+                if not ordered:
+                    num_written += _write_result(patch_writer, manifest, result)
+                    progress.update()
+                    continue
+                # Keep early results until all results before them are written
+                heapq.heappush(reorder_buffer, result)
+                while reorder_buffer and reorder_buffer[0][0] == next_seq:
+                    num_written += _write_result(patch_writer, manifest, heapq.heappop(reorder_buffer))
+                    next_seq += 1
+                    progress.update()
+    except KeyboardInterrupt:
+        logging.warning("Interrupted, stopping all workers")
+        interrupted = True
+    finally:
+        stop_event.set()
+        for worker in workers:
+            worker.join(timeout=5.0)
+            if worker.is_alive():
+                worker.terminate()
+        if own_patch_writer:
+            patch_writer.close()
+    if reader_errors:
+        raise reader_errors[0]
+    logging.info("Wrote {} images".format(num_written))
+    log_failure_counts(failure_counts)
+    if not interrupted:
+        logging.info("Done.")
+
+
+def _read_building_tasks(file_name, has_header, patch_writer, manifest, task_queues, stop_event, errors):
+    """
+    Reader stage of the parallel pipeline: distributes the buildings without an image to the worker queues
+    """
+    seq = 0
+    records = read_building_records(file_name, has_header, skip_ids=manifest)
+    try:
+        for building_id, building_label, building_city, geometry in records:
+            if patch_writer.contains(building_id, building_label):
+                logging.debug("Found existing image for {}".format(building_id))
+                metrics.inc("buildings_total", status="skipped_existing")
+                continue
+            task = (seq, building_id, building_label, building_city, geometry)
+            task_queue = task_queues[zlib.crc32(get_partition_key(building_id, geometry)) % len(task_queues)]
+            if not _put_until_stopped(task_queue, task, stop_event):
+                return
+            seq += 1
+    except Exception as e:
+        errors.append(e)
+        stop_event.set()
+    finally:
+        for task_queue in task_queues:
+            _put_until_stopped(task_queue, None, stop_event)
+
+
+def get_partition_key(building_id, geometry, zoom_level=PARTITION_ZOOM_LEVEL):
+    """
+    Maps a building to the coarse tile containing it without parsing its geometry, the first vertex of a footprint
+    lies close enough to its centroid
+    :param building_id: the ID of the building, used if the geometry has no coordinates
+    :param geometry: the WKT geometry or the Centroid of the building
+    :return: the partition key as bytes
+    """
+    if isinstance(geometry, Centroid):
+        lon, lat = geometry.x, geometry.y
+    else:
+        match = WKT_COORDINATE_PATTERN.search(geometry)
+        if match is None:
+            return building_id.encode()
+        lon, lat = float(match.group(1)), float(match.group(2))
+    tile = mercantile.tile(lon, lat, zoom_level)
+    return "{}/{}/{}".format(zoom_level, tile.x, tile.y).encode()
+
+
+def _put_until_stopped(target_queue, item, stop_event):
+    # A blocking put would prevent the reader from noticing that the pipeline is shut down
+    while not stop_event.is_set():
+        try:
+            target_queue.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def set_queue_gauges(task_queues, result_queue, reorder_buffer):
+    """
+    Reports the number of items in the queues between the stages of the parallel pipeline and in the reorder buffer
+    """
+    try:
+        metrics.set_gauge("queued_items", sum(q.qsize() for q in task_queues), queue="tasks")
+        metrics.set_gauge("queued_items", result_queue.qsize(), queue="results")
+    except NotImplementedError:
+        # The size of multiprocessing queues is not available on macOS
+        pass
+    metrics.set_gauge("queued_items", len(reorder_buffer), queue="reorder")
+
+
+def _building_worker(config, worker_index, task_queue, result_queue, stop_event):
+    """
+    Worker stage of the parallel pipeline: parses the geometries and creates the PNG encoded images of all variants.
+    Every task is answered with a result, the image data is None if the building failed and the error is set if it
+    failed permanently. The metrics of the worker are sent periodically as a dictionary, the last one is marked as
+    done and contains the failure counts of its downloads
+    """
+    # Interrupts are handled by the main process, which shuts the workers down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(format='%(asctime)s %(message)s', level=config["log_level"])
+    profile_path = config["profile_path"]
+    if profile_path is not None:
+        profile_path = "{}.worker{}".format(profile_path, worker_index)
+    with metrics.profiled(profile_path):
+        _run_building_worker(config, worker_index, task_queue, result_queue, stop_event)
+
+
+def _run_building_worker(config, worker_index, task_queue, result_queue, stop_event):
+    tile_store = open_tile_store(config["tiles_cache_dir"])
+    tile_cache = TileCache(config["tile_cache_bytes"])
+    negative_cache = NegativeTileCache(config["negative_cache_path"])
+    variants = config["variants"]
+    try:
+        with TileFetcher(tile_store, tile_url=config["tile_url"], num_workers=config["num_threads"],
+                         rate=config["rate"], negative_cache=negative_cache, max_retries=config["max_retries"],
+                         shared_rate_scale=config["rate_scale"]) as fetcher:
+            pending = deque()
+            last_report = time.monotonic()
+            while not stop_event.is_set():
+                if time.monotonic() - last_report >= config["metrics_interval"]:
+                    metrics.set_gauge("pending_buildings", len(pending))
+                    metrics.set_gauge("tiles_in_flight", fetcher.num_in_flight())
+                    result_queue.put({"worker": worker_index, "metrics": metrics.snapshot(), "done": False})
+                    last_report = time.monotonic()
+                try:
+                    task = task_queue.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if task is not None:
+                    seq, building_id, building_label, building_city, geometry = task
+                    try:
+                        building_centroid = geometry if isinstance(geometry, Centroid) else parse_centroid(geometry)
+                    except Exception as e:
+                        logging.warning("Could not parse geometry of building {}: {}".format(building_id, e))
+                        metrics.inc("buildings_total", status="invalid_geometry")
+                        result_queue.put((seq, building_id, building_label, building_city, None,
+                                          "invalid geometry: {}".format(e)))
+                        continue
+                    # Start downloading the tiles of this building and process the oldest pending building
+                    fetcher.prefetch(get_canvas_tiles(building_centroid, variants)[0])
+                    pending.append((seq, building_id, building_label, building_city, building_centroid))
+                while pending and (task is None or len(pending) > config["lookahead"]):
+                    seq, building_id, building_label, building_city, building_centroid = pending.popleft()
+                    data, error = None, None
+                    try:
+                        imgs = extract_views(building_centroid, tile_store, variants, fetcher=fetcher,
+                                             tile_cache=tile_cache)
+                        data = [encode_png(img) for img in imgs]
+                    except FileNotFoundError as e:
+                        logging.warning(e)
+                        metrics.inc("buildings_total", status="failed_permanent")
+                        error = str(e)
+                    except TransientTileError as e:
+                        logging.warning(e)
+                        metrics.inc("buildings_total", status="failed_transient")
+                    except Exception:
+                        logging.exception("Could not create image for building {}".format(building_id))
+                        metrics.inc("buildings_total", status="failed_error")
+                    result_queue.put((seq, building_id, building_label, building_city, data, error))
+                if task is None:
+                    break
+    finally:
+        tile_store.close()
+        negative_cache.close()
+    if not stop_event.is_set():
+        metrics.set_gauge("pending_buildings", 0)
+        metrics.set_gauge("tiles_in_flight", 0)
+        result_queue.put({"worker": worker_index, "metrics": metrics.snapshot(), "done": True,
+                          "failure_counts": fetcher.failure_counts()})
+
+
+def _write_result(patch_writer, manifest, result):
+    """
+    Writer stage of the parallel pipeline
+    :return: 1 if an image was written, 0 otherwise
+    """
+    _, building_id, building_label, building_city, data, error = result
+    if data is None:
+        if error is not None and manifest is not None:
+            manifest.record(building_id, FAILED, error)
+        return 0
+    return int(write_images(patch_writer, building_id, building_label, building_city, data))
+
+
+def read_rows(file_name, has_header=True):
+    """
+    Iterates over the raw rows of a CSV file
+    :param file_name: the input CSV file containing building_ids, labels, and geometries
+    :param has_header: the input CSv file has a header in the first row, which should be skipped, default is yes
+    :return: a generator of the columns of each row
+    """
     # Different operators to work with raw and compressed CSV files
     open_func, params = (bz2.open, ["rt"]) if file_name.endswith("bz2") else (open, [])
     with open_func(file_name, *params) as in_file:
         # Iterate over file
         reader = csv.reader(in_file, delimiter=",", quotechar='"')
-        for idx, cols in tqdm(enumerate(reader)):
+        for idx, cols in enumerate(reader):
             # Skip the header if present
             if has_header and idx == 0:
                 continue
-            # Assuming the column order from buildings.csv.bz2
-            building_id, building_label, building_geometry = cols[0], cols[1], loads(cols[-1])
-            building_centroid = building_geometry.centroid
-            logging.debug("Processing ID {}".format(building_id))
-            # Check if aerial image for building is already present
-            out_img_path = os.path.join(output_image_dir, f"aerial-{zoom_level}", building_label, f"{building_id}.png")
-            if os.path.isfile(out_img_path):
-                logging.debug("Found existing file at {}".format(out_img_path))
-                continue
-            # Make sure that all directories are present and create them if necessary
-            path = os.path.dirname(out_img_path)
-            if make_dirs:
-                if not os.path.exists(path):
-                    os.makedirs(path)
-                if not os.path.exists(tiles_cache_dir):
-                    os.makedirs(tiles_cache_dir)
-            # Make two attempts to create the image: one with the directly adjacent tiles and a second one with the
-            # second rank neighbor tiles (if necessary)
-            try:
-                img = extract_view(building_centroid, tiles_cache_dir, zoom_level, out_img_size)
-            except ValueError:
-                try:
-                    img = extract_view(building_centroid, tiles_cache_dir, zoom_level, out_img_size, surrounding=2)
-                except ValueError:
-                    logging.warning("Could not extract building {} in second try, giving up".format(building_id))
-                    continue
-            except FileNotFoundError as e:
-                logging.warning(e)
-                continue
-            # Convert the numpy array to an Pillow object and save it
-            img = Image.fromarray(img, mode="RGB")
-            img.save(out_img_path)
-            logging.debug("Wrote file to {}".format(out_img_path))
-    logging.info("Done.")
+            yield cols
+
+
+def read_building_records(file_name, has_header=True, skip_ids=None):
+    """
+    Iterates over the buildings of a CSV file or a preprocessed Parquet file without parsing the geometries
+    :param file_name: the input CSV file containing building_ids, labels, and geometries, or a preprocessed Parquet file
+    :param has_header: the input CSv file has a header in the first row, which should be skipped, default is yes
+    :param skip_ids: a container of building IDs which are left out, e.g., a CompletionManifest
+    :return: a generator of building_id, label, city, and the WKT geometry (CSV) or the Centroid (Parquet)
+    """
+    if is_columnar(file_name):
+        records = iter_centroids(file_name)
+    else:
+        # Assuming the column order from buildings.csv.bz2
+        records = ((cols[0], cols[1], cols[2], cols[-1]) for cols in read_rows(file_name, has_header))
+    for record in metrics.timed_iter(records, "stage_seconds", stage="read"):
+        if skip_ids is not None and record[0] in skip_ids:
+            metrics.inc("buildings_total", status="skipped_manifest")
+            continue
+        yield record
+
+
+def read_buildings(file_name, has_header=True, skip_ids=None):
+    """
+    Iterates over the buildings of a CSV file or a preprocessed Parquet file. Skipped buildings are left out before
+    their geometry is parsed
+    :param file_name: the input CSV file containing building_ids, labels, and geometries, or a preprocessed Parquet file
+    :param has_header: the input CSv file has a header in the first row, which should be skipped, default is yes
+    :param skip_ids: a container of building IDs which are left out, e.g., a CompletionManifest
+    :return: a generator of building_id, label, city, and centroid for each building
+    """
+    records = read_building_records(file_name, has_header, skip_ids)
+    for building_id, building_label, building_city, geometry in records:
+        if not isinstance(geometry, Centroid):
+            geometry = parse_centroid(geometry)
+        yield building_id, building_label, building_city, geometry
+
+
+def parse_centroid(geometry):
+    """
+    :param geometry: the WKT string of a building geometry
+    :return: the centroid of the geometry
+    """
+    with metrics.timer("stage_seconds", stage="parse"):
+        return loads(geometry).centroid
+
+
+def log_failure_counts(failure_counts):
+    """
+    Reports the number of failed tile downloads per status code and the number of retries at the end of a run
+    :param failure_counts: a dictionary from status to count
+    :return:
+    """
+    if not failure_counts:
+        return
+    logging.info("Failed tile requests: {}".format(", ".join(
+        "{}: {}".format(status, count) for status, count in sorted(failure_counts.items(), key=lambda i: str(i[0])))))
+
+
+def get_negative_cache_path(tiles_cache_dir):
+    """
+    :param tiles_cache_dir: the cache directory or the single-file tile store
+    :return: the default path of the negative cache journal next to the tile cache
+    """
+    if tiles_cache_dir.endswith(".mbtiles"):
+        return tiles_cache_dir[:-len(".mbtiles")] + ".negative_cache.tsv"
+    return os.path.join(tiles_cache_dir, "negative_cache.tsv")
+
+
+def encode_png(img):
+    """
+    :param img: an RGB image as numpy array
+    :return: the PNG encoded image
+    """
+    with metrics.timer("stage_seconds", stage="encode"):
+        data = BytesIO()
+        Image.fromarray(img, mode="RGB").save(data, format="PNG")
+        return data.getvalue()
 
 
-def extract_view(building_centroid, tiles_dir, zoom_level, out_img_size, in_tile_size=256, surrounding=1):
+def write_images(patch_writer, building_id, building_label, building_city, data):
+    """
+    Writes the PNG encoded images of all variants of a building and counts the result
+    :param patch_writer: the VariantPatchWriter for the resulting images
+    :param building_id: the ID of the building
+    :param building_label: the class of the building
+    :param building_city: the city of the building
+    :param data: a list with the PNG encoded image of every variant
+    :return: True if an image was written, False otherwise
     """
-    Creates an aerial image for a location specified with a center point. The method raises a ValueError if the expected
-    area is not covered by the surrounding tiles. Can be caught to do redo the operation with a higher surrounding
+    with metrics.timer("stage_seconds", stage="write"):
+        written = patch_writer.write(building_id, building_label, building_city, data)
+    metrics.inc("buildings_total", status="written" if written else "skipped_existing")
+    return written
+
+
+def process_building(building_id, building_label, building_city, building_centroid, tile_store, variants, fetcher,
+                     tile_cache, patch_writer, manifest=None):
+    """
+    Creates and saves the aerial images of all variants of a single building
+    :param building_id: the ID of the building
+    :param building_label: the class of the building
+    :param building_city: the city of the building
     :param building_centroid: the location at which the resulting aerial image is centered on
-    :param tiles_dir: the cache directory of tiles
+    :param tile_store: the tile store that keeps all downloaded tiles
+    :param variants: a list of Variants, i.e., zoom levels and sizes of the aerial images
+    :param fetcher: the TileFetcher used for downloading tiles
+    :param tile_cache: the TileCache of decoded tiles
+    :param patch_writer: the VariantPatchWriter for the resulting images
+    :param manifest: the CompletionManifest in which permanent failures are recorded
+    :return: True if an image was written, False otherwise
+    """
+    try:
+        imgs = extract_views(building_centroid, tile_store, variants, fetcher=fetcher, tile_cache=tile_cache)
+    except FileNotFoundError as e:
+        logging.warning(e)
+        metrics.inc("buildings_total", status="failed_permanent")
+        if manifest is not None:
+            manifest.record(building_id, FAILED, e)
+        return False
+    except TransientTileError as e:
+        # Not recorded as failure, the building is tried again in the next run
+        logging.warning(e)
+        metrics.inc("buildings_total", status="failed_transient")
+        return False
+    # Encode the numpy arrays as PNG and save them
+    return write_images(patch_writer, building_id, building_label, building_city, [encode_png(img) for img in imgs])
+
+
+def extract_view(building_centroid, tile_store, zoom_level, out_img_size, in_tile_size=256, fetcher=None,
+                 tile_cache=None):
+    """
+    Creates an aerial image for a location specified with a center point. The crop window is calculated in pixel space
+    first, so only the tiles intersecting it are downloaded and stitched
+    :param building_centroid: the location at which the resulting aerial image is centered on
+    :param tile_store: the tile store that caches the tiles
     :param zoom_level: the zoom level for which the aerial image is created
     :param out_img_size: width and height of the resulting aerial image as _ONE_ parameter for quadratically images
     :param in_tile_size: the size of the input tiles, usually 256 for normal tile services (default), but can be 512 for
      HD tiles
-    :param surrounding: the number of adjacent tiles to be taken into account recursively, e.g., 1 are all tiles which
-    are directly next to the center tile, 2 are all tiles next to all 1 tiles, and so on
+    :param fetcher: the TileFetcher used for downloading missing tiles
+    :param tile_cache: the TileCache used for loading decoded tiles, tiles are read from disk if not given
     :return: a numpy image representing the aerial image focused on point
     """
-    # Calculate the tile containing the building centroid
-    tile = mercantile.tile(building_centroid.x, building_centroid.y, zoom_level)
-    # Calculate the adjacent tiles including the center tile
-    tiles = [mercantile.Tile(tile.x + x, tile.y + y, zoom_level) for x, y in
-             product(range(-surrounding, surrounding + 1), repeat=2)]
+    return extract_views(building_centroid, tile_store, [Variant(zoom_level, out_img_size, None)], in_tile_size,
+                         fetcher, tile_cache)[0]
+
+
+def extract_views(building_centroid, tile_store, variants, in_tile_size=256, fetcher=None, tile_cache=None):
+    """
+    Creates the aerial images of several variants for a location. The tiles of the highest zoom level are stitched
+    once to a canvas covering the crop windows of all variants, images of lower zoom levels are downsampled from it
+    :param building_centroid: the location at which the resulting aerial images are centered on
+    :param tile_store: the tile store that caches the tiles
+    :param variants: a list of Variants, i.e., zoom levels and sizes of the aerial images
+    :param in_tile_size: the size of the input tiles
+    :param fetcher: the TileFetcher used for downloading missing tiles
+    :param tile_cache: the TileCache used for loading decoded tiles, tiles are read from disk if not given
+    :return: a list with the numpy image of every variant
+    """
+    tiles, windows = get_canvas_tiles(building_centroid, variants, in_tile_size)
     # Download all calculated tiles
-    download_tiles(tiles, tiles_dir)
+    with metrics.timer("stage_seconds", stage="download"):
+        download_tiles(tiles, tile_store, fetcher)
     # Create a big patch from all tiles
-    img = stich_tiles(tiles, tiles_dir, in_tile_size)
-    # Calculate the geo reference for the big patch
-    transformation = calc_transform(tiles, img)
-    # Calculate the pixel position of the centroid in the big patch
-    xs, ys = transform.rowcol(transformation, building_centroid.x, building_centroid.y)
-    # Calculate the mask for cutting
-    x_start = xs - out_img_size // 2
-    y_start = ys - out_img_size // 2
-    x_end = xs + out_img_size // 2
-    y_end = ys + out_img_size // 2
-    # For stability issues: making sure not to get index errors if one pixel is out of stiched image
-    # (happens in rare cases)
-    if x_start < 0 or y_start < 0 or x_end >= img.shape[0] or y_end >= img.shape[1]:
-        raise ValueError("Stiched image was not big enough")
-    # Cut the final building patch
-    img = img[x_start:x_end, y_start:y_end, :]
-    return img
-
-
-def download_tiles(tiles, out_dir):
+    with metrics.timer("stage_seconds", stage="stitch"):
+        img = stich_tiles(tiles, tile_store, in_tile_size, tile_cache)
+    x_offset = min(t.x for t in tiles) * in_tile_size
+    y_offset = min(t.y for t in tiles) * in_tile_size
+    views = []
+    with metrics.timer("stage_seconds", stage="crop"):
+        for x_start, y_start, window_size, factor in windows:
+            # Shift the crop window from global pixel coordinates to the coordinates of the stitched patch
+            x_start -= x_offset
+            y_start -= y_offset
+            # Cut the final building patch
+            view = img[y_start:y_start + window_size, x_start:x_start + window_size, :]
+            views.append(downsample(view, factor) if factor > 1 else view)
+    return views
+
+
+def get_canvas_tiles(building_centroid, variants, in_tile_size=256):
     """
-    Download a list of tiles
-    :param tiles: a list of tiles
-    :param out_dir: the output directory
-    :return:
+    Calculates the crop windows of several variants in pixel coordinates of the highest zoom level and the minimal set
+    of tiles of this zoom level covering them. A window of a lower zoom level covers exactly the pixels of its crop
+    window at that zoom level
+    :param building_centroid: the location at which the aerial images are centered on
+    :param variants: a list of Variants, i.e., zoom levels and sizes of the aerial images
+    :param in_tile_size: the size of the input tiles
+    :return: 1. a list of tiles intersecting the crop windows, 2. a list with the global pixel coordinates (x, y) of
+    the upper left corner, the width and height, and the downsampling factor of the crop window of every variant
     """
-    for t in tiles:
-        file_path = get_file_path(out_dir, t)
-        if os.path.isfile(file_path):
-            continue
-        download_tile(t, file_path)
+    max_zoom_level = max(v.zoom_level for v in variants)
+    windows = []
+    for variant in variants:
+        _, (x_start, y_start) = get_covering_tiles(building_centroid, variant.zoom_level, variant.img_size,
+                                                   in_tile_size)
+        factor = 1 << (max_zoom_level - variant.zoom_level)
+        windows.append((x_start * factor, y_start * factor, variant.img_size * factor, factor))
+    x_start, y_start = min(w[0] for w in windows), min(w[1] for w in windows)
+    x_end, y_end = max(w[0] + w[2] for w in windows), max(w[1] + w[2] for w in windows)
+    # Every tile from the one containing the first pixel to the one containing the last pixel of all windows
+    tiles_x = range(x_start // in_tile_size, (x_end - 1) // in_tile_size + 1)
+    tiles_y = range(y_start // in_tile_size, (y_end - 1) // in_tile_size + 1)
+    tiles = [mercantile.Tile(tx, ty, max_zoom_level) for ty, tx in product(tiles_y, tiles_x)]
+    return tiles, windows
+
+
+def downsample(img, factor):
+    """
+    Reduces the resolution of an image by averaging blocks of pixels, which matches the pixels of a lower zoom level
+    :param img: an RGB image as numpy array, width and height are multiples of the factor
+    :param factor: width and height of the averaged blocks
+    :return: the downsampled image
+    """
+    height, width = img.shape[0] // factor, img.shape[1] // factor
+    blocks = img.reshape(height, factor, width, factor, 3).sum(axis=(1, 3), dtype=np.uint32)
+    return ((blocks + factor * factor // 2) // (factor * factor)).astype(np.uint8)
+
+
+def get_covering_tiles(building_centroid, zoom_level, out_img_size, in_tile_size=256):
+    """
+    Calculates the crop window of an aerial image centered on a location and the minimal set of tiles covering it
+    :param building_centroid: the location at which the aerial image is centered on
+    :param zoom_level: the zoom level of the tiles
+    :param out_img_size: width and height of the aerial image
+    :param in_tile_size: the size of the input tiles
+    :return: 1. a list of tiles intersecting the crop window, 2. the global pixel coordinates (x, y) of the upper left
+    corner of the crop window
+    """
+    # Calculate the pixel containing the centroid on the whole map at the given zoom level
+    x, y = calc_global_pixel(building_centroid.x, building_centroid.y, zoom_level, in_tile_size)
+    x_start = int(math.floor(x)) - out_img_size // 2
+    y_start = int(math.floor(y)) - out_img_size // 2
+    # Every tile from the one containing the first pixel to the one containing the last pixel of the window
+    tiles_x = range(x_start // in_tile_size, (x_start + out_img_size - 1) // in_tile_size + 1)
+    tiles_y = range(y_start // in_tile_size, (y_start + out_img_size - 1) // in_tile_size + 1)
+    tiles = [mercantile.Tile(tx, ty, zoom_level) for ty, tx in product(tiles_y, tiles_x)]
+    return tiles, (x_start, y_start)
+
+
+def calc_global_pixel(lng, lat, zoom_level, tile_size=256):
+    """
+    Calculates the position of a WGS84 coordinate in pixels on the Web Mercator map of a zoom level
+    :param lng: longitude in degrees
+    :param lat: latitude in degrees
+    :param zoom_level: the zoom level of the map
+    :param tile_size: the size of a tile in pixels
+    :return: the pixel coordinates (x, y) as floats, counted from the upper left corner of the map
+    """
+    map_size = tile_size * (1 << zoom_level)
+    sin_lat = math.sin(math.radians(lat))
+    x = (lng + 180.0) / 360.0 * map_size
+    y = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * map_size
+    return x, y
 
 
-def download_tile(tile, file_path, mean_sleep_time=1.0, std_sleep_time=0.5):
+def download_tiles(tiles, tile_store, fetcher=None):
     """
-    Download one tile and save it to a given path. A kind downloader does not send as many requests as possible to the
-    server but instead waits a moment between two requests. The waiting time is drawn from a Gaussian distribution based
-    on the given parameters. Raises a FileNotFoundError when the tile is not available
-    :param tile: the tile to be downloaded
-    :param file_path: file path of the download
-    :param mean_sleep_time: mean of waiting time
-    :param std_sleep_time: standard deviation of waiting time
+    Download a list of tiles
+    :param tiles: a list of tiles
+    :param tile_store: the tile store receiving the tiles
+    :param fetcher: the TileFetcher used for downloading, a temporary one is used if not given
     :return:
     """
-    params = {"lyrs": "s", "x": tile.x, "y": tile.y, "z": tile.z}
-    response = requests.get(BASE_URL, params=params)
-    if response.status_code == 200:
-        img = Image.open(BytesIO(response.content))
-        img.save(file_path)
-        time.sleep(abs(random.gauss(mean_sleep_time, std_sleep_time)))
-    else:
-        raise FileNotFoundError("No image for tile {}, got code {}".format(tile, response.status_code))
+    if fetcher is not None:
+        fetcher.fetch(tiles)
+        return
+    with TileFetcher(tile_store) as tmp_fetcher:
+        tmp_fetcher.fetch(tiles)
 
 
-def stich_tiles(tiles, tiles_dir, tile_size):
+def stich_tiles(tiles, tile_store, tile_size, tile_cache=None):
     """
     Loads a list of neighboring tiles and puts them together to a big image patch
     :param tiles: a list of tiles covering an area
-    :param tiles_dir: the directory containing the tiles
+    :param tile_store: the tile store containing the tiles
     :param tile_size: size of a single tile
+    :param tile_cache: the TileCache used for loading decoded tiles, tiles are read from disk if not given
     :return: a big image patch from all tiles
     """
     # Calculate the offsets
@@ -215,11 +785,12 @@ def stich_tiles(tiles, tiles_dir, tile_size):
     # Fill the canvas
     for t in tiles:
         # Load the tile
-        tile_file_path = get_file_path(tiles_dir, t)
-        img = Image.open(tile_file_path)
-        img = np.array(img)
+        if tile_cache is not None:
+            img = tile_cache.get(t, tile_store)
+        else:
+            img = np.array(Image.open(BytesIO(tile_store.get(t))).convert("RGB"))
         if img is None:
-            logging.warning("Tile {} not available".format(tile_file_path))
+            logging.warning("Tile {} not available".format(t))
             continue
         # Calculate the where to put the tile in canvas
         x_start = (t.x - x_offset) * tile_size
@@ -232,34 +803,6 @@ def stich_tiles(tiles, tiles_dir, tile_size):
     return img_template
 
 
-def calc_transform(tiles, img):
-    """
-    Calculates the transformation matrix from pixel coordinates to WGS84 geo-coordinates
-    :param tiles: a list of tiles covering an area
-    :param img: the image patch from all tiles
-    :return: a transformation matrix
-    """
-    bounds = [mercantile.bounds(t) for t in tiles]
-    west = min([b.west for b in bounds])
-    south = min([b.south for b in bounds])
-    east = max([b.east for b in bounds])
-    north = max([b.north for b in bounds])
-    out_transform = transform.from_bounds(west, south, east, north, img.shape[0], img.shape[1])
-    return out_transform
-
-
-def get_file_path(base_dir, tile):
-    """
-    A simple method to unify the way tile objects are mapped to file paths. Does not check if file exists!
-    :param base_dir: the directory containing all tiles, i.e., the caching directory
-    :param tile: a tile object
-    :return: the file path where the file should be stored
-    """
-    file_name = "{}-{}-{}.png".format(tile.x, tile.y, tile.z)
-    file_path = os.path.join(base_dir, file_name)
-    return file_path
-
-
 def main():
     """
     Get the command line arguments, set up the logging, and start the download process
@@ -270,8 +813,63 @@ def main():
     level = logging.DEBUG if args.verbose else logging.INFO
     logging.basicConfig(format='%(asctime)s %(message)s', level=level)
 
-    process_buildings_from_file(args.input_file, args.tiles_cache_dir, args.output_image_dir, args.zoom_level,
-                                args.img_size)
+    variants = get_variants(args.zoom_levels, args.img_sizes)
+    patch_writer = open_variant_patch_writer(args.output_format, args.output_image_dir, variants, args.shard_size)
+    manifest_paths = [args.manifest] if args.manifest else \
+        [get_manifest_path(args.output_image_dir, v.zoom_level, v.dir_size) for v in variants]
+    if args.rebuild_manifest:
+        for manifest_path, writer in zip(manifest_paths, patch_writer.writers):
+            num_ids = rebuild_manifest(manifest_path, writer.iter_building_ids())
+            logging.info("Rebuilt manifest {} with {:,} buildings".format(manifest_path, num_ids))
+        patch_writer.close()
+        return
+    manifest = ManifestGroup(manifest_paths)
+    negative_cache_path = args.negative_cache or get_negative_cache_path(args.tiles_cache_dir)
+    exporter = metrics.MetricsExporter(jsonl_path=args.metrics_jsonl, prom_path=args.metrics_prom,
+                                       interval=args.metrics_interval)
+    exporter.start()
+    try:
+        with metrics.profiled(args.profile):
+            run(args, variants, patch_writer, manifest, negative_cache_path)
+    finally:
+        patch_writer.close()
+        manifest.close()
+        metrics.log_summary(exporter.close())
+
+
+def run(args, variants, patch_writer, manifest, negative_cache_path):
+    """
+    Processes the buildings in the main process or in worker processes according to the command line arguments
+    :param args: the parsed command line arguments
+    :param variants: a list of Variants, i.e., zoom levels and sizes of the aerial images
+    :param patch_writer: the VariantPatchWriter for the resulting images
+    :param manifest: the ManifestGroup of finished buildings
+    :param negative_cache_path: the journal of failed tiles
+    :return:
+    """
+    if args.num_processes > 0:
+        process_buildings_in_parallel(args.input_file, args.tiles_cache_dir, args.output_image_dir, variants,
+                                      args.num_processes, ordered=args.ordered,
+                                      tile_url=args.tile_url, num_threads=args.num_workers, rate=args.rate,
+                                      tile_cache_mb=args.tile_cache_mb, patch_writer=patch_writer,
+                                      manifest=manifest, negative_cache_path=negative_cache_path,
+                                      max_retries=args.max_retries, metrics_interval=args.metrics_interval,
+                                      profile_path=args.profile)
+        return
+    tile_cache = TileCache(args.tile_cache_mb * 1024 ** 2)
+    tile_store = open_tile_store(args.tiles_cache_dir)
+    negative_cache = NegativeTileCache(negative_cache_path, compact=True)
+    try:
+        with TileFetcher(tile_store, tile_url=args.tile_url, num_workers=args.num_workers, rate=args.rate,
+                         negative_cache=negative_cache, max_retries=args.max_retries) as fetcher:
+            process_buildings_from_file(args.input_file, args.tiles_cache_dir, args.output_image_dir, variants,
+                                        fetcher=fetcher,
+                                        lookahead=4 * args.num_workers, tile_cache=tile_cache,
+                                        sort_tiles=args.sort_tiles, sort_window=args.sort_window,
+                                        patch_writer=patch_writer, manifest=manifest)
+    finally:
+        tile_store.close()
+        negative_cache.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,189 @@
+"""
+MIT License
+
+Copyright (c) 2022 Eike Jens Hoffmann [eike.jens.hoffmann [at] tum.de]
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import logging
+import os
+
+import numpy as np
+
+from patch_store import get_variant_dir_name
+
+# Status values of the journal entries
+DONE = "done"
+FAILED = "failed"
+
+
+class BuildingIdSet:
+    """
+    A compact set of building IDs. Numeric IDs loaded at start are kept in a sorted int64 array, which needs 8 bytes
+    per ID instead of a Python object, IDs added later and non-numeric IDs are kept in a regular set
+    """
+
+    def __init__(self, ids=()):
+        """
+        :param ids: an iterable of building IDs as strings
+        """
+        numeric, other = [], set()
+        for building_id in ids:
+            if building_id.isdigit():
+                numeric.append(int(building_id))
+            else:
+                other.add(building_id)
+        self._sorted = np.unique(np.array(numeric, dtype=np.int64))
+        self._other = other
+
+    def __len__(self):
+        return len(self._sorted) + len(self._other)
+
+    def __contains__(self, building_id):
+        if building_id in self._other:
+            return True
+        if not building_id.isdigit() or len(self._sorted) == 0:
+            return False
+        value = int(building_id)
+        pos = np.searchsorted(self._sorted, value)
+        return bool(pos < len(self._sorted) and self._sorted[pos] == value)
+
+    def add(self, building_id):
+        self._other.add(building_id)
+
+
+class CompletionManifest:
+    """
+    An append-only journal of finished buildings. Every line contains the building ID, the status (done or failed),
+    and an optional reason. The IDs of the journal are loaded into a BuildingIdSet at start, so finished buildings can
+    be skipped before their geometry is parsed
+    """
+
+    def __init__(self, file_path):
+        """
+        :param file_path: the path of the journal, created if not existing
+        """
+        self.file_path = file_path
+        self.num_done, self.num_failed = 0, 0
+        self._ids = BuildingIdSet(self._read_ids())
+        directory = os.path.dirname(file_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._file = open(file_path, "a")
+        logging.info("Manifest {} lists {:,} finished buildings ({:,} failed)".format(
+            file_path, self.num_done + self.num_failed, self.num_failed))
+
+    def _read_ids(self):
+        if not os.path.isfile(self.file_path):
+            return
+        with open(self.file_path) as in_file:
+            for line in in_file:
+                # An interrupted write can leave an incomplete last line, which is ignored
+                if not line.endswith("\n"):
+                    continue
+                cols = line.rstrip("\n").split("\t")
+                if len(cols) < 2:
+                    continue
+                if cols[1] == FAILED:
+                    self.num_failed += 1
+                else:
+                    self.num_done += 1
+                yield cols[0]
+
+    def __contains__(self, building_id):
+        return building_id in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def record(self, building_id, status=DONE, reason=""):
+        """
+        Appends a building to the journal
+        :param building_id: the ID of the building
+        :param status: done if the image was written, failed if the building can never be processed
+        :param reason: optional reason of a failure
+        :return:
+        """
+        self._file.write("{}\t{}\t{}\n".format(building_id, status, " ".join(str(reason).split())))
+        self._file.flush()
+        self._ids.add(building_id)
+
+    def close(self):
+        self._file.close()
+
+
+class ManifestGroup:
+    """
+    The journals of several variants of the aerial images. A building counts as finished if it is finished in all
+    journals, e.g., a variant added later is created for all buildings
+    """
+
+    def __init__(self, file_paths):
+        """
+        :param file_paths: the paths of the journals, created if not existing
+        """
+        self.manifests = [CompletionManifest(file_path) for file_path in file_paths]
+
+    def __contains__(self, building_id):
+        return all(building_id in manifest for manifest in self.manifests)
+
+    def record(self, building_id, status=DONE, reason=""):
+        """
+        Appends a building to all journals not listing it yet
+        :param building_id: the ID of the building
+        :param status: done if the images were written, failed if the building can never be processed
+        :param reason: optional reason of a failure
+        :return:
+        """
+        for manifest in self.manifests:
+            if building_id not in manifest:
+                manifest.record(building_id, status, reason)
+
+    def close(self):
+        for manifest in self.manifests:
+            manifest.close()
+
+
+def rebuild_manifest(file_path, building_ids):
+    """
+    Replaces a journal with the given building IDs, e.g., all buildings found in an existing output tree. Failed
+    buildings of the old journal are dropped and will be tried again
+    :param file_path: the path of the journal
+    :param building_ids: an iterable of the IDs of all finished buildings
+    :return: the number of buildings in the new journal
+    """
+    tmp_path = file_path + ".tmp"
+    num_ids = 0
+    with open(tmp_path, "w") as out_file:
+        for building_id in building_ids:
+            out_file.write("{}\t{}\t\n".format(building_id, DONE))
+            num_ids += 1
+    os.replace(tmp_path, file_path)
+    return num_ids
+
+
+def get_manifest_path(output_image_dir, zoom_level, img_size=None):
+    """
+    :param output_image_dir: the output directory where to place all building images
+    :param zoom_level: the zoom level of the aerial images
+    :param img_size: the size of the aerial images if it is part of the directory name
+    :return: the default path of the journal next to the images of a zoom level
+    """
+    return os.path.join(output_image_dir, get_variant_dir_name(zoom_level, img_size), "manifest.tsv")
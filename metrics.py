@@ -0,0 +1,404 @@
+"""
+MIT License
+
+Copyright (c) 2022 Eike Jens Hoffmann [eike.jens.hoffmann [at] tum.de]
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import bisect
+import cProfile
+import io
+import json
+import logging
+import math
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the histogram buckets in seconds, doubling from 10 microseconds to about 80 seconds
+BUCKETS = tuple(1e-5 * 2 ** k for k in range(24))
+PROMETHEUS_PREFIX = "so2sat_"
+
+
+class Histogram:
+    """
+    A histogram with fixed logarithmic buckets. The buckets are the same in every process, so histograms of parallel
+    workers are merged by adding their counts
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        :param q: the quantile between 0 and 1
+        :return: the upper bound of the bucket containing the quantile, i.e., an estimate that is at most twice as high
+        """
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(BUCKETS + (math.inf,), self.counts):
+            total += count
+            if total >= rank and total > 0:
+                return bound
+        return 0.0
+
+    def to_dict(self):
+        return {"counts": list(self.counts), "count": self.count, "sum": self.sum}
+
+    @classmethod
+    def from_dict(cls, values):
+        histogram = cls()
+        histogram.counts = list(values["counts"])
+        histogram.count = values["count"]
+        histogram.sum = values["sum"]
+        return histogram
+
+
+class Timer:
+    """
+    A context manager that adds its duration to a histogram
+    """
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.registry.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+class Metrics:
+    """
+    A thread-safe registry of counters, gauges, and histograms. Every metric is identified by its name and its labels.
+    Snapshots are plain dictionaries, which can be sent between processes, merged, and written as JSON. The latest
+    snapshots of other processes can be attached, so the snapshot of the main process covers all workers
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._remote = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increases a counter
+        :param name: the name of the counter
+        :param value: the increment
+        :param labels: the labels of the counter, e.g., status="written"
+        :return:
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        """
+        Sets a gauge to the current value, e.g., the length of a queue
+        :param name: the name of the gauge
+        :param value: the current value
+        :param labels: the labels of the gauge
+        :return:
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        """
+        Adds a value to a histogram
+        :param name: the name of the histogram
+        :param value: the observed value, usually a duration in seconds
+        :param labels: the labels of the histogram, e.g., stage="encode"
+        :return:
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def timer(self, name, **labels):
+        """
+        :param name: the name of the histogram
+        :param labels: the labels of the histogram
+        :return: a context manager that adds the duration of its block to the histogram
+        """
+        return Timer(self, name, labels)
+
+    def timed_iter(self, iterable, name, **labels):
+        """
+        Iterates over an iterable and adds the time spent to produce each item to a histogram, e.g., for reading
+        :param iterable: the iterable, usually a generator
+        :param name: the name of the histogram
+        :param labels: the labels of the histogram
+        :return: a generator of the items of the iterable
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.observe(name, time.perf_counter() - start, **labels)
+            yield item
+
+    def set_remote(self, source, snapshot):
+        """
+        Attaches the latest snapshot of another process, replacing the previous one of the same source
+        :param source: an identifier of the process, e.g., the index of a worker
+        :param snapshot: the snapshot of the metrics of the process
+        :return:
+        """
+        with self._lock:
+            self._remote[source] = snapshot
+
+    def snapshot(self):
+        """
+        :return: the current values of all metrics including the attached snapshots as a JSON serializable dictionary
+        """
+        with self._lock:
+            local = {
+                "time": time.time(),
+                "counters": [{"name": name, "labels": dict(labels), "value": value}
+                             for (name, labels), value in self._counters.items()],
+                "gauges": [{"name": name, "labels": dict(labels), "value": value}
+                           for (name, labels), value in self._gauges.items()],
+                "histograms": [dict(name=name, labels=dict(labels), **histogram.to_dict())
+                               for (name, labels), histogram in self._histograms.items()]}
+            remote = list(self._remote.values())
+        if not remote:
+            return local
+        return merge_snapshots([local] + remote)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+            self._remote.clear()
+
+
+def merge_snapshots(snapshots):
+    """
+    Adds up the snapshots of several processes. Gauges are added as well, e.g., the downloads in flight of all workers
+    :param snapshots: an iterable of snapshots
+    :return: the merged snapshot
+    """
+    counters, gauges, histograms = {}, {}, {}
+    latest = 0.0
+    for snapshot in snapshots:
+        latest = max(latest, snapshot["time"])
+        for target, entries in ((counters, snapshot["counters"]), (gauges, snapshot["gauges"])):
+            for entry in entries:
+                key = (entry["name"], tuple(sorted(entry["labels"].items())))
+                target[key] = target.get(key, 0) + entry["value"]
+        for entry in snapshot["histograms"]:
+            key = (entry["name"], tuple(sorted(entry["labels"].items())))
+            histogram = histograms.get(key)
+            if histogram is None:
+                histograms[key] = Histogram.from_dict(entry)
+                continue
+            histogram.counts = [a + b for a, b in zip(histogram.counts, entry["counts"])]
+            histogram.count += entry["count"]
+            histogram.sum += entry["sum"]
+    return {
+        "time": latest,
+        "counters": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in counters.items()],
+        "gauges": [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in gauges.items()],
+        "histograms": [dict(name=name, labels=dict(labels), **histogram.to_dict())
+                       for (name, labels), histogram in histograms.items()]}
+
+
+def _format_labels(labels, **extra):
+    items = sorted(labels.items()) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in items) + "}"
+
+
+def format_prometheus(snapshot, prefix=PROMETHEUS_PREFIX):
+    """
+    Formats a snapshot in the Prometheus text exposition format, e.g., for the textfile collector of the node exporter
+    :param snapshot: the snapshot of the metrics
+    :param prefix: the prefix of all metric names
+    :return: the text of all metrics
+    """
+    lines = []
+    for kind, entries in (("counter", snapshot["counters"]), ("gauge", snapshot["gauges"])):
+        for name in sorted(set(e["name"] for e in entries)):
+            lines.append("# TYPE {}{} {}".format(prefix, name, kind))
+            for entry in entries:
+                if entry["name"] == name:
+                    lines.append("{}{}{} {}".format(prefix, name, _format_labels(entry["labels"]), entry["value"]))
+    entries = snapshot["histograms"]
+    for name in sorted(set(e["name"] for e in entries)):
+        lines.append("# TYPE {}{} histogram".format(prefix, name))
+        for entry in entries:
+            if entry["name"] != name:
+                continue
+            total = 0
+            for bound, count in zip(BUCKETS + (math.inf,), entry["counts"]):
+                total += count
+                le = "+Inf" if bound == math.inf else "{:g}".format(bound)
+                lines.append("{}{}_bucket{} {}".format(prefix, name, _format_labels(entry["labels"], le=le), total))
+            lines.append("{}{}_sum{} {}".format(prefix, name, _format_labels(entry["labels"]), entry["sum"]))
+            lines.append("{}{}_count{} {}".format(prefix, name, _format_labels(entry["labels"]), entry["count"]))
+    return "\n".join(lines) + "\n"
+
+
+def log_summary(snapshot):
+    """
+    Reports the number, mean, and approximate median and 95th percentile of every histogram and all counters at the
+    end of a run
+    :param snapshot: the snapshot of the metrics
+    :return:
+    """
+    for entry in sorted(snapshot["histograms"], key=lambda e: (e["name"], sorted(e["labels"].items()))):
+        histogram = Histogram.from_dict(entry)
+        if histogram.count == 0:
+            continue
+        logging.info("{}{}: n={:,} mean={:.2f}ms p50<={:.2f}ms p95<={:.2f}ms total={:.1f}s".format(
+            entry["name"], _format_labels(entry["labels"]), histogram.count, 1000 * histogram.sum / histogram.count,
+            1000 * histogram.quantile(0.5), 1000 * histogram.quantile(0.95), histogram.sum))
+    for entry in sorted(snapshot["counters"], key=lambda e: (e["name"], sorted(e["labels"].items()))):
+        logging.info("{}{}: {:,}".format(entry["name"], _format_labels(entry["labels"]), entry["value"]))
+
+
+class MetricsExporter:
+    """
+    Writes snapshots of the metrics periodically in a background thread, appended as JSON lines and as a Prometheus
+    textfile that is replaced atomically. A last snapshot is written when the exporter is closed
+    """
+
+    def __init__(self, collect=None, jsonl_path=None, prom_path=None, interval=10.0):
+        """
+        :param collect: a function returning the current snapshot, the snapshot of the global registry if not given
+        :param jsonl_path: the file to which every snapshot is appended as one JSON line, not written if None
+        :param prom_path: the Prometheus textfile, not written if None
+        :param interval: the time between two snapshots in seconds
+        """
+        self.collect = collect if collect is not None else registry.snapshot
+        self.jsonl_path = jsonl_path
+        self.prom_path = prom_path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start(self):
+        if self.jsonl_path is None and self.prom_path is None:
+            return
+        self._thread = threading.Thread(target=self._run, name="metrics-exporter", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.export()
+            except Exception:
+                logging.exception("Could not export metrics")
+
+    def export(self):
+        """
+        Writes the current snapshot to all configured files
+        :return: the snapshot
+        """
+        snapshot = self.collect()
+        if self.jsonl_path is not None:
+            with open(self.jsonl_path, "a") as out_file:
+                out_file.write(json.dumps(snapshot) + "\n")
+        if self.prom_path is not None:
+            tmp_path = self.prom_path + ".tmp"
+            with open(tmp_path, "w") as out_file:
+                out_file.write(format_prometheus(snapshot))
+            os.replace(tmp_path, self.prom_path)
+        return snapshot
+
+    def close(self):
+        """
+        Stops the background thread and writes the final snapshot
+        :return: the final snapshot
+        """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        if self.jsonl_path is None and self.prom_path is None:
+            return self.collect()
+        return self.export()
+
+
+@contextmanager
+def profiled(profile_path, num_functions=20):
+    """
+    Profiles the enclosed block with cProfile if a path is given, dumps the statistics to the path, which can be
+    opened with pstats or snakeviz, and reports the functions with the highest cumulative time
+    :param profile_path: the output file of the profile, nothing is profiled if None
+    :param num_functions: the number of functions in the report
+    :return:
+    """
+    if profile_path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(num_functions)
+        logging.info("Wrote profile {}\n{}".format(profile_path, report.getvalue()))
+
+
+# The registry of the current process, every worker process has its own one
+registry = Metrics()
+inc = registry.inc
+set_gauge = registry.set_gauge
+observe = registry.observe
+timer = registry.timer
+timed_iter = registry.timed_iter
+snapshot = registry.snapshot
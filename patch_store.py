@@ -0,0 +1,560 @@
+"""
+MIT License
+
+Copyright (c) 2022 Eike Jens Hoffmann [eike.jens.hoffmann [at] tum.de]
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import csv
+import io
+import json
+import logging
+import os
+import re
+import tarfile
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from streaming import ValueEncoder
+
+# Columns of the sidecar index of tar shards
+INDEX_COLUMNS = ["building_id", "class", "city", "shard", "offset", "size"]
+
+# File names of tar shards, e.g., shard-000042.tar
+SHARD_FILE_PATTERN = re.compile(r"^shard-(\d+)\.tar$")
+
+# One kind of aerial image created per building. The size is part of the directory name only if several sizes are
+# created, i.e., dir_size is None otherwise
+Variant = namedtuple("Variant", ["zoom_level", "img_size", "dir_size"])
+
+
+class DirectoryPatchWriter:
+    """
+    Writes one PNG file per building to aerial-{zoom}/{label}/{building_id}.png. This is the original output layout
+    """
+
+    def __init__(self, output_image_dir, zoom_level, img_size=None):
+        """
+        :param output_image_dir: the output directory where to place all building images
+        :param zoom_level: the zoom level of the aerial images
+        :param img_size: the size of the aerial images if it is part of the directory name, i.e., aerial-{zoom}-{size}
+        """
+        self.output_image_dir = output_image_dir
+        self.zoom_level = zoom_level
+        self.img_size = img_size
+        # Called with the building ID as soon as an image is durably written
+        self.on_commit = None
+
+    def get_path(self, building_id, building_label):
+        """
+        :param building_id: the ID of the building
+        :param building_label: the class of the building
+        :return: the file path of the aerial image
+        """
+        return get_output_path(self.output_image_dir, self.zoom_level, building_label, building_id, self.img_size)
+
+    def contains(self, building_id, building_label):
+        """
+        :param building_id: the ID of the building
+        :param building_label: the class of the building
+        :return: True if the image of the building was written already
+        """
+        return os.path.isfile(self.get_path(building_id, building_label))
+
+    def write(self, building_id, building_label, building_city, data):
+        """
+        Writes the image of a building. Does nothing if it already exists
+        :param building_id: the ID of the building
+        :param building_label: the class of the building
+        :param building_city: the city of the building, not used by this layout
+        :param data: the PNG encoded image
+        :return: True if the image was written
+        """
+        out_img_path = self.get_path(building_id, building_label)
+        if os.path.isfile(out_img_path):
+            return False
+        write_file_atomically(out_img_path, data)
+        logging.debug("Wrote file to {}".format(out_img_path))
+        if self.on_commit is not None:
+            self.on_commit(building_id)
+        return True
+
+    def iter_building_ids(self):
+        """
+        :return: a generator of the IDs of all buildings with an image in the output tree
+        """
+        zoom_dir = os.path.join(self.output_image_dir, get_variant_dir_name(self.zoom_level, self.img_size))
+        if not os.path.isdir(zoom_dir):
+            return
+        with os.scandir(zoom_dir) as label_dirs:
+            for label_dir in label_dirs:
+                if not label_dir.is_dir():
+                    continue
+                with os.scandir(label_dir.path) as entries:
+                    for entry in entries:
+                        if entry.name.endswith(".png"):
+                            yield entry.name[:-len(".png")]
+
+    def close(self):
+        pass
+
+
+class TarShardPatchWriter:
+    """
+    Packs the images into tar shards with a fixed number of samples following the WebDataset convention: every sample
+    consists of {building_id}.png and {building_id}.json with class and city. The sidecar index.csv maps every
+    building_id to its shard and the byte offset of the PNG data, so single samples can be read without scanning a
+    shard. A shard is written to a temporary file and added to the index only when it is complete, hence an
+    interrupted run loses at most the samples of the open shard
+    """
+
+    def __init__(self, output_image_dir, zoom_level, shard_size=10000, img_size=None):
+        """
+        :param output_image_dir: the output directory, shards are placed in its aerial-{zoom} subdirectory
+        :param zoom_level: the zoom level of the aerial images
+        :param shard_size: number of samples per shard
+        :param img_size: the size of the aerial images if it is part of the directory name, i.e., aerial-{zoom}-{size}
+        """
+        self.shard_dir = os.path.join(output_image_dir, get_variant_dir_name(zoom_level, img_size))
+        self.index_path = os.path.join(self.shard_dir, "index.csv")
+        self.shard_size = shard_size
+        os.makedirs(self.shard_dir, exist_ok=True)
+        # Remove shards of interrupted runs which never made it into the index
+        for name in os.listdir(self.shard_dir):
+            if name.endswith(".tar.tmp"):
+                os.remove(os.path.join(self.shard_dir, name))
+        self._done = SortedIdSet(np.sort(read_index_ids(self.index_path)))
+        shard_ids = [int(m.group(1)) for m in map(SHARD_FILE_PATTERN.match, os.listdir(self.shard_dir)) if m]
+        self._next_shard = max(shard_ids) + 1 if shard_ids else 0
+        self._tar = None
+        self._shard_name = None
+        self._rows = []
+        self._keys = set()
+        # Called with the building ID as soon as an image is durably written, i.e., its shard is complete
+        self.on_commit = None
+
+    def contains(self, building_id, building_label=None):
+        """
+        :param building_id: the ID of the building
+        :param building_label: not needed for this layout
+        :return: True if the image of the building was written already
+        """
+        return building_id in self._done or building_id in self._keys
+
+    def write(self, building_id, building_label, building_city, data):
+        """
+        Appends the image of a building to the open shard and starts a new shard if it is full. Does nothing if the
+        building was written already
+        :param building_id: the ID of the building
+        :param building_label: the class of the building
+        :param building_city: the city of the building
+        :param data: the PNG encoded image
+        :return: True if the image was written
+        """
+        if self.contains(building_id):
+            return False
+        if self._tar is None:
+            self._open_shard()
+        meta = json.dumps({"building_id": building_id, "class": building_label, "city": building_city}).encode()
+        offset = self._add_member(f"{building_id}.png", data)
+        self._add_member(f"{building_id}.json", meta)
+        self._rows.append([building_id, building_label, building_city, self._shard_name, offset, len(data)])
+        self._keys.add(building_id)
+        if len(self._rows) >= self.shard_size:
+            self._close_shard()
+        return True
+
+    def _add_member(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        # The data follows directly after the header of the member
+        offset = self._tar.offset + len(info.tobuf(self._tar.format, self._tar.encoding, self._tar.errors))
+        self._tar.addfile(info, io.BytesIO(data))
+        return offset
+
+    def _open_shard(self):
+        self._shard_name = "shard-{:06d}.tar".format(self._next_shard)
+        self._next_shard += 1
+        self._tar = tarfile.open(os.path.join(self.shard_dir, self._shard_name + ".tmp"), "w",
+                                 format=tarfile.USTAR_FORMAT)
+
+    def _close_shard(self):
+        self._tar.close()
+        shard_path = os.path.join(self.shard_dir, self._shard_name)
+        os.replace(shard_path + ".tmp", shard_path)
+        # The index is only extended after the shard is in place
+        new_index = not os.path.isfile(self.index_path)
+        with open(self.index_path, "a", newline="") as index_file:
+            writer = csv.writer(index_file)
+            if new_index:
+                writer.writerow(INDEX_COLUMNS)
+            writer.writerows(self._rows)
+        self._done.update(self._keys)
+        if self.on_commit is not None:
+            for row in self._rows:
+                self.on_commit(row[0])
+        logging.debug("Wrote shard {} with {} samples".format(shard_path, len(self._rows)))
+        self._tar, self._shard_name, self._rows, self._keys = None, None, [], set()
+
+    def iter_building_ids(self):
+        """
+        :return: a generator of the IDs of all buildings in complete shards
+        """
+        for chunk in read_index_columns(self.index_path, ["building_id"]):
+            yield from chunk["building_id"]
+
+    def close(self):
+        """
+        Completes the open shard
+        :return:
+        """
+        if self._tar is not None:
+            self._close_shard()
+
+
+class TarShardReader:
+    """
+    Random access to the samples of tar shards through their sidecar index
+    """
+
+    def __init__(self, shard_dir):
+        """
+        :param shard_dir: the directory with the shards and index.csv, i.e., aerial-{zoom}
+        """
+        self.shard_dir = shard_dir
+        # Column arrays sorted by building ID instead of one dictionary per row, which would need several GB for all
+        # buildings
+        ids, shard_codes, offsets, sizes = [], [], [], []
+        shard_encoder = ValueEncoder()
+        index_path = os.path.join(shard_dir, "index.csv")
+        for chunk in read_index_columns(index_path, ["building_id", "shard", "offset", "size"]):
+            ids.append(encode_ids(chunk["building_id"]))
+            shard_codes.append(shard_encoder.encode(chunk["shard"]))
+            offsets.append(chunk["offset"].to_numpy(dtype=np.int64))
+            sizes.append(chunk["size"].to_numpy(dtype=np.int64))
+        ids = np.concatenate(ids) if ids else encode_ids([])
+        order = np.argsort(ids, kind="stable")
+        self._ids = SortedIdSet(ids[order])
+        self._shards = shard_encoder.values
+        self._shard_codes = np.concatenate(shard_codes)[order] if shard_codes else np.empty(0, dtype=np.int32)
+        self._offsets = np.concatenate(offsets)[order] if offsets else np.empty(0, dtype=np.int64)
+        self._sizes = np.concatenate(sizes)[order] if sizes else np.empty(0, dtype=np.int64)
+        self._files = {}
+        # Seek and read of an open shard must not be interleaved by several threads
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, building_id):
+        return building_id in self._ids
+
+    def get(self, building_id, building_label=None):
+        """
+        Reads the PNG encoded image of a building with one seek. Raises a KeyError if the building is unknown
+        :param building_id: the ID of the building
+        :param building_label: not needed for this layout
+        :return: the PNG encoded image
+        """
+        position = self._ids.position(building_id)
+        if position < 0:
+            raise KeyError(building_id)
+        shard = self._shards[self._shard_codes[position]]
+        with self._lock:
+            shard_file = self._files.get(shard)
+            if shard_file is None:
+                shard_file = open(os.path.join(self.shard_dir, shard), "rb")
+                self._files[shard] = shard_file
+            shard_file.seek(int(self._offsets[position]))
+            return shard_file.read(int(self._sizes[position]))
+
+    def contains(self, building_id, building_label=None):
+        return building_id in self._ids
+
+    def close(self):
+        with self._lock:
+            for shard_file in self._files.values():
+                shard_file.close()
+            self._files = {}
+
+
+class DirectoryPatchReader:
+    """
+    Reads the PNG files of the aerial-{zoom}/{label}/{building_id}.png layout
+    """
+
+    def __init__(self, output_image_dir, zoom_level, img_size=None):
+        """
+        :param output_image_dir: the output directory of the images
+        :param zoom_level: the zoom level of the aerial images
+        :param img_size: the size of the aerial images if it is part of the directory name
+        """
+        self.output_image_dir = output_image_dir
+        self.zoom_level = zoom_level
+        self.img_size = img_size
+
+    def contains(self, building_id, building_label):
+        return os.path.isfile(get_output_path(self.output_image_dir, self.zoom_level, building_label, building_id,
+                                              self.img_size))
+
+    def get(self, building_id, building_label):
+        """
+        Raises a FileNotFoundError if the building has no image
+        :param building_id: the ID of the building
+        :param building_label: the class of the building
+        :return: the PNG encoded image
+        """
+        with open(get_output_path(self.output_image_dir, self.zoom_level, building_label, building_id,
+                                  self.img_size), "rb") as in_file:
+            return in_file.read()
+
+    def close(self):
+        pass
+
+
+class VariantPatchWriter:
+    """
+    Writes several variants of the aerial image of every building with one patch writer per variant. A building is
+    committed when the images of all its variants are committed
+    """
+
+    def __init__(self, writers):
+        """
+        :param writers: one patch writer per variant
+        """
+        self.writers = writers
+        # Called with the building ID as soon as the images of all variants are durably written
+        self.on_commit = None
+        # Number of variants of a building whose images are written but not committed yet
+        self._pending = {}
+        for writer in writers:
+            writer.on_commit = self._commit_variant
+
+    def _commit_variant(self, building_id):
+        remaining = self._pending.pop(building_id, 1) - 1
+        if remaining > 0:
+            self._pending[building_id] = remaining
+        elif self.on_commit is not None:
+            self.on_commit(building_id)
+
+    def contains(self, building_id, building_label):
+        """
+        :param building_id: the ID of the building
+        :param building_label: the class of the building
+        :return: True if the images of all variants of the building were written already
+        """
+        return all(writer.contains(building_id, building_label) for writer in self.writers)
+
+    def write(self, building_id, building_label, building_city, data):
+        """
+        Writes the images of the variants which were not written already
+        :param building_id: the ID of the building
+        :param building_label: the class of the building
+        :param building_city: the city of the building
+        :param data: a list with the PNG encoded image of every variant
+        :return: True if an image was written
+        """
+        missing = [(writer, img) for writer, img in zip(self.writers, data)
+                   if not writer.contains(building_id, building_label)]
+        if not missing:
+            return False
+        self._pending[building_id] = len(missing)
+        for writer, img in missing:
+            writer.write(building_id, building_label, building_city, img)
+        return True
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+def open_patch_reader(output_image_dir, zoom_level, img_size=None):
+    """
+    Opens the images of a zoom level in the layout in which they were written
+    :param output_image_dir: the output directory of the images
+    :param zoom_level: the zoom level of the aerial images
+    :param img_size: the size of the aerial images if it is part of the directory name
+    :return: a TarShardReader if the directory contains tar shards, a DirectoryPatchReader otherwise
+    """
+    shard_dir = os.path.join(output_image_dir, get_variant_dir_name(zoom_level, img_size))
+    if os.path.isfile(os.path.join(shard_dir, "index.csv")):
+        return TarShardReader(shard_dir)
+    return DirectoryPatchReader(output_image_dir, zoom_level, img_size)
+
+
+def open_patch_writer(output_format, output_image_dir, zoom_level, shard_size=10000, img_size=None):
+    """
+    Creates the patch writer for an output format
+    :param output_format: png for one file per building or tar for shards
+    :param output_image_dir: the output directory where to place all building images
+    :param zoom_level: the zoom level of the aerial images
+    :param shard_size: number of samples per shard
+    :param img_size: the size of the aerial images if it is part of the directory name, i.e., aerial-{zoom}-{size}
+    :return: a patch writer
+    """
+    if output_format == "tar":
+        return TarShardPatchWriter(output_image_dir, zoom_level, shard_size, img_size)
+    if output_format == "png":
+        return DirectoryPatchWriter(output_image_dir, zoom_level, img_size)
+    raise ValueError("Unknown output format {}".format(output_format))
+
+
+def open_variant_patch_writer(output_format, output_image_dir, variants, shard_size=10000):
+    """
+    Creates a patch writer for several variants of the aerial images
+    :param output_format: png for one file per building or tar for shards
+    :param output_image_dir: the output directory where to place all building images
+    :param variants: a list of Variants
+    :param shard_size: number of samples per shard
+    :return: a VariantPatchWriter
+    """
+    return VariantPatchWriter([open_patch_writer(output_format, output_image_dir, v.zoom_level, shard_size,
+                                                 v.dir_size) for v in variants])
+
+
+def get_variants(zoom_levels, img_sizes):
+    """
+    :param zoom_levels: a list of zoom levels
+    :param img_sizes: a list of image sizes
+    :return: a list of Variants with all combinations of zoom levels and sizes
+    """
+    return [Variant(zoom_level, img_size, img_size if len(img_sizes) > 1 else None)
+            for zoom_level in zoom_levels for img_size in img_sizes]
+
+
+def get_variant_dir_name(zoom_level, img_size=None):
+    """
+    :param zoom_level: the zoom level of the aerial images
+    :param img_size: the size of the aerial images if it is part of the directory name
+    :return: aerial-{zoom} or aerial-{zoom}-{size}
+    """
+    return f"aerial-{zoom_level}" if img_size is None else f"aerial-{zoom_level}-{img_size}"
+
+
+class SortedIdSet:
+    """
+    A compact set of building IDs stored as a sorted array of byte strings, which needs about one byte per character
+    of an ID instead of about 100 bytes per ID in a Python set
+    """
+
+    def __init__(self, ids=None):
+        """
+        :param ids: a sorted array of UTF-8 encoded IDs as returned by encode_ids
+        """
+        self._ids = ids if ids is not None else encode_ids([])
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, building_id):
+        return self.position(building_id) >= 0
+
+    def position(self, building_id):
+        """
+        :param building_id: the ID of a building
+        :return: the position of the ID in the sorted array, -1 if the ID is not in the set
+        """
+        key = building_id.encode()
+        position = int(np.searchsorted(self._ids, key))
+        return position if position < len(self._ids) and self._ids[position] == key else -1
+
+    def update(self, building_ids):
+        """
+        Adds IDs to the set, which copies the array once
+        :param building_ids: an iterable of IDs
+        :return:
+        """
+        new_ids = np.sort(encode_ids(building_ids))
+        ids = self._ids.astype(np.result_type(self._ids, new_ids))
+        self._ids = np.insert(ids, np.searchsorted(ids, new_ids), new_ids)
+
+
+def encode_ids(building_ids):
+    """
+    :param building_ids: an iterable or a Series of string IDs
+    :return: an array of the UTF-8 encoded IDs with fixed width
+    """
+    if not isinstance(building_ids, pd.Series):
+        building_ids = pd.Series(list(building_ids), dtype=str)
+    return building_ids.str.encode("utf-8").to_numpy(dtype=bytes)
+
+
+def read_index_columns(index_path, columns, chunk_size=1_000_000):
+    """
+    Reads columns of a sidecar index chunk by chunk, so the rows never exist as Python objects all at once
+    :param index_path: path of a sidecar index
+    :param columns: the names of the columns to read
+    :param chunk_size: number of rows per chunk
+    :return: a generator of DataFrames with the columns, nothing if the index does not exist
+    """
+    if not os.path.isfile(index_path):
+        return
+    yield from pd.read_csv(index_path, usecols=columns, dtype={"building_id": str, "shard": str},
+                           keep_default_na=False, chunksize=chunk_size)
+
+
+def read_index_ids(index_path):
+    """
+    :param index_path: path of a sidecar index
+    :return: an array of the UTF-8 encoded building IDs in the index as returned by encode_ids
+    """
+    ids = [encode_ids(chunk["building_id"]) for chunk in read_index_columns(index_path, ["building_id"])]
+    return np.concatenate(ids) if ids else encode_ids([])
+
+
+def get_output_path(output_image_dir, zoom_level, building_label, building_id, img_size=None):
+    """
+    Maps a building to the file path of its aerial image
+    :param output_image_dir: the output directory where to place all building images
+    :param zoom_level: the zoom level of the aerial image
+    :param building_label: the class of the building
+    :param building_id: the ID of the building
+    :param img_size: the size of the aerial image if it is part of the directory name
+    :return: the file path of the aerial image
+    """
+    return os.path.join(output_image_dir, get_variant_dir_name(zoom_level, img_size), building_label,
+                        f"{building_id}.png")
+
+
+def write_file_atomically(file_path, data):
+    """
+    Writes data to a temporary file next to the target and renames it afterwards, so an interrupted write never leaves
+    a partial file at the target path
+    :param file_path: the target path, missing directories are created
+    :param data: the bytes to be written
+    :return:
+    """
+    path = os.path.dirname(file_path)
+    if path and not os.path.exists(path):
+        os.makedirs(path, exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(file_path, os.getpid())
+    try:
+        with open(tmp_path, "wb") as out_file:
+            out_file.write(data)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -0,0 +1,212 @@
+"""
+MIT License
+
+Copyright (c) 2022 Eike Jens Hoffmann [eike.jens.hoffmann [at] tum.de]
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import argparse
+import logging
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+from tqdm import tqdm
+
+# Zoom level of the precomputed tile keys, experiments showed that 18 works best for building function classification
+TILE_ZOOM_LEVEL = 18
+
+# Columns of the preprocessed file without the geometry, which is stored in the last column
+ATTRIBUTE_COLUMNS = ["building_id", "class", "city", "lon", "lat", "tile_x", "tile_y"]
+
+SCHEMA = pa.schema([("building_id", pa.string()), ("class", pa.string()), ("city", pa.string()),
+                    ("lon", pa.float64()), ("lat", pa.float64()), ("tile_x", pa.int32()), ("tile_y", pa.int32()),
+                    ("geometry", pa.string())])
+
+# Lightweight replacement of a shapely point for precomputed centroids
+Centroid = namedtuple("Centroid", ["x", "y"])
+
+
+def parse_args():
+    """
+    Reads the command line arguments and returns them
+
+    :return: cmd args
+    """
+    parser = argparse.ArgumentParser("Converts the buildings CSV file once into a columnar Parquet file with "
+                                     "precomputed centroids and tile keys")
+    parser.add_argument("input_csv_bz2", help="Buildings CSV file with Bzip2 compression as input")
+    parser.add_argument("output_parquet", help="Parquet file as output")
+    parser.add_argument("-c", dest="chunk_size", help="Number of rows processed at once", default=200000, type=int)
+    return parser.parse_args()
+
+
+def is_columnar(file_name):
+    """
+    :param file_name: path of a buildings file
+    :return: True if the file is a preprocessed Parquet file, False for CSV files
+    """
+    return file_name.endswith(".parquet")
+
+
+def calc_tiles(lon, lat, zoom_level=TILE_ZOOM_LEVEL):
+    """
+    Vectorized calculation of the Web Mercator tiles containing the given coordinates
+    :param lon: array of longitudes in degrees
+    :param lat: array of latitudes in degrees
+    :param zoom_level: the zoom level of the tiles
+    :return: the arrays of tile x and tile y coordinates
+    """
+    num_tiles = 1 << zoom_level
+    sin_lat = np.sin(np.radians(lat))
+    x = (lon + 180.0) / 360.0 * num_tiles
+    y = (0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * np.pi)) * num_tiles
+    return np.floor(x).astype(np.int32), np.floor(y).astype(np.int32)
+
+
+def preprocess_chunk(chunk):
+    """
+    Calculates the centroids and tile keys of a chunk of buildings with vectorized geometry operations
+    :param chunk: a Pandas dataframe read from the input buildings CSV file
+    :return: a Pandas dataframe with the columns of the preprocessed file
+    """
+    centroids = shapely.centroid(shapely.from_wkt(chunk["geometry"].to_numpy()))
+    lon, lat = shapely.get_x(centroids), shapely.get_y(centroids)
+    tile_x, tile_y = calc_tiles(lon, lat)
+    return pd.DataFrame({"building_id": chunk["building_id"], "class": chunk["class"], "city": chunk["city"],
+                         "lon": lon, "lat": lat, "tile_x": tile_x, "tile_y": tile_y, "geometry": chunk["geometry"]})
+
+
+def preprocess(input_file, output_file, chunk_size=200000):
+    """
+    Streams the buildings CSV file once and writes a Parquet file with one row group per chunk. The geometry is stored
+    as WKT in the last column, readers that ask only for the other columns never read or decompress it
+    :param input_file: the input CSV file containing building_ids, labels, cities, and geometries
+    :param output_file: the Parquet file to be written
+    :param chunk_size: number of rows processed at once
+    :return: the number of rows written
+    """
+    num_rows = 0
+    tmp_file = output_file + ".tmp"
+    reader = pd.read_csv(input_file, chunksize=chunk_size, quotechar='"',
+                         dtype={"building_id": str, "class": str, "city": str, "geometry": str})
+    with pq.ParquetWriter(tmp_file, SCHEMA, compression="zstd") as writer:
+        for chunk in tqdm(reader):
+            table = pa.Table.from_pandas(preprocess_chunk(chunk), schema=SCHEMA, preserve_index=False)
+            writer.write_table(table)
+            num_rows += table.num_rows
+    os.replace(tmp_file, output_file)
+    return num_rows
+
+
+def read_buildings_table(file_name, columns=None):
+    """
+    Reads a buildings file as Pandas dataframe, only the requested columns are read from Parquet files. Building IDs
+    are read as strings from both file types
+    :param file_name: a buildings CSV file or a preprocessed Parquet file
+    :param columns: the columns to be read, all if None
+    :return: a Pandas dataframe
+    """
+    if is_columnar(file_name):
+        return pd.read_parquet(file_name, columns=columns)
+    return pd.read_csv(file_name, usecols=columns, dtype={"building_id": str})
+
+
+def count_rows(file_name):
+    """
+    :param file_name: a buildings CSV file or a preprocessed Parquet file
+    :return: the number of rows, which is read from the metadata for Parquet files
+    """
+    if is_columnar(file_name):
+        return pq.ParquetFile(file_name).metadata.num_rows
+    return read_buildings_table(file_name, columns=[0]).shape[0]
+
+
+def take_rows(file_name, row_numbers):
+    """
+    Reads all columns of the selected rows of a buildings file
+    :param file_name: a buildings CSV file or a preprocessed Parquet file
+    :param row_numbers: positions of the rows to be read, the result keeps their order
+    :return: a Pandas dataframe
+    """
+    if is_columnar(file_name):
+        # Only the row groups containing selected rows are read
+        parquet_file = pq.ParquetFile(file_name)
+        row_numbers = np.asarray(row_numbers, dtype=np.int64)
+        group_starts = np.cumsum([0] + [parquet_file.metadata.row_group(i).num_rows
+                                        for i in range(parquet_file.num_row_groups)])
+        row_groups = np.searchsorted(group_starts, row_numbers, side="right") - 1
+        groups = np.unique(row_groups)
+        if groups.shape[0] == 0:
+            return parquet_file.schema_arrow.empty_table().to_pandas()
+        # Row numbers relative to the concatenation of the selected row groups
+        offsets = np.cumsum(np.concatenate([[0], group_starts[groups + 1] - group_starts[groups]]))
+        positions = row_numbers - group_starts[row_groups] + offsets[np.searchsorted(groups, row_groups)]
+        table = parquet_file.read_row_groups(groups.tolist())
+        return table.take(pa.array(positions, type=pa.int64())).to_pandas()
+    return read_buildings_table(file_name).iloc[row_numbers]
+
+
+def write_buildings_table(data, file_name):
+    """
+    Writes buildings in the format given by the file extension, i.e., Parquet or (compressed) CSV
+    :param data: a Pandas dataframe
+    :param file_name: the output file
+    :return:
+    """
+    if is_columnar(file_name):
+        data.to_parquet(file_name, index=False, compression="zstd")
+    else:
+        data.to_csv(file_name, index=False)
+
+
+def iter_centroids(file_name, batch_size=65536):
+    """
+    Iterates over the buildings of a preprocessed file without touching the geometries
+    :param file_name: a preprocessed Parquet file
+    :param batch_size: number of rows read at once
+    :return: a generator of building_id, label, city, and centroid for each building
+    """
+    parquet_file = pq.ParquetFile(file_name)
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=["building_id", "class", "city", "lon", "lat"]):
+        columns = batch.to_pydict()
+        for building_id, label, city, lon, lat in zip(columns["building_id"], columns["class"], columns["city"],
+                                                      columns["lon"], columns["lat"]):
+            yield building_id, label, city, Centroid(lon, lat)
+
+
+def main():
+    """
+    Converts the buildings CSV file into the preprocessed Parquet file
+    :return:
+    """
+    args = parse_args()
+    logging.info(f"Preprocessing {args.input_csv_bz2} ...")
+    num_rows = preprocess(args.input_csv_bz2, args.output_parquet, args.chunk_size)
+    logging.info(f"Wrote {num_rows:,} buildings to {args.output_parquet}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    main()
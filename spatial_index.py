@@ -0,0 +1,324 @@
+"""
+MIT License
+
+Copyright (c) 2022 Eike Jens Hoffmann [eike.jens.hoffmann [at] tum.de]
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import shapely
+
+from preprocess import TILE_ZOOM_LEVEL, calc_tiles, is_columnar, take_rows, write_buildings_table
+
+# Arrays of the index, stored as one .npy file each, so they can be memory mapped
+INDEX_ARRAYS = ["keys", "rows", "lon", "lat", "tile_x", "tile_y", "city", "duplicate"]
+
+# Maximum number of Morton ranges a rectangle is decomposed into, larger rectangles are covered by coarser ranges
+MAX_RANGES = 256
+
+
+def parse_args():
+    """
+    Reads the command line arguments and returns them
+
+    :return: cmd args
+    """
+    parser = argparse.ArgumentParser("Builds a spatial index of a preprocessed buildings file and writes the buildings "
+                                     "of a region, a tile range, or a city into a new file")
+    parser.add_argument("input_parquet", help="Preprocessed buildings Parquet file written by preprocess.py")
+    parser.add_argument("output_file", help="Parquet or CSV file for the selected buildings, only the index is built "
+                                            "if not given", nargs="?", default=None)
+    parser.add_argument("--bbox", help="Buildings with their centroid in a bounding box", nargs=4, type=float,
+                        metavar=("MIN_LON", "MIN_LAT", "MAX_LON", "MAX_LAT"), default=None)
+    parser.add_argument("--polygon", help="Buildings with their centroid in a polygon given as WKT or as a file "
+                                          "containing WKT", default=None)
+    parser.add_argument("--tiles", help="Buildings with their centroid in a tile range", nargs=5, type=int,
+                        metavar=("ZOOM", "MIN_X", "MIN_Y", "MAX_X", "MAX_Y"), default=None)
+    parser.add_argument("--city", help="Buildings assigned to one of the cities", nargs="+", default=None)
+    parser.add_argument("--unique", help="Keep only the first row of buildings assigned to several cities",
+                        action="store_true")
+    parser.add_argument("--rebuild", help="Rebuild the index even if it is up to date", action="store_true")
+    args = parser.parse_args()
+    if args.tiles is not None and not 0 <= args.tiles[0] <= TILE_ZOOM_LEVEL:
+        parser.error(f"--tiles: the zoom level must be between 0 and {TILE_ZOOM_LEVEL}, the zoom level of the index")
+    return args
+
+
+def get_index_dir(file_name):
+    """
+    :param file_name: a preprocessed buildings Parquet file
+    :return: the directory of its spatial index
+    """
+    return file_name + ".sidx"
+
+
+def spread_bits(values):
+    """
+    Inserts a zero bit after every bit of 32-bit values
+    :param values: an array of non-negative integers below 2^32
+    :return: a uint64 array
+    """
+    v = np.asarray(values).astype(np.uint64) & np.uint64(0xFFFFFFFF)
+    for shift, mask in [(16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)]:
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+def morton_keys(x, y):
+    """
+    Vectorized version of tile_cache.morton_key
+    :param x: an array of tile x coordinates
+    :param y: an array of tile y coordinates
+    :return: a uint64 array of Morton codes
+    """
+    return spread_bits(x) | (spread_bits(y) << np.uint64(1))
+
+
+def morton_ranges(min_x, min_y, max_x, max_y, zoom_level=TILE_ZOOM_LEVEL, max_ranges=MAX_RANGES):
+    """
+    Decomposes a rectangle of tiles into ranges of Morton codes. The quadtree is refined level by level as long as the
+    number of ranges stays below the limit, so the ranges may cover tiles outside the rectangle
+    :param min_x: smallest tile x coordinate
+    :param min_y: smallest tile y coordinate
+    :param max_x: largest tile x coordinate, inclusive
+    :param max_y: largest tile y coordinate, inclusive
+    :param zoom_level: the zoom level of the tiles
+    :param max_ranges: maximum number of ranges
+    :return: a list of half-open ranges (start, stop) of Morton codes in ascending order
+    """
+    ranges = []
+    partial = [(0, 0)]
+    for level in range(zoom_level + 1):
+        shift = zoom_level - level
+        children = []
+        for qx, qy in partial:
+            x0, y0 = qx << shift, qy << shift
+            x1, y1 = x0 + (1 << shift) - 1, y0 + (1 << shift) - 1
+            if x1 < min_x or x0 > max_x or y1 < min_y or y0 > max_y:
+                continue
+            if min_x <= x0 and x1 <= max_x and min_y <= y0 and y1 <= max_y:
+                ranges.append((qx, qy, shift))
+            else:
+                children.append((qx, qy))
+        if not children:
+            partial = []
+            break
+        if level == zoom_level or len(ranges) + 4 * len(children) > max_ranges:
+            ranges.extend((qx, qy, shift) for qx, qy in children)
+            partial = []
+            break
+        partial = [(2 * qx + dx, 2 * qy + dy) for qx, qy in children for dy in (0, 1) for dx in (0, 1)]
+    bounds = sorted((int(morton_keys(qx, qy)) << 2 * shift, (int(morton_keys(qx, qy)) + 1) << 2 * shift)
+                    for qx, qy, shift in ranges)
+    # Merge adjacent ranges
+    merged = []
+    for start, stop in bounds:
+        if merged and merged[-1][1] == start:
+            merged[-1] = (merged[-1][0], stop)
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def build_index(file_name, index_dir=None, batch_size=1000000):
+    """
+    Builds the spatial index of a preprocessed buildings file. The precomputed centroids and zoom 18 tile keys are
+    sorted by their Morton code, buildings that occur in an earlier row are marked as duplicates
+    :param file_name: a preprocessed buildings Parquet file
+    :param index_dir: the directory of the index, next to the buildings file if None
+    :param batch_size: number of rows read at once
+    :return: the directory of the index
+    """
+    if not is_columnar(file_name):
+        raise ValueError(f"{file_name} is not a preprocessed Parquet file, run preprocess.py first")
+    index_dir = index_dir or get_index_dir(file_name)
+    columns = {name: [] for name in ["building_id", "city", "lon", "lat", "tile_x", "tile_y"]}
+    for batch in pq.ParquetFile(file_name).iter_batches(batch_size=batch_size, columns=list(columns)):
+        for name in columns:
+            columns[name].append(batch.column(name).to_numpy(zero_copy_only=False))
+    columns = {name: np.concatenate(values) if values else np.empty(0) for name, values in columns.items()}
+    city_codes, cities = pd.factorize(columns["city"], sort=True)
+    arrays = {"lon": columns["lon"].astype(np.float64), "lat": columns["lat"].astype(np.float64),
+              "tile_x": columns["tile_x"].astype(np.int32), "tile_y": columns["tile_y"].astype(np.int32),
+              "city": city_codes.astype(np.int16),
+              "duplicate": pd.Series(columns["building_id"]).duplicated().to_numpy()}
+    del columns
+    arrays["keys"] = morton_keys(arrays["tile_x"], arrays["tile_y"])
+    order = np.argsort(arrays["keys"], kind="stable")
+    arrays = {name: values[order] for name, values in arrays.items()}
+    arrays["rows"] = order.astype(np.int64)
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+    for name in INDEX_ARRAYS:
+        np.save(os.path.join(index_dir, name + ".npy"), arrays[name])
+    stat = os.stat(file_name)
+    # The metadata is written last, an index without it is incomplete
+    with open(os.path.join(index_dir, "meta.json"), "w") as out_file:
+        json.dump({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "zoom_level": TILE_ZOOM_LEVEL,
+                   "cities": cities.tolist(), "num_rows": int(order.shape[0])}, out_file)
+    logging.info(f"Built spatial index {index_dir} of {order.shape[0]:,} buildings "
+                 f"({int(arrays['duplicate'].sum()):,} duplicates)")
+    return index_dir
+
+
+class SpatialIndex:
+    """
+    A persisted spatial index of a preprocessed buildings file. The buildings are sorted by the Morton code of the
+    zoom 18 tile containing their centroid, so every query reads only a few contiguous slices of the memory mapped
+    arrays. A building belongs to a region if its centroid does
+    """
+
+    def __init__(self, file_name, index_dir=None, build=True, rebuild=False):
+        """
+        :param file_name: a preprocessed buildings Parquet file
+        :param index_dir: the directory of the index, next to the buildings file if None
+        :param build: build the index if it is missing or older than the buildings file
+        :param rebuild: build the index in any case
+        """
+        self.file_name = file_name
+        self.index_dir = index_dir or get_index_dir(file_name)
+        if rebuild or not self._is_up_to_date():
+            if not (build or rebuild):
+                raise ValueError(f"Spatial index {self.index_dir} is missing or outdated")
+            build_index(file_name, self.index_dir)
+        with open(os.path.join(self.index_dir, "meta.json")) as in_file:
+            meta = json.load(in_file)
+        self.cities = meta["cities"]
+        self.zoom_level = meta["zoom_level"]
+        for name in INDEX_ARRAYS:
+            setattr(self, name, np.load(os.path.join(self.index_dir, name + ".npy"), mmap_mode="r"))
+
+    def _is_up_to_date(self):
+        meta_file = os.path.join(self.index_dir, "meta.json")
+        if not os.path.isfile(meta_file):
+            return False
+        with open(meta_file) as in_file:
+            meta = json.load(in_file)
+        stat = os.stat(self.file_name)
+        return meta["size"] == stat.st_size and meta["mtime_ns"] == stat.st_mtime_ns
+
+    def __len__(self):
+        return self.keys.shape[0]
+
+    def _tile_candidates(self, min_x, min_y, max_x, max_y):
+        """
+        :return: the positions in the index of all buildings in the Morton ranges covering the tile rectangle
+        """
+        ranges = morton_ranges(min_x, min_y, max_x, max_y, self.zoom_level)
+        if not ranges:
+            return np.empty(0, dtype=np.int64)
+        bounds = np.searchsorted(self.keys, np.array(ranges, dtype=np.uint64).ravel()).reshape(-1, 2)
+        return np.concatenate([np.arange(start, stop) for start, stop in bounds])
+
+    def _bbox_candidates(self, min_lon, min_lat, max_lon, max_lat):
+        (min_x, max_x), (max_y, min_y) = calc_tiles(np.array([min_lon, max_lon]), np.array([min_lat, max_lat]),
+                                                    self.zoom_level)
+        positions = self._tile_candidates(min_x, min_y, max_x, max_y)
+        lon, lat = self.lon[positions], self.lat[positions]
+        return positions[(lon >= min_lon) & (lon <= max_lon) & (lat >= min_lat) & (lat <= max_lat)]
+
+    def query(self, bbox=None, polygon=None, tiles=None, cities=None, unique=False):
+        """
+        Selects buildings by all given conditions
+        :param bbox: (min_lon, min_lat, max_lon, max_lat) containing the centroids
+        :param polygon: a shapely polygon containing the centroids
+        :param tiles: (zoom, min_x, min_y, max_x, max_y) range of tiles containing the centroids, inclusive
+        :param cities: names of the cities the buildings are assigned to
+        :param unique: drop rows of buildings that occur in an earlier row, e.g., assigned to another city
+        :return: the row numbers of the selected buildings in ascending order
+        """
+        positions = None
+        if tiles is not None:
+            zoom, min_x, min_y, max_x, max_y = tiles
+            if not 0 <= zoom <= self.zoom_level:
+                raise ValueError(f"Tile zoom level {zoom} is not between 0 and {self.zoom_level}, the zoom level of "
+                                 f"the index")
+            shift = self.zoom_level - zoom
+            min_x, min_y = min_x << shift, min_y << shift
+            max_x, max_y = ((max_x + 1) << shift) - 1, ((max_y + 1) << shift) - 1
+            positions = self._tile_candidates(min_x, min_y, max_x, max_y)
+            tile_x, tile_y = self.tile_x[positions], self.tile_y[positions]
+            positions = positions[(tile_x >= min_x) & (tile_x <= max_x) & (tile_y >= min_y) & (tile_y <= max_y)]
+        if bbox is not None:
+            positions = self._intersect(positions, self._bbox_candidates(*bbox))
+        if polygon is not None:
+            shapely.prepare(polygon)
+            candidates = self._bbox_candidates(*polygon.bounds)
+            candidates = candidates[shapely.contains_xy(polygon, self.lon[candidates], self.lat[candidates])]
+            positions = self._intersect(positions, candidates)
+        if cities is not None:
+            codes = [self.cities.index(city) for city in cities if city in self.cities]
+            if positions is None:
+                positions = np.flatnonzero(np.isin(self.city, codes))
+            else:
+                positions = positions[np.isin(self.city[positions], codes)]
+        if positions is None:
+            positions = np.arange(len(self))
+        if unique:
+            positions = positions[~self.duplicate[positions]]
+        return np.sort(self.rows[positions])
+
+    @staticmethod
+    def _intersect(positions, other):
+        return other if positions is None else np.intersect1d(positions, other)
+
+
+def read_polygon(polygon):
+    """
+    :param polygon: a polygon as WKT or the path of a file containing WKT
+    :return: a shapely geometry
+    """
+    if os.path.isfile(polygon):
+        with open(polygon) as in_file:
+            polygon = in_file.read()
+    return shapely.from_wkt(polygon)
+
+
+def main():
+    """
+    Builds or updates the spatial index and writes the selected buildings, which can be used as input of
+    download_building_aerial_images.py, undersample.py, and split_train_test.py
+    :return:
+    """
+    args = parse_args()
+    index = SpatialIndex(args.input_parquet, rebuild=args.rebuild)
+    if args.output_file is None:
+        return
+    start = time.perf_counter()
+    rows = index.query(args.bbox, read_polygon(args.polygon) if args.polygon else None, args.tiles, args.city,
+                       args.unique)
+    logging.info(f"Selected {rows.shape[0]:,} of {len(index):,} buildings in "
+                 f"{(time.perf_counter() - start) * 1000:.1f} ms")
+    write_buildings_table(take_rows(args.input_parquet, rows), args.output_file)
+    logging.info(f"Wrote {args.output_file}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    main()
@@ -21,37 +21,328 @@ SOFTWARE.
 """
 
 import argparse
+import logging
 import os.path
+from collections import deque
+from contextlib import ExitStack
+from functools import partial
 from math import floor
+from multiprocessing import Pool
 
+import numpy as np
 import pandas as pd
+import shapely
+
+from preprocess import TILE_ZOOM_LEVEL, calc_tiles, count_rows, is_columnar, read_buildings_table, take_rows, \
+    write_buildings_table
+from streaming import DEFAULT_MEMORY_MB, ChunkedTableWriter, ValueEncoder, count_rows_streaming, \
+    estimate_chunk_size, iter_chunks
 
 # A carefully chosen random seed
 SEED = 42
 
+# Zoom level of the tiles used as spatial blocks, a tile at zoom 14 covers about 2.4 km at the equator
+DEFAULT_BLOCK_ZOOM = 14
+# Columns a split can be stratified by
+STRATIFY_COLUMNS = ("city", "class")
+
+
+def stratify_columns(value):
+    """
+    Parses a comma-separated list of stratification columns, a single value cannot swallow the input file argument
+
+    :param value: the command line value, e.g., city,class
+    :return: the list of columns
+    """
+    columns = [column.strip() for column in value.split(",") if column.strip()]
+    for column in columns:
+        if column not in STRATIFY_COLUMNS:
+            raise argparse.ArgumentTypeError(f"invalid column {column!r}, choose from {', '.join(STRATIFY_COLUMNS)}")
+    return list(dict.fromkeys(columns))
+
 
-def parse_args():
+def parse_args(args=None):
     """
     Reads the command line arguments and returns them
 
+    :param args: the arguments to parse, sys.argv if not given
     :return: cmd args
     """
     parser = argparse.ArgumentParser("A script to split a building CSV file into a training and test part")
     parser.add_argument("-s", help="Relative size of the training set compared to the whole dataset", dest="split_ratio", type=float, default=0.8)
-    parser.add_argument("input_csv_bz2", help="Buildings CSV file with Bzip2 compression as input")
-    return parser.parse_args()
+    parser.add_argument("--streaming", help="Read the input chunk by chunk instead of loading it into memory. The "
+                                            "parts contain the same rows, but in the order of the input file",
+                        action="store_true")
+    parser.add_argument("-m", dest="memory_mb", help="Memory ceiling of a chunk in megabytes in streaming mode",
+                        default=DEFAULT_MEMORY_MB, type=int)
+    parser.add_argument("--method", help="shuffle: shuffle all rows and cut, hash: assign every row by a stable hash "
+                                         "of its key in one streaming pass, so the assignment of a building does not "
+                                         "depend on the other buildings", choices=["shuffle", "hash"],
+                        default="shuffle")
+    parser.add_argument("--key", help="Key hashed by the hash method, building: the building ID, tile: the tile at "
+                                      "the block zoom level containing the centroid, so nearby buildings end up in "
+                                      "the same part", choices=["building", "tile"], default="building")
+    parser.add_argument("--block-zoom", help="Zoom level of the tiles used as spatial blocks", dest="block_zoom",
+                        default=DEFAULT_BLOCK_ZOOM, type=int)
+    parser.add_argument("--stratify", help="Make every part contain the same share of each city and/or class with "
+                                           "the hash method, given as comma-separated columns, e.g., city,class, "
+                                           "needs an additional pass over the keys",
+                        type=stratify_columns, default=[])
+    parser.add_argument("-k", dest="num_folds", help="Write k folds of equal size instead of a training and test part "
+                                                     "with the hash method", default=None, type=int)
+    parser.add_argument("-p", dest="num_processes", help="Number of processes hashing the keys with the hash method",
+                        default=1, type=int)
+    parser.add_argument("input_csv_bz2", help="Buildings CSV file with Bzip2 compression or preprocessed Parquet file "
+                                              "as input")
+    return parser.parse_args(args)
+
+
+def split_streaming(input_file, train_file, test_file, split_ratio, memory_mb=DEFAULT_MEMORY_MB):
+    """
+    Splits a file with bounded memory. The rows of the training part are marked in a boolean array using the same
+    permutation as the in-memory split, then the input is streamed once and every row is copied to its part
+
+    :param input_file: a CSV file or a Parquet file
+    :param train_file: output file of the training part
+    :param test_file: output file of the test part
+    :param split_ratio: relative size of the training part
+    :param memory_mb: memory ceiling of a chunk in megabytes
+    :return: the number of rows of the training and the test part
+    """
+    chunk_size = estimate_chunk_size(input_file, memory_mb)
+    num_rows = count_rows_streaming(input_file, chunk_size)
+    is_train = np.zeros(num_rows, dtype=bool)
+    is_train[np.random.RandomState(SEED).permutation(num_rows)[:floor(num_rows * split_ratio)]] = True
+    with ChunkedTableWriter(train_file) as train_writer, ChunkedTableWriter(test_file) as test_writer:
+        for chunk in iter_chunks(input_file, chunk_size):
+            mask = is_train[chunk.index.start:chunk.index.stop]
+            train_writer.write(chunk[mask])
+            test_writer.write(chunk[~mask])
+    return train_writer.num_rows, test_writer.num_rows
+
+
+def calc_split_hashes(chunk, key="building", block_zoom=DEFAULT_BLOCK_ZOOM, seed=SEED):
+    """
+    Calculates a stable 64-bit hash of the split key of every row. The hash only depends on the key and the seed, not
+    on other rows, the platform, or the order of the rows
+
+    :param chunk: a Pandas dataframe with the key columns, see get_key_columns
+    :param key: building to hash the building ID, tile to hash the block containing the centroid
+    :param block_zoom: zoom level of the tiles used as spatial blocks
+    :param seed: random seed, a different seed yields a different split
+    :return: a uint64 array of hashes
+    """
+    if key == "building":
+        values = chunk["building_id"].astype(str).to_numpy(dtype=object)
+    else:
+        if "tile_x" in chunk:
+            tile_x, tile_y = chunk["tile_x"].to_numpy(), chunk["tile_y"].to_numpy()
+        else:
+            centroids = shapely.centroid(shapely.from_wkt(chunk["geometry"].to_numpy()))
+            tile_x, tile_y = calc_tiles(shapely.get_x(centroids), shapely.get_y(centroids))
+        shift = TILE_ZOOM_LEVEL - block_zoom
+        values = (tile_x.astype(np.uint64) >> np.uint64(shift) << np.uint64(32)) | \
+                 (tile_y.astype(np.uint64) >> np.uint64(shift))
+    return pd.util.hash_array(values, hash_key=f"{seed:016d}"[-16:], categorize=False)
+
+
+def get_key_columns(file_name, key):
+    """
+    :param file_name: a buildings CSV file or a preprocessed Parquet file
+    :param key: building or tile, see calc_split_hashes
+    :return: the columns needed to calculate the hashes
+    """
+    if key == "building":
+        return ["building_id"]
+    return ["tile_x", "tile_y"] if is_columnar(file_name) else ["geometry"]
+
+
+def encode_strata(chunk, stratify, encoder):
+    """
+    :param chunk: a Pandas dataframe with the stratification columns
+    :param stratify: the columns used for stratification
+    :param encoder: a ValueEncoder of the strata
+    :return: the stratum code of every row
+    """
+    if not stratify:
+        return np.zeros(chunk.shape[0], dtype=np.int32)
+    strata = chunk[stratify[0]].fillna("").astype(str)
+    for column in stratify[1:]:
+        strata = strata + "\t" + chunk[column].fillna("").astype(str)
+    return encoder.encode(strata)
+
+
+def calc_hash_thresholds(hashes, strata, fractions):
+    """
+    Calculates the hash thresholds of every stratum, so the parts get the given shares of every stratum. All rows with
+    the same hash form a block, e.g., a spatial block or a building listed in several cities. A block is assigned as a
+    whole with the thresholds of the stratum most of its rows belong to, and the thresholds of a stratum are calculated
+    from the row counts of its blocks. Hence a block never ends up in two parts and the strata are balanced at block
+    level
+
+    :param hashes: the hashes of all rows
+    :param strata: the stratum codes of all rows
+    :param fractions: the cumulative shares at which a new part starts
+    :return: 1. the sorted unique hashes of the blocks, 2. the stratum of every block, 3. a uint64 array with one row
+    of thresholds per stratum
+    """
+    num_strata = int(strata.max()) + 1 if strata.shape[0] else 0
+    thresholds = np.full((num_strata, len(fractions)), np.iinfo(np.uint64).max, dtype=np.uint64)
+    block_hashes, blocks = np.unique(hashes, return_inverse=True)
+    # Rows per block and stratum, the most frequent stratum of a block decides, ties go to the lower stratum code
+    pairs, pair_counts = np.unique(blocks.astype(np.int64) * max(num_strata, 1) + strata, return_counts=True)
+    pair_blocks, pair_strata = pairs // max(num_strata, 1), pairs % max(num_strata, 1)
+    order = np.lexsort((-pair_counts, pair_blocks))
+    is_first = np.ones(order.shape[0], dtype=bool)
+    is_first[1:] = pair_blocks[order][1:] != pair_blocks[order][:-1]
+    block_strata = pair_strata[order[is_first]].astype(np.int32)
+    block_sizes = np.bincount(blocks, minlength=block_hashes.shape[0])
+    # The blocks of every stratum in hash order
+    order = np.argsort(block_strata, kind="stable")
+    starts = np.searchsorted(block_strata[order], np.arange(num_strata + 1))
+    for stratum in range(num_strata):
+        selected = order[starts[stratum]:starts[stratum + 1]]
+        sizes = block_sizes[selected]
+        rows_before = np.cumsum(sizes) - sizes
+        targets = np.floor(sizes.sum() * np.asarray(fractions))
+        pos = np.searchsorted(rows_before, targets, side="left")
+        # Cut at the block boundary closest to the target, large blocks would otherwise always enlarge the first parts
+        total = np.append(rows_before, sizes.sum())
+        closer = (pos > 0) & (targets - total[np.maximum(pos - 1, 0)] < total[pos] - targets)
+        pos = pos - closer
+        inside = pos < selected.shape[0]
+        thresholds[stratum, inside] = block_hashes[selected[pos[inside]]]
+    return block_hashes, block_strata, thresholds
+
+
+def calc_uniform_thresholds(fractions):
+    """
+    :param fractions: the cumulative shares at which a new part starts
+    :return: a uint64 array with the thresholds dividing the whole hash range by the given shares
+    """
+    max_hash = np.iinfo(np.uint64).max
+    # A share of 1.0 would overflow the uint64 range
+    return np.array([max_hash if f >= 1.0 else int(f * 2.0 ** 64) for f in fractions], dtype=np.uint64)
+
+
+def split_by_hash(input_file, output_files, fractions, key="building", block_zoom=DEFAULT_BLOCK_ZOOM, stratify=(),
+                  num_processes=1, memory_mb=DEFAULT_MEMORY_MB):
+    """
+    Splits a file into parts by a stable hash of the split key of every row in a single streaming pass. Without
+    stratification, a row goes into the part in which its hash falls when the hash range is divided by the given
+    shares. With stratification, a first pass over the key columns calculates the hash thresholds of every stratum,
+    rows with the same hash, e.g., of the same spatial block, still end up in the same part
+
+    :param input_file: a buildings CSV file or a preprocessed Parquet file
+    :param output_files: one CSV file or Parquet file per part
+    :param fractions: the cumulative shares at which a new part starts, one less than the number of parts
+    :param key: building or tile, see calc_split_hashes
+    :param block_zoom: zoom level of the tiles used as spatial blocks
+    :param stratify: the columns used for stratification
+    :param num_processes: number of processes hashing the keys
+    :param memory_mb: memory ceiling of a chunk in megabytes
+    :return: the number of rows of every part
+    """
+    stratify = list(stratify)
+    chunk_size = estimate_chunk_size(input_file, memory_mb)
+    key_columns = get_key_columns(input_file, key)
+    hash_keys = partial(calc_split_hashes, key=key, block_zoom=block_zoom)
+    encoder = ValueEncoder()
+    pool = Pool(num_processes) if num_processes > 1 else None
+    try:
+        if stratify:
+            hashes, strata = [], []
+            chunks = iter_chunks(input_file, chunk_size, key_columns + stratify)
+            for chunk, chunk_hashes in iter_hashed_chunks(chunks, hash_keys, key_columns, pool, num_processes):
+                hashes.append(chunk_hashes)
+                strata.append(encode_strata(chunk, stratify, encoder))
+            block_hashes, block_strata, thresholds = calc_hash_thresholds(np.concatenate(hashes),
+                                                                          np.concatenate(strata), fractions)
+            del hashes, strata
+        else:
+            thresholds = calc_uniform_thresholds(fractions)[np.newaxis, :]
+        with ExitStack() as stack:
+            writers = [stack.enter_context(ChunkedTableWriter(output_file)) for output_file in output_files]
+            for chunk, chunk_hashes in iter_hashed_chunks(iter_chunks(input_file, chunk_size), hash_keys, key_columns,
+                                                          pool, num_processes):
+                if stratify:
+                    strata = block_strata[np.searchsorted(block_hashes, chunk_hashes)]
+                else:
+                    strata = encode_strata(chunk, stratify, encoder)
+                parts = (chunk_hashes[:, np.newaxis] >= thresholds[strata]).sum(axis=1)
+                for part, writer in enumerate(writers):
+                    writer.write(chunk[parts == part])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    num_rows = [writer.num_rows for writer in writers]
+    logging.info("Wrote " + ", ".join(f"{n:,} rows to {f}" for n, f in zip(num_rows, output_files)))
+    return num_rows
+
+
+def iter_hashed_chunks(chunks, hash_keys, key_columns, pool=None, num_processes=1):
+    """
+    Calculates the hashes of the chunks, in parallel if a process pool is given. Only the key columns are sent to the
+    workers, at most num_processes chunks are in flight
+
+    :param chunks: an iterable of Pandas dataframes
+    :param hash_keys: the function calculating the hashes of the key columns
+    :param key_columns: the columns needed for the hashes
+    :param pool: an optional multiprocessing pool
+    :param num_processes: number of processes of the pool
+    :return: a generator of chunks and their hashes in the order of the chunks
+    """
+    if pool is None:
+        for chunk in chunks:
+            yield chunk, hash_keys(chunk[key_columns])
+        return
+    pending = deque()
+    for chunk in chunks:
+        pending.append((chunk, pool.apply_async(hash_keys, (chunk[key_columns],))))
+        if len(pending) >= num_processes:
+            chunk, result = pending.popleft()
+            yield chunk, result.get()
+    while pending:
+        chunk, result = pending.popleft()
+        yield chunk, result.get()
 
 
 def main():
     """
     Reads the input CSV, performs a random split, and saves the training and test part in two separate files with
-    appropriate file name suffixes in the current directory
+    appropriate file name suffixes in the current directory. A preprocessed Parquet input is split into Parquet files,
+    only the selected rows of every part are read. With the hash method and k folds, the parts are saved as
+    {prefix}_fold0 to {prefix}_fold{k-1}
 
     :return:
     """
-    # Read the data
     args = parse_args()
-    data = pd.read_csv(args.input_csv_bz2)
+    prefix = os.path.basename(args.input_csv_bz2).split(".")[0]
+    suffix = ".parquet" if is_columnar(args.input_csv_bz2) else ".csv.bz2"
+    if args.method == "hash":
+        if args.num_folds:
+            output_files = [f"{prefix}_fold{i}{suffix}" for i in range(args.num_folds)]
+            fractions = [i / args.num_folds for i in range(1, args.num_folds)]
+        else:
+            output_files, fractions = [prefix + "_train" + suffix, prefix + "_test" + suffix], [args.split_ratio]
+        split_by_hash(args.input_csv_bz2, output_files, fractions, args.key, args.block_zoom, args.stratify,
+                      args.num_processes, args.memory_mb)
+        return
+    if args.streaming:
+        split_streaming(args.input_csv_bz2, prefix + "_train" + suffix, prefix + "_test" + suffix, args.split_ratio,
+                        args.memory_mb)
+        return
+    if is_columnar(args.input_csv_bz2):
+        # The same permutation as sample(frac=1.0, random_state=SEED) but without reading any data
+        num_rows = count_rows(args.input_csv_bz2)
+        order = np.random.RandomState(SEED).permutation(num_rows)
+        train_split = floor(num_rows * args.split_ratio)
+        write_buildings_table(take_rows(args.input_csv_bz2, order[:train_split]), prefix + "_train.parquet")
+        write_buildings_table(take_rows(args.input_csv_bz2, order[train_split:]), prefix + "_test.parquet")
+        return
+    # Read the data
+    data = read_buildings_table(args.input_csv_bz2)
     # Random shuffle of the data
     data = data.sample(frac=1.0, random_state=SEED)
     # Simple way to find the index of the split
@@ -59,10 +350,10 @@ def main():
     # Create the two parts for training and test
     train_data, test_data = data[:train_split], data[train_split:]
     # Extract the file prefix based on the file type separator and save the two files in the current directory
-    prefix = os.path.basename(args.input_csv_bz2).split(".")[0]
     train_data.to_csv(prefix + "_train.csv.bz2", index=False)
     test_data.to_csv(prefix + "_test.csv.bz2", index=False)
 
 
 if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
     main()
@@ -0,0 +1,265 @@
+"""
+MIT License
+
+Copyright (c) 2022 Eike Jens Hoffmann [eike.jens.hoffmann [at] tum.de]
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import bz2
+import gzip
+import logging
+import lzma
+import os
+from collections import deque
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from preprocess import is_columnar
+
+# Default memory ceiling of a chunk in megabytes
+DEFAULT_MEMORY_MB = 1024
+
+# Ratio between the peak memory of processing a chunk and the size of the parsed chunk, covers the parser buffers,
+# the filtered copy, and the encoding of the output
+CHUNK_OVERHEAD = 4
+
+# Openers of the compressed CSV formats supported by Pandas, chosen by file extension
+COMPRESSED_OPENERS = {".bz2": bz2.open, ".gz": gzip.open, ".xz": lzma.open}
+
+
+def estimate_chunk_size(file_name, memory_mb=DEFAULT_MEMORY_MB, columns=None, sample_rows=1000):
+    """
+    Estimates the number of rows that can be processed at once without exceeding the memory ceiling. The size of a
+    row is measured on the first rows of the file
+    :param file_name: a CSV file or a Parquet file
+    :param memory_mb: the memory ceiling in megabytes
+    :param columns: the columns to be read, all if None
+    :param sample_rows: number of rows used for the measurement
+    :return: the number of rows per chunk
+    """
+    sample = next(iter_chunks(file_name, sample_rows, columns), None)
+    if sample is None or sample.shape[0] == 0:
+        return sample_rows
+    bytes_per_row = sample.memory_usage(index=False, deep=True).sum() / sample.shape[0]
+    chunk_size = max(int(memory_mb * 2 ** 20 / (bytes_per_row * CHUNK_OVERHEAD)), 1)
+    logging.debug(f"Measured {bytes_per_row:,.0f} bytes per row, reading {chunk_size:,} rows at once")
+    return chunk_size
+
+
+def iter_chunks(file_name, chunk_size, columns=None):
+    """
+    Reads a file chunk by chunk. All columns of CSV files are read as strings, so the values are written back
+    unchanged and every chunk has the same types
+    :param file_name: a CSV file or a Parquet file
+    :param chunk_size: number of rows per chunk
+    :param columns: the columns to be read, all if None
+    :return: a generator of Pandas dataframes, the index of every chunk contains the row numbers in the file
+    """
+    offset = 0
+    if is_columnar(file_name):
+        batches = (batch.to_pandas() for batch in
+                   pq.ParquetFile(file_name).iter_batches(batch_size=chunk_size, columns=columns))
+    else:
+        batches = pd.read_csv(file_name, chunksize=chunk_size, usecols=columns, dtype=str)
+    for chunk in batches:
+        chunk.index = pd.RangeIndex(offset, offset + chunk.shape[0])
+        offset += chunk.shape[0]
+        yield chunk
+
+
+def count_rows_streaming(file_name, chunk_size):
+    """
+    :param file_name: a CSV file or a Parquet file
+    :param chunk_size: number of rows per chunk
+    :return: the number of rows, which is read from the metadata for Parquet files
+    """
+    if is_columnar(file_name):
+        return pq.ParquetFile(file_name).metadata.num_rows
+    return sum(chunk.shape[0] for chunk in iter_chunks(file_name, chunk_size, columns=[0]))
+
+
+def _apply_to_row_group(file_name, row_group, columns, func):
+    return func(pq.ParquetFile(file_name).read_row_group(row_group, columns=columns).to_pandas())
+
+
+def map_chunks(func, file_name, chunk_size, columns=None, pool=None, num_processes=1):
+    """
+    Applies a function to every chunk of a file, in parallel if a process pool is given. The workers read the row
+    groups of Parquet files themselves, chunks of CSV files are read by the calling process and sent to the workers.
+    At most num_processes chunks are in flight
+    :param func: a picklable function of a Pandas dataframe
+    :param file_name: a CSV file or a Parquet file
+    :param chunk_size: number of rows per chunk of CSV files, Parquet files are processed by row group
+    :param columns: the columns to be read, all if None
+    :param pool: an optional multiprocessing pool
+    :param num_processes: number of processes of the pool
+    :return: a generator of the results in the order of the chunks
+    """
+    if pool is None:
+        for chunk in iter_chunks(file_name, chunk_size, columns):
+            yield func(chunk)
+        return
+    if is_columnar(file_name):
+        tasks = ((_apply_to_row_group, (file_name, row_group, columns, func))
+                 for row_group in range(pq.ParquetFile(file_name).num_row_groups))
+    else:
+        tasks = ((func, (chunk,)) for chunk in iter_chunks(file_name, chunk_size, columns))
+    pending = deque()
+    for task, args in tasks:
+        pending.append(pool.apply_async(task, args))
+        if len(pending) >= num_processes:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+class ChunkedTableWriter:
+    """
+    Writes a table chunk by chunk in the format given by the file extension, i.e., Parquet or (compressed) CSV. The
+    file is written under a temporary name and renamed when it is closed
+    """
+
+    def __init__(self, file_name):
+        """
+        :param file_name: the output file
+        """
+        self.file_name = file_name
+        self.num_rows = 0
+        self._tmp_file = file_name + ".tmp"
+        self._writer = None
+        self._empty = None
+
+    def write(self, chunk):
+        """
+        Appends the rows of a chunk
+        :param chunk: a Pandas dataframe, all chunks need the same columns
+        :return:
+        """
+        # The types of an empty chunk are unknown, it only defines the output if no rows are written at all
+        if chunk.shape[0] == 0:
+            if self._writer is None:
+                self._empty = chunk
+            return
+        if is_columnar(self.file_name):
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self._tmp_file, table.schema, compression="zstd")
+            self._writer.write_table(table.cast(self._writer.schema))
+        else:
+            if self._writer is None:
+                self._writer = self._open_csv()
+            chunk.to_csv(self._writer, index=False, header=self.num_rows == 0)
+        self.num_rows += chunk.shape[0]
+
+    def _open_csv(self):
+        opener = COMPRESSED_OPENERS.get(os.path.splitext(self.file_name)[1], open)
+        return opener(self._tmp_file, "wt", newline="")
+
+    def close(self):
+        """
+        Closes the file and moves it to its final name
+        :return:
+        """
+        if self._writer is None:
+            if self._empty is None:
+                raise ValueError(f"No chunk was written to {self.file_name}")
+            # Without any rows, only the columns of an empty chunk are written
+            if is_columnar(self.file_name):
+                self._empty.to_parquet(self._tmp_file, index=False)
+            else:
+                with self._open_csv() as out_file:
+                    self._empty.to_csv(out_file, index=False)
+            os.replace(self._tmp_file, self.file_name)
+            return
+        self._writer.close()
+        os.replace(self._tmp_file, self.file_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        elif self._writer is not None:
+            self._writer.close()
+            os.remove(self._tmp_file)
+
+
+class HashedIdSet:
+    """
+    A compact set of IDs, every ID is stored as 64-bit hash in a sorted array, which needs 8 bytes per ID. Two
+    different IDs share a hash with a probability of about n^2 / 2^65, i.e., less than 1e-4 for 30 million IDs
+    """
+
+    def __init__(self):
+        self._hashes = np.empty(0, dtype=np.uint64)
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def add_new(self, ids):
+        """
+        Adds a batch of IDs to the set
+        :param ids: an array of IDs, missing IDs are treated as one ID like in drop_duplicates
+        :return: a boolean mask of the IDs that occur for the first time, in the batch and in the set
+        """
+        hashes = pd.util.hash_array(np.asarray(ids, dtype=object))
+        new = ~pd.Series(hashes).duplicated().to_numpy()
+        if len(self._hashes) > 0:
+            pos = np.minimum(np.searchsorted(self._hashes, hashes), len(self._hashes) - 1)
+            new &= self._hashes[pos] != hashes
+        # Both parts are sorted, so the stable sort only merges two runs
+        self._hashes = np.sort(np.concatenate([self._hashes, np.sort(hashes[new])]), kind="stable")
+        return new
+
+
+class ValueEncoder:
+    """
+    Encodes the values of a column with few distinct values, e.g., cities or classes, chunk by chunk as integer codes
+    """
+
+    def __init__(self):
+        self.values = []
+        self._index = pd.Index([], dtype=object)
+
+    def encode(self, values):
+        """
+        :param values: an array of values
+        :return: an int32 array of codes into the list of values seen so far, -1 for missing values
+        """
+        values = pd.Series(values)
+        unseen = [value for value in values.dropna().unique() if value not in self._index]
+        if unseen:
+            self.values.extend(unseen)
+            self._index = pd.Index(self.values, dtype=object)
+        return self._index.get_indexer(values).astype(np.int32)
+
+    def sorted_codes(self, codes):
+        """
+        Converts codes into codes of the sorted list of values, like pd.factorize(..., sort=True) would return them
+        :param codes: codes returned by encode
+        :return: 1. the converted codes, 2. the sorted list of values
+        """
+        values = sorted(self.values)
+        mapping = pd.Index(values, dtype=object).get_indexer(self.values).astype(np.int32)
+        return np.where(codes >= 0, mapping[np.maximum(codes, 0)], -1).astype(np.int32), values
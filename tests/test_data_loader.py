@@ -0,0 +1,59 @@
+"""
+MIT License
+
+Copyright (c) 2022 Eike Jens Hoffmann [eike.jens.hoffmann [at] tum.de]
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from data_loader import AerialPatchDataset
+from patch_store import get_output_path
+
+
+def write_images(tmp_path, num_images, zoom_level=18):
+    output_image_dir = str(tmp_path / "images")
+    for i in range(num_images):
+        file_path = get_output_path(output_image_dir, zoom_level, "residential", str(i))
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        Image.fromarray(np.full((8, 8, 3), i, dtype=np.uint8)).save(file_path)
+    buildings_file = str(tmp_path / "buildings.csv")
+    pd.DataFrame({"building_id": range(num_images), "class": "residential"}).to_csv(buildings_file, index=False)
+    return buildings_file, output_image_dir
+
+
+def test_cache_with_drop_last(tmp_path):
+    buildings_file, output_image_dir = write_images(tmp_path, 10)
+    cache_file = str(tmp_path / "images.cache")
+    dataset = AerialPatchDataset(buildings_file, output_image_dir, batch_size=4, num_workers=2,
+                                 cache_file=cache_file, drop_last=True)
+    decoded = [images for images, _ in dataset]
+    assert [len(images) for images in decoded] == [4, 4]
+    # The dropped last batch is decoded into the cache, so the second epoch reads the complete cache
+    assert os.path.isfile(cache_file + ".json")
+    assert dataset._open_cache() is not None
+    cached = [images for images, _ in dataset]
+    assert [len(images) for images in cached] == [4, 4]
+    for decoded_images, cached_images in zip(decoded, cached):
+        np.testing.assert_array_equal(decoded_images, cached_images)
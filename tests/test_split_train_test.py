@@ -0,0 +1,68 @@
+"""
+MIT License
+
+Copyright (c) 2022 Eike Jens Hoffmann [eike.jens.hoffmann [at] tum.de]
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import bz2
+import csv
+import os
+import subprocess
+import sys
+
+import pandas as pd
+import pytest
+
+from split_train_test import parse_args
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "split_train_test.py")
+
+
+def write_buildings(file_name, num_rows):
+    with bz2.open(file_name, "wt", newline="") as out_file:
+        writer = csv.writer(out_file)
+        writer.writerow(["building_id", "class", "city", "geometry"])
+        for i in range(num_rows):
+            lon, lat = 11.5 + (i % 20) * 0.01, 48.1 + (i // 20) * 0.01
+            writer.writerow([1000 + i, ["residential", "commercial", "other"][i % 3], ["munich", "berlin"][i % 2],
+                             f"POLYGON (({lon} {lat}, {lon + 1e-4} {lat}, {lon + 1e-4} {lat + 1e-4}, {lon} {lat}))"])
+
+
+def test_stratify_before_input_file():
+    args = parse_args(["--method", "hash", "--stratify", "city,class", "buildings.csv.bz2"])
+    assert args.stratify == ["city", "class"]
+    assert args.input_csv_bz2 == "buildings.csv.bz2"
+
+
+def test_stratify_rejects_unknown_column():
+    with pytest.raises(SystemExit):
+        parse_args(["--stratify", "city,height", "buildings.csv.bz2"])
+
+
+def test_stratified_split_from_command_line(tmp_path):
+    write_buildings(tmp_path / "buildings.csv.bz2", 300)
+    subprocess.run([sys.executable, SCRIPT, "--method", "hash", "--stratify", "city,class", "buildings.csv.bz2"],
+                   cwd=tmp_path, check=True)
+    train = pd.read_csv(tmp_path / "buildings_train.csv.bz2")
+    test = pd.read_csv(tmp_path / "buildings_test.csv.bz2")
+    assert len(train) + len(test) == 300
+    assert not set(train["building_id"]) & set(test["building_id"])
+    assert set(train["city"]) == set(test["city"]) == {"munich", "berlin"}
@@ -0,0 +1,153 @@
+"""
+MIT License
+
+Copyright (c) 2022 Eike Jens Hoffmann [eike.jens.hoffmann [at] tum.de]
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+import mercantile
+import numpy as np
+from PIL import Image
+
+import metrics
+
+# Number of buildings sorted together by sort_by_tile_order, which bounds the memory and the delay before the first
+# building is processed
+DEFAULT_SORT_WINDOW = 100_000
+
+
+class TileCache:
+    """
+    A byte-bounded LRU cache of decoded tiles. Neighboring buildings share most of their tiles, so keeping the decoded
+    uint8 arrays in memory avoids decoding the same tile files over and over again
+    """
+
+    def __init__(self, max_bytes=256 * 1024 ** 2):
+        """
+        :param max_bytes: the maximum number of bytes of all cached tile arrays together
+        """
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def get(self, tile, tile_store):
+        """
+        Returns the decoded tile from the cache or loads it from the tile store
+        :param tile: the tile object, used as (x, y, z) key
+        :param tile_store: the tile store from which the tile is loaded in case of a cache miss
+        :return: a read-only uint8 array of the tile
+        """
+        key = (tile.x, tile.y, tile.z)
+        with self._lock:
+            img = self._tiles.get(key)
+            if img is not None:
+                self._tiles.move_to_end(key)
+                self.hits += 1
+                metrics.inc("tile_cache_total", result="hit")
+                return img
+            self.misses += 1
+        metrics.inc("tile_cache_total", result="miss")
+        # Decode outside of the lock, so other threads are not blocked by a slow decoding
+        with metrics.timer("stage_seconds", stage="decode"):
+            img = np.array(Image.open(BytesIO(tile_store.get(tile))).convert("RGB"))
+        img.setflags(write=False)
+        self.put(key, img)
+        return img
+
+    def put(self, key, img):
+        """
+        Adds a decoded tile to the cache and evicts the least recently used tiles if the cache is full
+        :param key: the (x, y, z) key of the tile
+        :param img: the decoded tile
+        :return:
+        """
+        if img.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old_img = self._tiles.pop(key, None)
+            if old_img is not None:
+                self.num_bytes -= old_img.nbytes
+            self._tiles[key] = img
+            self.num_bytes += img.nbytes
+            while self.num_bytes > self.max_bytes:
+                _, evicted = self._tiles.popitem(last=False)
+                self.num_bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def stats(self):
+        """
+        :return: a dictionary with the hit, miss, and eviction counters as well as the current fill level
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "hit_rate": self.hits / lookups if lookups else 0.0, "tiles": len(self._tiles),
+                    "bytes": self.num_bytes}
+
+
+def morton_key(x, y):
+    """
+    Interleaves the bits of the tile coordinates (Z-order curve). Tiles with close keys are spatially close, which is
+    the same ordering as sorting by quadkey
+    :param x: x coordinate of a tile
+    :param y: y coordinate of a tile
+    :return: the Morton code of the tile
+    """
+    key = 0
+    bit = 0
+    while x or y:
+        key |= (x & 1) << (2 * bit) | (y & 1) << (2 * bit + 1)
+        x >>= 1
+        y >>= 1
+        bit += 1
+    return key
+
+
+def sort_by_tile_order(buildings, zoom_level, window=DEFAULT_SORT_WINDOW):
+    """
+    Reorders buildings along the Morton order of the tiles containing their centroids, so consecutive buildings share
+    their tiles and the decoded tile cache stays warm
+    :param buildings: an iterable of tuples with the centroid of a building as last element
+    :param zoom_level: the zoom level of the tiles
+    :param window: number of buildings that are sorted together to bound the memory, all buildings if None or 0
+    :return: a generator of the reordered buildings
+    """
+    def order_key(building):
+        tile = mercantile.tile(building[-1].x, building[-1].y, zoom_level)
+        return morton_key(tile.x, tile.y)
+
+    chunk = []
+    for building in buildings:
+        chunk.append(building)
+        if window and len(chunk) >= window:
+            yield from sorted(chunk, key=order_key)
+            chunk = []
+    yield from sorted(chunk, key=order_key)
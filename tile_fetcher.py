@@ -0,0 +1,464 @@
+"""
+MIT License
+
+Copyright (c) 2022 Eike Jens Hoffmann [eike.jens.hoffmann [at] tum.de]
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import logging
+import multiprocessing
+import os
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from tile_store import sniff_format
+
+# URL template for the Google Maps satellite tile server, {x}, {y}, and {z} are replaced per tile
+DEFAULT_TILE_URL = "https://mt1.google.com/vt?lyrs=s&x={x}&y={y}&z={z}"
+
+# Status codes telling that the server is overloaded or throttles the requests
+THROTTLING_STATUS_CODES = {429, 503}
+
+# Status of responses with code 200 whose content is not an image, e.g., an error page
+INVALID_CONTENT = "invalid_content"
+
+# Time in seconds a failed tile is not requested again, per class of failure
+DEFAULT_TTLS = {"permanent": 30 * 24 * 3600, "throttled": 600, "server_error": 3600, "connection_error": 600}
+
+
+class TransientTileError(IOError):
+    """
+    Raised when a tile could not be downloaded because of a temporary problem, e.g., throttling or server errors.
+    Unlike a FileNotFoundError for missing tiles, the building should be tried again in a later run
+    """
+
+
+def classify_failure(status):
+    """
+    Assigns a failure to a class with its own time to live in the negative cache and its own retry behavior
+    :param status: an HTTP status code or the name of the exception of a failed request
+    :return: one of permanent, throttled, server_error, or connection_error
+    """
+    if status == INVALID_CONTENT:
+        return "server_error"
+    if isinstance(status, str):
+        return "connection_error"
+    if status in THROTTLING_STATUS_CODES:
+        return "throttled"
+    if status >= 500:
+        return "server_error"
+    return "permanent"
+
+
+class NegativeTileCache:
+    """
+    Remembers tiles that could not be downloaded, so neighboring buildings do not request them again before their time
+    to live is over. Entries are appended to a journal file, which is loaded at start, so the cache survives restarts.
+    Several processes can append to the same journal, every process reads the entries of the others at most every
+    reload_interval seconds. Expired and replaced entries are dropped when the journal is compacted, which is only safe
+    while no other process has the journal open, e.g., before the worker processes are started
+    """
+
+    def __init__(self, file_path=None, ttls=None, compact=False, reload_interval=30.0):
+        """
+        :param file_path: the path of the journal, the cache is kept in memory only if None
+        :param ttls: time to live in seconds for each class of failure, see DEFAULT_TTLS
+        :param compact: rewrite the journal with the valid entries only after loading it
+        :param reload_interval: seconds between two reads of the entries appended by other processes
+        """
+        self.file_path = file_path
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.reload_interval = reload_interval
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._file = None
+        self._offset = 0
+        self._last_load = time.monotonic()
+        if file_path is None:
+            return
+        if os.path.isfile(file_path):
+            num_lines = self._load()
+            if compact and num_lines > len(self._entries):
+                self._compact()
+        directory = os.path.dirname(file_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._file = open(file_path, "a")
+
+    def _load(self):
+        """
+        Reads the entries appended to the journal since the last call
+        :return: the number of complete lines read
+        """
+        now = time.time()
+        num_lines = 0
+        with open(self.file_path, "rb") as in_file:
+            in_file.seek(self._offset)
+            while True:
+                line = in_file.readline().decode()
+                # An interrupted or ongoing write can leave an incomplete last line, which is read next time
+                if not line.endswith("\n"):
+                    break
+                self._offset = in_file.tell()
+                num_lines += 1
+                cols = line.rstrip("\n").split("\t")
+                if len(cols) != 5:
+                    continue
+                x, y, z, status, expires = cols
+                if float(expires) > now:
+                    self._entries[(int(x), int(y), int(z))] = (int(status) if status.isdigit() else status,
+                                                               float(expires))
+                else:
+                    self._entries.pop((int(x), int(y), int(z)), None)
+        self._last_load = time.monotonic()
+        return num_lines
+
+    def _compact(self):
+        tmp_path = self.file_path + ".tmp"
+        with open(tmp_path, "w") as out_file:
+            for (x, y, z), (status, expires) in self._entries.items():
+                out_file.write("{}\t{}\t{}\t{}\t{:.0f}\n".format(x, y, z, status, expires))
+        os.replace(tmp_path, self.file_path)
+        self._offset = os.path.getsize(self.file_path)
+        logging.info("Compacted negative tile cache {} to {:,} entries".format(self.file_path, len(self._entries)))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, tile):
+        """
+        :param tile: a tile object
+        :return: the status of the last failure if the tile should not be requested, None otherwise
+        """
+        with self._lock:
+            if self._file is not None and time.monotonic() - self._last_load > self.reload_interval:
+                self._load()
+            entry = self._entries.get((tile.x, tile.y, tile.z))
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self._entries[(tile.x, tile.y, tile.z)]
+                return None
+            return entry[0]
+
+    def add(self, tile, status):
+        """
+        Remembers a failed tile for the time to live of its failure class
+        :param tile: a tile object
+        :param status: an HTTP status code or the name of the exception of the failed request
+        :return:
+        """
+        expires = time.time() + self.ttls[classify_failure(status)]
+        with self._lock:
+            self._entries[(tile.x, tile.y, tile.z)] = (status, expires)
+            if self._file is not None:
+                self._file.write("{}\t{}\t{}\t{}\t{:.0f}\n".format(tile.x, tile.y, tile.z, status, expires))
+                self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket that limits the number of requests per second across all workers. Tokens are refilled
+    continuously with the given rate and at most burst tokens can be stored, so idle phases do not lead to a request
+    storm afterwards
+    """
+
+    def __init__(self, rate, burst=None, shared_scale=None):
+        """
+        :param rate: number of tokens (requests) per second
+        :param burst: maximum number of tokens that can be accumulated, defaults to one second worth of tokens
+        :param shared_scale: a multiprocessing.Value("d", 1.0) with the share of the configured rate that is currently
+        used. If the buckets of several processes share it, a throttling response slows all of them down
+        """
+        self.max_rate = float(rate)
+        self.burst = float(burst) if burst is not None else max(1.0, self.max_rate)
+        self._scale = shared_scale if shared_scale is not None else multiprocessing.Value("d", 1.0)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        """
+        :return: the current number of tokens per second, the configured rate reduced after throttling responses
+        """
+        return self.max_rate * self._scale.value
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self, tokens=1.0):
+        """
+        Blocks until the requested number of tokens is available and takes them from the bucket
+        :param tokens: number of tokens to take
+        :return:
+        """
+        start = time.perf_counter()
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    break
+                wait_time = (tokens - self._tokens) / self.rate
+            time.sleep(wait_time)
+        metrics.observe("rate_limit_wait_seconds", time.perf_counter() - start)
+
+    def throttle(self, factor=0.5, min_rate=0.05):
+        """
+        Reduces the rate multiplicatively, e.g., after the server answered with a throttling response
+        :param factor: the factor applied to the current rate
+        :param min_rate: the rate is never reduced below this value
+        :return:
+        """
+        with self._lock, self._scale.get_lock():
+            self._refill()
+            self._scale.value = max(min_rate / self.max_rate, self._scale.value * factor)
+            logging.info("Reduced request rate to {:.2f}/s".format(self.rate))
+
+    def recover(self, step=0.01):
+        """
+        Increases a reduced rate additively after a successful request until the configured rate is reached again
+        :param step: the increase as fraction of the configured rate
+        :return:
+        """
+        if self._scale.value >= 1.0:
+            return
+        with self._lock, self._scale.get_lock():
+            self._refill()
+            self._scale.value = min(1.0, self._scale.value + step)
+
+
+class TileFetcher:
+    """
+    Downloads tiles into a tile store with a bounded pool of worker threads. Every worker thread keeps its
+    own keep-alive session, all workers share one token bucket, and requests for tiles that are already in flight are
+    merged, so a tile is never downloaded twice even if several buildings ask for it at the same time. Throttling, server,
+    and connection errors are retried with exponential backoff and jitter, throttling responses also reduce the shared
+    rate. Tiles that failed are kept in a negative cache
+    """
+
+    def __init__(self, tile_store, tile_url=DEFAULT_TILE_URL, num_workers=8, rate=1.0, burst=None, timeout=30,
+                 negative_cache=None, max_retries=5, backoff_base=1.0, backoff_max=120.0, shared_rate_scale=None):
+        """
+        :param tile_store: the tile store that keeps all downloaded tiles
+        :param tile_url: URL template of the tile source with {x}, {y}, and {z} placeholders, can point to a local
+        server for testing
+        :param num_workers: number of concurrent downloads
+        :param rate: maximum number of requests per second for all workers together
+        :param burst: maximum number of requests that can be sent at once after an idle phase
+        :param timeout: timeout in seconds for a single HTTP request
+        :param negative_cache: the NegativeTileCache of failed tiles, an in-memory cache is used if not given
+        :param max_retries: number of retries of a request after a transient failure
+        :param backoff_base: the first retry waits up to this number of seconds, the maximum doubles with every retry
+        :param backoff_max: the upper limit of the waiting time between two retries in seconds
+        :param shared_rate_scale: the share of the rate shared with the fetchers of other processes, see TokenBucket
+        """
+        self.tile_store = tile_store
+        self.tile_url = tile_url
+        self.num_workers = num_workers
+        self.timeout = timeout
+        self.rate_limiter = TokenBucket(rate, burst, shared_rate_scale)
+        self.negative_cache = negative_cache if negative_cache is not None else NegativeTileCache()
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failures = Counter()
+        self._executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="tile-fetcher")
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Waits for running downloads and shuts the worker pool down
+        :return:
+        """
+        self._executor.shutdown(wait=True)
+
+    def _session(self):
+        # Sessions are not guaranteed to be thread-safe, hence every worker thread gets its own connection pool
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._local.session = session
+        return session
+
+    def submit(self, tile, check_store=True):
+        """
+        Schedules the download of a tile unless it is cached already. Concurrent requests for the same tile share one
+        download
+        :param tile: the tile to be downloaded
+        :param check_store: look the tile up in the store, can be skipped if the caller has checked it already
+        :return: a future of the download or None if the tile is already in the cache
+        """
+        with self._lock:
+            future = self._in_flight.get(tile)
+            if future is not None:
+                return future
+            if check_store and self.tile_store.contains(tile):
+                metrics.inc("tiles_total", source="store")
+                return None
+            future = self._executor.submit(self._download, tile)
+            self._in_flight[tile] = future
+        future.add_done_callback(lambda _: self._release(tile))
+        return future
+
+    def _release(self, tile):
+        with self._lock:
+            self._in_flight.pop(tile, None)
+
+    def num_in_flight(self):
+        """
+        :return: the number of tiles that are queued or downloaded right now
+        """
+        with self._lock:
+            return len(self._in_flight)
+
+    def prefetch(self, tiles):
+        """
+        Schedules the download of a list of tiles without waiting for the results. Errors are not reported here but
+        when the tiles are fetched
+        :param tiles: a list of tiles
+        :return:
+        """
+        self._submit_many(tiles)
+
+    def fetch(self, tiles):
+        """
+        Downloads a list of tiles concurrently and waits until all of them are in the cache. Raises a
+        FileNotFoundError when a tile is not available
+        :param tiles: a list of tiles
+        :return:
+        """
+        for future in self._submit_many(tiles):
+            if future is not None:
+                future.result()
+
+    def _submit_many(self, tiles):
+        # One batched existence check in the store for all tiles
+        present = self.tile_store.contains_many(tiles)
+        if present:
+            metrics.inc("tiles_total", len(present), source="store")
+        return [self.submit(t, check_store=False) for t in tiles if t not in present]
+
+    def _download(self, tile):
+        """
+        Downloads one tile and saves the response bytes as they are in the tile store. The tile is not decoded here,
+        this happens only when it is stitched. Raises a FileNotFoundError if the tile is not available and a
+        TransientTileError if it could not be downloaded after all retries
+        :param tile: the tile to be downloaded
+        :return:
+        """
+        status = self.negative_cache.get(tile)
+        if status is not None:
+            with self._lock:
+                self.failures["cached {}".format(status)] += 1
+            metrics.inc("tiles_total", source="negative_cache")
+            raise self._failure_error(tile, status, "remembered failure")
+        url = self.tile_url.format(x=tile.x, y=tile.y, z=tile.z)
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            retry_after = None
+            try:
+                with metrics.timer("tile_request_seconds"):
+                    response = self._session().get(url, timeout=self.timeout)
+            except requests.RequestException as e:
+                status = type(e).__name__
+            else:
+                status = response.status_code
+                retry_after = response.headers.get("Retry-After")
+                metrics.inc("tile_download_bytes_total", len(response.content))
+                if status == 200:
+                    image_format = sniff_format(response.content)
+                    if image_format is not None:
+                        self.tile_store.put(tile, response.content)
+                        metrics.inc("tile_responses_total", status=status)
+                        metrics.inc("tiles_total", source="download")
+                        self.rate_limiter.recover()
+                        logging.debug("Downloaded tile {} as {}".format(tile, image_format))
+                        return
+                    # The server answered with something else than an image, e.g., an error page
+                    status = INVALID_CONTENT
+            metrics.inc("tile_responses_total", status=status)
+            failure_class = classify_failure(status)
+            if failure_class == "permanent" or attempt == self.max_retries:
+                break
+            if failure_class == "throttled":
+                self.rate_limiter.throttle()
+            with self._lock:
+                self.failures["retry {}".format(status)] += 1
+            time.sleep(self._backoff(attempt, retry_after))
+        with self._lock:
+            self.failures[status] += 1
+        self.negative_cache.add(tile, status)
+        raise self._failure_error(tile, status)
+
+    def _backoff(self, attempt, retry_after=None):
+        """
+        Calculates the waiting time before a retry as exponential backoff with full jitter. A Retry-After header in
+        seconds is respected
+        :param attempt: the number of the failed attempt starting with 0
+        :param retry_after: the value of the Retry-After header of the response, if any
+        :return: the waiting time in seconds
+        """
+        wait_time = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if retry_after is not None and retry_after.isdigit():
+            wait_time = max(wait_time, min(self.backoff_max, float(retry_after)))
+        return wait_time
+
+    @staticmethod
+    def _failure_error(tile, status, reason="got code"):
+        message = "No image for tile {}, {} {}".format(tile, reason, status)
+        if classify_failure(status) == "permanent":
+            return FileNotFoundError(message)
+        return TransientTileError(message)
+
+    def failure_counts(self):
+        """
+        :return: a dictionary with the number of failed tiles per status code, the number of retries, and the number of
+        tiles skipped because of the negative cache
+        """
+        with self._lock:
+            return dict(self.failures)
+
@@ -0,0 +1,333 @@
+"""
+MIT License
+
+Copyright (c) 2022 Eike Jens Hoffmann [eike.jens.hoffmann [at] tum.de]
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import argparse
+import logging
+import os
+import re
+import sqlite3
+import threading
+from collections import defaultdict
+
+import mercantile
+from tqdm import tqdm
+
+# File names of tiles in a cache directory, e.g., 137411-91119-18.png
+TILE_FILE_PATTERN = re.compile(r"^(\d+)-(\d+)-(\d+)\.png$")
+
+# Magic numbers at the start of encoded images
+IMAGE_SIGNATURES = [(b"\xff\xd8\xff", "jpg"), (b"\x89PNG\r\n\x1a\n", "png"), (b"GIF87a", "gif"), (b"GIF89a", "gif")]
+
+
+class DirectoryTileStore:
+    """
+    Stores every tile as a single file in a flat directory. This is the original layout of the tile cache. Files keep
+    the .png name regardless of the image format, which is sniffed from the content when decoding
+    """
+
+    def __init__(self, base_dir, create=True):
+        """
+        :param base_dir: the directory containing all tiles
+        :param create: create the directory if not existing
+        """
+        self.base_dir = base_dir
+        if create and not os.path.exists(base_dir):
+            os.makedirs(base_dir)
+
+    def contains(self, tile):
+        """
+        :param tile: a tile object
+        :return: True if the tile is in the store
+        """
+        return os.path.isfile(get_file_path(self.base_dir, tile))
+
+    def contains_many(self, tiles):
+        """
+        :param tiles: a list of tiles
+        :return: the set of tiles which are in the store
+        """
+        return {t for t in tiles if self.contains(t)}
+
+    def get(self, tile):
+        """
+        Reads the encoded image data of a tile. Raises a FileNotFoundError when the tile is not in the store
+        :param tile: a tile object
+        :return: the encoded image data
+        """
+        with open(get_file_path(self.base_dir, tile), "rb") as in_file:
+            return in_file.read()
+
+    def put(self, tile, data):
+        """
+        Adds the encoded image data of a tile. The data is written to a temporary file first, so readers never see a
+        partially written tile
+        :param tile: a tile object
+        :param data: the encoded image data
+        :return:
+        """
+        file_path = get_file_path(self.base_dir, tile)
+        # Thread idents repeat across processes, hence the worker processes of -p also need the process ID
+        tmp_path = "{}.{}.{}.tmp".format(file_path, os.getpid(), threading.get_ident())
+        with open(tmp_path, "wb") as out_file:
+            out_file.write(data)
+        os.replace(tmp_path, file_path)
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        """
+        :return: a generator of all tiles in the store
+        """
+        with os.scandir(self.base_dir) as entries:
+            for entry in entries:
+                match = TILE_FILE_PATTERN.match(entry.name)
+                if match is not None:
+                    yield mercantile.Tile(*map(int, match.groups()))
+
+
+class MBTilesTileStore:
+    """
+    Stores all tiles in one indexed SQLite file following the MBTiles layout. Existence checks and reads are index
+    lookups instead of lookups in a directory with millions of entries, and the whole cache can be copied as one file.
+    Every thread uses its own connection
+    """
+
+    def __init__(self, file_path, create=True):
+        """
+        :param file_path: the path of the .mbtiles file
+        :param create: create the file and its directory if not existing
+        """
+        self.file_path = file_path
+        if not create and not os.path.isfile(file_path):
+            raise FileNotFoundError("No tile store at {}".format(file_path))
+        directory = os.path.dirname(file_path)
+        if create and directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        connection = self._connection()
+        connection.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)")
+        connection.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, "
+                           "tile_row INTEGER, tile_data BLOB, PRIMARY KEY (zoom_level, tile_column, tile_row))")
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.file_path, timeout=60, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    @staticmethod
+    def _tile_row(tile):
+        # MBTiles uses the TMS scheme where rows are counted from the south
+        return (1 << tile.z) - 1 - tile.y
+
+    def contains(self, tile):
+        """
+        :param tile: a tile object
+        :return: True if the tile is in the store
+        """
+        row = self._connection().execute(
+            "SELECT 1 FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (tile.z, tile.x, self._tile_row(tile))).fetchone()
+        return row is not None
+
+    def contains_many(self, tiles):
+        """
+        Checks the existence of many tiles with one range query per zoom level, which fits the compact blocks of tiles
+        around buildings
+        :param tiles: a list of tiles
+        :return: the set of tiles which are in the store
+        """
+        by_zoom = defaultdict(set)
+        for t in tiles:
+            by_zoom[t.z].add(t)
+        found = set()
+        for z, zoom_tiles in by_zoom.items():
+            rows = [self._tile_row(t) for t in zoom_tiles]
+            result = self._connection().execute(
+                "SELECT tile_column, tile_row FROM tiles WHERE zoom_level = ? AND tile_column BETWEEN ? AND ? "
+                "AND tile_row BETWEEN ? AND ?",
+                (z, min(t.x for t in zoom_tiles), max(t.x for t in zoom_tiles), min(rows), max(rows)))
+            for x, row in result:
+                t = mercantile.Tile(x, (1 << z) - 1 - row, z)
+                if t in zoom_tiles:
+                    found.add(t)
+        return found
+
+    def get(self, tile):
+        """
+        Reads the encoded image data of a tile. Raises a FileNotFoundError when the tile is not in the store
+        :param tile: a tile object
+        :return: the encoded image data
+        """
+        row = self._connection().execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (tile.z, tile.x, self._tile_row(tile))).fetchone()
+        if row is None:
+            raise FileNotFoundError("Tile {} not in {}".format(tile, self.file_path))
+        return row[0]
+
+    def put(self, tile, data):
+        """
+        Adds the encoded image data of a tile
+        :param tile: a tile object
+        :param data: the encoded image data
+        :return:
+        """
+        self.put_many([(tile, data)])
+
+    def put_many(self, items, replace=True):
+        """
+        Adds many tiles in one transaction. The image format of the first tile is recorded in the metadata
+        :param items: a list of (tile, encoded image data) tuples
+        :param replace: overwrite tiles which are already in the store, otherwise they are kept
+        :return:
+        """
+        if not items:
+            return
+        statement = "INSERT OR {} INTO tiles VALUES (?, ?, ?, ?)".format("REPLACE" if replace else "IGNORE")
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN")
+            connection.execute("INSERT OR IGNORE INTO metadata VALUES ('format', ?)", (sniff_format(items[0][1]),))
+            connection.executemany(statement,
+                                   [(t.z, t.x, self._tile_row(t), sqlite3.Binary(data)) for t, data in items])
+
+    def close(self):
+        """
+        Closes the connections of all threads
+        :return:
+        """
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        self._local = threading.local()
+
+    def __iter__(self):
+        """
+        :return: a generator of all tiles in the store
+        """
+        for z, x, row in self._connection().execute("SELECT zoom_level, tile_column, tile_row FROM tiles"):
+            yield mercantile.Tile(x, (1 << z) - 1 - row, z)
+
+
+def open_tile_store(location, create=True):
+    """
+    Opens the tile store backend matching the location: files ending with .mbtiles are single-file SQLite stores, all
+    other locations are directories with one file per tile
+    :param location: path of the tile store
+    :param create: create the store if not existing
+    :return: a tile store
+    """
+    if location.endswith(".mbtiles"):
+        return MBTilesTileStore(location, create)
+    return DirectoryTileStore(location, create)
+
+
+def sniff_format(data):
+    """
+    Determines the image format from the first bytes of encoded image data
+    :param data: the encoded image data
+    :return: the format as file extension, e.g., jpg or png, or None if the format is unknown
+    """
+    for signature, image_format in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return image_format
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def get_file_path(base_dir, tile):
+    """
+    A simple method to unify the way tile objects are mapped to file paths. Does not check if file exists!
+    :param base_dir: the directory containing all tiles, i.e., the caching directory
+    :param tile: a tile object
+    :return: the file path where the file should be stored
+    """
+    file_name = "{}-{}-{}.png".format(tile.x, tile.y, tile.z)
+    file_path = os.path.join(base_dir, file_name)
+    return file_path
+
+
+def import_directory(tiles_dir, target, batch_size=10000):
+    """
+    Copies all tiles of a flat cache directory into a single-file tile store. Tiles already present in the target are
+    kept
+    :param tiles_dir: the cache directory with one file per tile
+    :param target: the MBTilesTileStore receiving the tiles
+    :param batch_size: number of tiles written per transaction
+    :return: the number of tiles read from the cache directory
+    """
+    source = DirectoryTileStore(tiles_dir, create=False)
+    batch = []
+    num_tiles = 0
+    for t in tqdm(source):
+        batch.append((t, source.get(t)))
+        if len(batch) >= batch_size:
+            target.put_many(batch, replace=False)
+            num_tiles += len(batch)
+            batch = []
+    target.put_many(batch, replace=False)
+    return num_tiles + len(batch)
+
+
+def parse_args():
+    """
+    Reads the command line arguments and returns them
+
+    :return: cmd args
+    """
+    parser = argparse.ArgumentParser("Migrates a flat tile cache directory into a single-file tile store")
+    parser.add_argument("tiles_cache_dir", help="Cache directory with one file per tile")
+    parser.add_argument("tile_store", help="Target single-file tile store, e.g., tiles.mbtiles")
+    parser.add_argument("-b", dest="batch_size", help="Number of tiles per transaction", default=10000, type=int)
+    return parser.parse_args()
+
+
+def main():
+    """
+    Imports all tiles of a cache directory into a tile store
+    :return:
+    """
+    args = parse_args()
+    target = MBTilesTileStore(args.tile_store)
+    try:
+        num_tiles = import_directory(args.tiles_cache_dir, target, args.batch_size)
+    finally:
+        target.close()
+    logging.info(f"Imported {num_tiles:,} tiles into {args.tile_store}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+    main()
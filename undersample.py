@@ -22,10 +22,13 @@ SOFTWARE.
 
 import argparse
 import logging
-from itertools import product
 
+import numpy as np
 import pandas as pd
-from tqdm import tqdm
+
+from preprocess import is_columnar, read_buildings_table, take_rows, write_buildings_table
+from streaming import DEFAULT_MEMORY_MB, ChunkedTableWriter, HashedIdSet, ValueEncoder, estimate_chunk_size, \
+    iter_chunks
 
 # A carefully chosen random seed
 SEED = 42
@@ -38,62 +41,166 @@ def parse_args():
     :return: cmd args
     """
     parser = argparse.ArgumentParser("Two dimensional downsampling on city and class level")
-    parser.add_argument("input_csv_bz2", help="Imbalanced buildings CSV file with Bzip2 compression as input")
-    parser.add_argument("output_csv_bz2", help="Balanced buildings CSV file with Bzip2 compression as output")
+    parser.add_argument("input_csv_bz2", help="Imbalanced buildings CSV file with Bzip2 compression or preprocessed "
+                                              "Parquet file as input")
+    parser.add_argument("output_csv_bz2", help="Balanced buildings CSV file with Bzip2 compression or Parquet file as "
+                                               "output")
+    parser.add_argument("--streaming", help="Read the input twice chunk by chunk instead of loading it into memory. "
+                                            "The output contains the same buildings, but in the order of the input "
+                                            "file", action="store_true")
+    parser.add_argument("-m", dest="memory_mb", help="Memory ceiling of a chunk in megabytes in streaming mode",
+                        default=DEFAULT_MEMORY_MB, type=int)
     return parser.parse_args()
 
 
-def calc_num_samples_per_city_and_class(data):
+def encode_groups(data):
     """
-    Calculates the number of building samples per class and city as well as the desired number of building samples per
-    class and city. This number is defined as the
+    Encodes the city and the class of each building as integer codes. Buildings without city or class get the code -1
 
     :param data: a Pandas dataframe read from the input buildings CSV file
-    :return: 1. a list of all city names, 2. a list of all classes, 3. the designated number of
+    :return: 1. city codes, 2. sorted list of all city names, 3. class codes, 4. sorted list of all classes
+    """
+    city_codes, cities = pd.factorize(data["city"], sort=True)
+    class_codes, classes = pd.factorize(data["class"], sort=True)
+    return city_codes, cities.tolist(), class_codes, classes.tolist()
+
+
+def calc_num_samples_per_city_and_class(has_id, class_codes, classes, cities):
     """
-    # Count the number of cities and classes
-    class_count = data.groupby("class").nunique()
-    city_count = data.groupby("city").nunique()
-    logging.debug(f"Found {city_count} cities")
+    Calculates the desired number of building samples per class and city. This number is defined as the number of
+    samples of the class with the least support divided by the number of cities
+
+    :param has_id: a boolean array telling which buildings of the deduplicated data have a building ID
+    :param class_codes: class code of each building
+    :param classes: sorted list of all classes
+    :param cities: sorted list of all city names
+    :return: the designated number of samples per city and class
+    """
+    logging.debug(f"Found {len(cities)} cities")
+    # Count the buildings with an ID per class, the IDs are unique after the deduplication
+    valid = (class_codes >= 0) & has_id
+    class_count = np.bincount(class_codes[valid], minlength=len(classes))
     # Get the class with the lowest number of building samples
-    min_class, min_samples = class_count["building_id"].idxmin(),  class_count["building_id"].min()
-    # Calculate the desired number of samples per city and class
-    num_samples_per_city = min_samples // city_count.shape[0]
-    logging.debug(f"Class {min_class} has least support with {min_samples} samples")
-    return city_count.index.tolist(), class_count.index.tolist(), num_samples_per_city
+    min_class = int(np.argmin(class_count))
+    min_samples = int(class_count[min_class])
+    logging.debug(f"Class {classes[min_class]} has least support with {min_samples} samples")
+    return min_samples // len(cities)
 
 
-def random_city_split(data, city, clazz, desired_num_samples_per_city_and_class):
+def random_permutation(n, seed=SEED):
     """
-    Tries to obtain the desired number of building samples from the given data for a specified city and class. If
-    samples are missing, they will be reported as a number. If more samples are available, they are returned in a
-    separate list
+    Shuffles n items exactly like Pandas' sample(frac=1.0, random_state=seed) does
 
-    :param data: a Pandas dataframe read from the input buildings CSV file
-    :param city: one of the cities out of the list of cities
-    :param clazz: one of the classes out of the list of classes
-    :param desired_num_samples_per_city_and_class: the ideal number of samples per class and city
-    :return: 1. a random sample of buildings from the given data, might be smaller than the ideal number of samples if
-    there is no sufficient data
-    2. unused samples of cities and class, which can be used for backfilling. None if there is no sufficient data
-    3. number of samples missing for the city and the class
-    """
-    # Select the subset for city and class
-    city_class_subset = data[data["city"] == city]
-    city_class_subset = city_class_subset[city_class_subset["class"] == clazz]
-    # Perform random shuffling
-    city_class_subset = city_class_subset.sample(frac=1.0, random_state=SEED)
-    num_city_class_samples = city_class_subset.shape[0]
-    # Return the results
-    if num_city_class_samples < desired_num_samples_per_city_and_class:
-        missing_items = desired_num_samples_per_city_and_class - num_city_class_samples
-        return city_class_subset, None, missing_items
-    elif num_city_class_samples > desired_num_samples_per_city_and_class:
-        return city_class_subset[:desired_num_samples_per_city_and_class], \
-               city_class_subset[desired_num_samples_per_city_and_class:], \
-               0
-    else:
-        return city_class_subset, None, 0
+    :param n: number of items
+    :param seed: random seed
+    :return: a permutation of range(n)
+    """
+    return np.random.RandomState(seed).permutation(n)
+
+
+def balance(data, seed=SEED):
+    """
+    Selects a random sample of buildings with the same number of buildings per city and class. Cities and classes
+    with too few buildings are backfilled per class with buildings from the other cities
+
+    :param data: a deduplicated Pandas dataframe read from the input buildings CSV file
+    :param seed: random seed
+    :return: positions of the selected rows in data, ordered by city and class followed by the backfill per class
+    """
+    city_codes, cities, class_codes, classes = encode_groups(data)
+    return balance_groups(city_codes, cities, class_codes, classes, data["building_id"].notna().to_numpy(), seed)
+
+
+def balance_groups(city_codes, cities, class_codes, classes, has_id, seed=SEED):
+    """
+    Balances buildings given by their city and class codes. All groups are formed in a single pass over the codes,
+    sampling only shuffles row positions
+
+    :param city_codes: city code of each building, -1 if the city is missing
+    :param cities: sorted list of all city names
+    :param class_codes: class code of each building, -1 if the class is missing
+    :param classes: sorted list of all classes
+    :param has_id: a boolean array telling which buildings have a building ID
+    :param seed: random seed
+    :return: positions of the selected buildings, ordered by city and class followed by the backfill per class
+    """
+    num_samples_per_city = calc_num_samples_per_city_and_class(has_id, class_codes, classes, cities)
+    logging.info(f"Need {num_samples_per_city:,} samples per city and class")
+    # Group the row positions by city and class, rows of a group keep their order
+    num_classes = len(classes)
+    group_codes = city_codes * num_classes + class_codes
+    group_codes[(city_codes < 0) | (class_codes < 0)] = -1
+    order = np.argsort(group_codes, kind="stable")
+    order = order[np.searchsorted(group_codes[order], 0):]
+    group_sizes = np.bincount(group_codes[order], minlength=len(cities) * num_classes)
+    group_starts = np.concatenate([[0], np.cumsum(group_sizes)[:-1]])
+    # Shuffle each group and keep the first samples, the rest of the group can be used for backfilling
+    dataset = []
+    excess_list = {cls: [] for cls in range(num_classes)}
+    missing_numbers = np.zeros(num_classes, dtype=np.int64)
+    for group, (start, size) in enumerate(zip(group_starts, group_sizes)):
+        cls = group % num_classes
+        rows = order[start:start + size][random_permutation(size, seed)]
+        dataset.append(rows[:num_samples_per_city])
+        excess_list[cls].append(rows[num_samples_per_city:])
+        missing_numbers[cls] += max(num_samples_per_city - size, 0)
+    # Backfill with data from excess lists
+    for cls in range(num_classes):
+        excess = np.concatenate(excess_list[cls])
+        if missing_numbers[cls] > excess.shape[0]:
+            raise ValueError(f"Class {classes[cls]} is missing {missing_numbers[cls]:,} samples, but only "
+                             f"{excess.shape[0]:,} are available for backfilling")
+        logging.debug(f"Backfilling {missing_numbers[cls]:,} samples of class {classes[cls]}")
+        dataset.append(excess[random_permutation(excess.shape[0], seed)[:missing_numbers[cls]]])
+    return np.concatenate(dataset)
+
+
+def scan_buildings(file_name, chunk_size):
+    """
+    First pass of the streaming mode, reads only building IDs, classes, and cities chunk by chunk and deduplicates the
+    buildings by their ID
+
+    :param file_name: a buildings CSV file or a preprocessed Parquet file
+    :param chunk_size: number of rows per chunk
+    :return: 1. row numbers of the deduplicated buildings, 2. city codes, 3. sorted list of all city names, 4. class
+    codes, 5. sorted list of all classes, 6. boolean array telling which buildings have an ID, 7. number of rows
+    """
+    seen_ids = HashedIdSet()
+    city_encoder, class_encoder = ValueEncoder(), ValueEncoder()
+    row_numbers, city_codes, class_codes, has_id = [], [], [], []
+    num_rows = 0
+    for chunk in iter_chunks(file_name, chunk_size, ["building_id", "class", "city"]):
+        num_rows += chunk.shape[0]
+        chunk = chunk[seen_ids.add_new(chunk["building_id"].to_numpy())]
+        row_numbers.append(chunk.index.to_numpy())
+        city_codes.append(city_encoder.encode(chunk["city"]))
+        class_codes.append(class_encoder.encode(chunk["class"]))
+        has_id.append(chunk["building_id"].notna().to_numpy())
+    city_codes, cities = city_encoder.sorted_codes(np.concatenate(city_codes))
+    class_codes, classes = class_encoder.sorted_codes(np.concatenate(class_codes))
+    return np.concatenate(row_numbers), city_codes, cities, class_codes, classes, np.concatenate(has_id), num_rows
+
+
+def undersample_streaming(input_file, output_file, memory_mb=DEFAULT_MEMORY_MB):
+    """
+    Balances a buildings file with bounded memory. The first pass selects the buildings from their IDs, cities, and
+    classes, the second pass copies the selected rows to the output in the order of the input file
+
+    :param input_file: a buildings CSV file or a preprocessed Parquet file
+    :param output_file: a CSV file or a Parquet file
+    :param memory_mb: memory ceiling of a chunk in megabytes
+    :return: the number of rows written
+    """
+    chunk_size = estimate_chunk_size(input_file, memory_mb)
+    row_numbers, city_codes, cities, class_codes, classes, has_id, num_rows = scan_buildings(input_file, chunk_size)
+    logging.info(f"Read {num_rows:,} buildings, deduplication yielded {row_numbers.shape[0]:,} buildings")
+    selected = np.zeros(num_rows, dtype=bool)
+    selected[row_numbers[balance_groups(city_codes, cities, class_codes, classes, has_id)]] = True
+    del row_numbers, city_codes, class_codes, has_id
+    with ChunkedTableWriter(output_file) as writer:
+        for chunk in iter_chunks(input_file, chunk_size):
+            writer.write(chunk[selected[chunk.index.start:chunk.index.stop]])
+    return writer.num_rows
 
 
 def main():
@@ -103,35 +210,26 @@ def main():
     """
     # Read the command line arguments
     args = parse_args()
+    if args.streaming:
+        num_rows = undersample_streaming(args.input_csv_bz2, args.output_csv_bz2, args.memory_mb)
+        logging.info(f"Balanced dataset {args.output_csv_bz2} has {num_rows:,} rows")
+        return
     # Read the buildings.csv.bz2
     logging.info(f"Reading {args.input_csv_bz2} ...")
-    data = pd.read_csv(args.input_csv_bz2)
+    columnar = is_columnar(args.input_csv_bz2)
+    # Only the columns needed for balancing are read from a preprocessed file, the index keeps the row numbers
+    data = read_buildings_table(args.input_csv_bz2, ["building_id", "class", "city"]) if columnar else \
+        pd.read_csv(args.input_csv_bz2)
     logging.info(f"Read {args.input_csv_bz2} with {data.shape[0]:,} buildings")
     # Make sure that each building is only once in the dataset
     data.drop_duplicates(subset="building_id", inplace=True)
     logging.info(f"Deduplication yielded {data.shape[0]:,} buildings")
-    # Calculate the statistics including the desired number of samples per city and class
-    cities, classes, num_samples_per_city = calc_num_samples_per_city_and_class(data)
-    logging.info(f"Need {num_samples_per_city:,} samples per city and class")
-    # Initialize the dataset
-    dataset = []
-    excess_list = {cls: [] for cls in classes}
-    missing_numbers = {cls: 0 for cls in classes}
-    # Perform the initial balancing by iterating over all cities and classes
-    for city, cls in tqdm(product(cities, classes), total=len(cities) * len(classes)):
-        sub_data, excess, missing = random_city_split(data, city, cls, num_samples_per_city)
-        dataset.append(sub_data)
-        if excess is not None:
-            excess_list[cls].append(excess)
-        missing_numbers[cls] += missing
-    # Backfill with data from excess lists
-    for cls in classes:
-        excess = pd.concat(excess_list[cls], axis=0)
-        dataset.append(excess.sample(n=missing_numbers[cls], random_state=SEED))
-    # Put the final balanced dataset together and write it to a file
-    dataset = pd.concat(dataset, axis=0)
+    # Perform the balancing and put the final balanced dataset together
+    dataset = data.iloc[balance(data)]
+    if columnar:
+        dataset = take_rows(args.input_csv_bz2, dataset.index.to_numpy())
     logging.info(f"Balanced dataset {args.output_csv_bz2} has {dataset.shape[0]:,} rows")
-    dataset.to_csv(args.output_csv_bz2, index=False)
+    write_buildings_table(dataset, args.output_csv_bz2)
     # print(dataset)
 
 